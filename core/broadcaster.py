@@ -0,0 +1,69 @@
+from .history import HistoryRecord
+from threading import Lock
+from typing import List, NamedTuple, TYPE_CHECKING
+
+# asyncio 只在有客户端订阅（即启动了网页服务）时才用到，在那时再导入，
+# 无界面模式下不用为它付出启动时间
+if TYPE_CHECKING:
+    import asyncio
+
+
+class SampleBatch(NamedTuple):
+    records: List[HistoryRecord]
+    # 本批第一条记录的序号，等于上一批的 cursor 时说明中间没有丢帧
+    since: int
+    cursor: int
+    version: int
+
+
+class Subscription:
+    """
+    每个客户端一个有界队列，只在事件循环线程上读写
+    队列满了就丢掉最旧的一批，客户端通过 since 不连续发现丢帧后自行补齐
+    """
+
+    def __init__(self, loop: "asyncio.AbstractEventLoop", queue_size: int) -> None:
+        import asyncio
+
+        self.loop = loop
+        self.queue: "asyncio.Queue" = asyncio.Queue(maxsize=queue_size)
+        self.dropped = 0
+
+    def _put(self, batch: SampleBatch) -> None:
+        if self.queue.full():
+            self.queue.get_nowait()
+            self.dropped += 1
+        self.queue.put_nowait(batch)
+
+    async def get(self) -> SampleBatch:
+        return await self.queue.get()
+
+
+class SampleBroadcaster:
+    def __init__(self, queue_size: int = 16) -> None:
+        self.queue_size = queue_size
+        self.subscriptions: List[Subscription] = []
+        self.lock = Lock()
+
+    def subscribe(self, loop: "asyncio.AbstractEventLoop") -> Subscription:
+        subscription = Subscription(loop, self.queue_size)
+        with self.lock:
+            self.subscriptions = self.subscriptions + [subscription]
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        with self.lock:
+            self.subscriptions = [
+                s for s in self.subscriptions if s is not subscription
+            ]
+
+    def publish(self, batch: SampleBatch) -> None:
+        """
+        由采样线程调用，只把批次投递到各个事件循环，不在这里做编码或等待
+        """
+        for subscription in self.subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription._put, batch)
+            except RuntimeError:
+                # 事件循环已经关闭
+                self.unsubscribe(subscription)
@@ -0,0 +1,212 @@
+"""
+服务端降采样：图表每个像素只需要一两个点，没必要把所有原始记录都发给前端
+
+- minmax（默认）：按时间分桶，每个 pid 每个桶输出两行，每个指标分别取桶内的最小值和最大值，
+  按出现的先后放进这两行，尖峰不会被平均掉
+- avg：每个 pid 每个桶输出一行平均值
+- lttb：Largest-Triangle-Three-Buckets，按 metric 指定的指标挑出最能保留曲线形状的记录，
+  输出的都是真实的采样，其余指标取同一时刻的值
+
+每个 pid 最多输出约 max_points 行，记录再多响应大小也有上限；
+桶按 resolution 的整数倍对齐，所有 pid 共用同一组桶，曲线之间可以直接对比
+"""
+
+from .history import History, HistoryColumns, METRIC_FIELDS
+from array import array
+from bisect import bisect_left
+from typing import Dict, List, Optional
+import math
+
+METHODS = ("minmax", "avg", "lttb")
+
+# minmax 每个桶输出两行，max_points 再小就无法保证上限
+MIN_MAX_POINTS = 2
+
+
+class _Rows:
+    """
+    按行收集输出，最后按时间戳排序拼成 HistoryColumns
+    """
+
+    def __init__(self) -> None:
+        self.kind_ids = array("I")
+        self.timestamps = array("d")
+        self.metrics: Dict[str, array] = {field: array("f") for field in METRIC_FIELDS}
+
+    def add(self, kind_id: int, timestamp_seconds: float, values: Dict[str, float]):
+        self.kind_ids.append(kind_id)
+        self.timestamps.append(timestamp_seconds)
+        for field, value in values.items():
+            self.metrics[field].append(value)
+
+    def add_range(self, series: HistoryColumns, start: int, end: int) -> None:
+        self.kind_ids.extend(series.kind_ids[start:end])
+        self.timestamps.extend(series.timestamps[start:end])
+        for field, column in series.metrics.items():
+            self.metrics[field].extend(column[start:end])
+
+    def add_indices(self, series: HistoryColumns, indices: List[int]) -> None:
+        for i in indices:
+            self.add_range(series, i, i + 1)
+
+    def to_columns(self, kinds, first_sequence: int, next_sequence: int):
+        order = sorted(range(len(self.timestamps)), key=self.timestamps.__getitem__)
+        kind_ids = array("I", (self.kind_ids[i] for i in order))
+        return HistoryColumns(
+            kinds={kind_id: kinds[kind_id] for kind_id in set(kind_ids)},
+            kind_ids=kind_ids,
+            timestamps=array("d", (self.timestamps[i] for i in order)),
+            metrics={
+                field: array("f", (column[i] for i in order))
+                for field, column in self.metrics.items()
+            },
+            first_sequence=first_sequence,
+            next_sequence=next_sequence,
+            gap=False,
+        )
+
+
+def _buckets(timestamps: array, width: int):
+    """
+    依次返回每个非空桶的 [start, end) 下标
+    """
+    start = 0
+    while start < len(timestamps):
+        bucket_end = (timestamps[start] // width + 1) * width
+        end = max(start + 1, bisect_left(timestamps, bucket_end, lo=start))
+        yield start, end
+        start = end
+
+
+def _bucket_width(first: int, last: int, buckets: int, min_width: int) -> int:
+    """
+    不小于 min_width 的桶宽，使 [first, last] 按桶宽的整数倍对齐之后最多落在 buckets 个桶里
+    只按时间跨度除以桶数的话，对齐会让首尾各多出半个桶，桶数可能多一个
+    """
+    width = max(min_width, math.ceil((last - first + 1) / buckets))
+    if last // width - first // width + 1 <= buckets:
+        return width
+    if buckets == 1:
+        # 时间戳非负，桶宽超过 last 时所有记录都在第一个桶里
+        return max(width, last + 1)
+    # 此时 (last - first) / width < buckets - 1，对齐之后最多 buckets 个桶
+    return max(width, math.ceil((last - first + 1) / (buckets - 1)))
+
+
+def _minmax(series: HistoryColumns, width: int, rows: _Rows) -> None:
+    for start, end in _buckets(series.timestamps, width):
+        if end - start <= 2:
+            rows.add_range(series, start, end)
+            continue
+        first, second = {}, {}
+        for field, column in series.metrics.items():
+            values = column[start:end]
+            low, high = min(values), max(values)
+            if values.index(low) <= values.index(high):
+                first[field], second[field] = low, high
+            else:
+                first[field], second[field] = high, low
+        rows.add(series.kind_ids[start], series.timestamps[start], first)
+        rows.add(series.kind_ids[end - 1], series.timestamps[end - 1], second)
+
+
+def _avg(series: HistoryColumns, width: int, rows: _Rows) -> None:
+    for start, end in _buckets(series.timestamps, width):
+        rows.add(
+            series.kind_ids[start],
+            series.timestamps[start],
+            {
+                field: math.fsum(column[start:end]) / (end - start)
+                for field, column in series.metrics.items()
+            },
+        )
+
+
+def _lttb_indices(x: array, y: array, threshold: int) -> List[int]:
+    count = len(y)
+    if threshold >= count:
+        return list(range(count))
+    if threshold < 3:
+        # 不够放中间的点，只保留首尾
+        return [0, count - 1][:threshold]
+    every = (count - 2) / (threshold - 2)
+    indices = [0]
+    a = 0
+    for i in range(threshold - 2):
+        # 下一个桶的平均点
+        next_start = int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, count)
+        avg_x = sum(x[next_start:next_end]) / (next_end - next_start)
+        avg_y = math.fsum(y[next_start:next_end]) / (next_end - next_start)
+        # 当前桶中与上一个选中点、下一个桶平均点构成的三角形面积最大的点
+        ax, ay = x[a], y[a]
+        best, best_area = -1, -1.0
+        for k in range(int(i * every) + 1, next_start):
+            area = abs((ax - avg_x) * (y[k] - ay) - (ax - x[k]) * (avg_y - ay))
+            if area > best_area:
+                best, best_area = k, area
+        indices.append(best)
+        a = best
+    indices.append(count - 1)
+    return indices
+
+
+def downsample(
+    history: History,
+    max_points: Optional[int] = None,
+    resolution: Optional[int] = None,
+    method: str = "minmax",
+    metric: str = "cpu_percent",
+    start_time: Optional[int] = None,
+    end_time: Optional[int] = None,
+    pid: Optional[int] = None,
+    target: Optional[str] = None,
+) -> HistoryColumns:
+    """
+    max_points：每个 pid 最多输出的行数，不能小于 MIN_MAX_POINTS；resolution：桶宽（秒）
+    两者都给时取较粗的那个；记录数不超过 max_points 的 pid 原样返回
+    多目标时每个目标的总值各算一条曲线；target：只输出该目标的记录
+    """
+    if method not in METHODS:
+        raise ValueError(f"不支持的降采样方法：{method}")
+    if metric not in METRIC_FIELDS:
+        raise ValueError(f"不支持的指标：{metric}")
+    if max_points is not None and max_points < MIN_MAX_POINTS:
+        raise ValueError(f"max_points 不能小于 {MIN_MAX_POINTS}")
+
+    # 先记下游标：之后追加的记录可能也被读到，前端从这里继续增量同步时最多重复几条，不会遗漏
+    first_sequence = history.first_sequence
+    next_sequence = history.next_sequence
+    keys = [key for key in history.get_series_keys(target) if pid in (None, key[0])]
+    series_list = [
+        history.get_series(p, start_time, end_time, name) for p, name in keys
+    ]
+    series_list = [series for series in series_list if len(series.timestamps) > 0]
+
+    width = max(1, resolution or 1)
+    if max_points is not None and len(series_list) > 0:
+        first = min(series.timestamps[0] for series in series_list)
+        last = max(series.timestamps[-1] for series in series_list)
+        buckets = max_points // 2 if method == "minmax" else max_points
+        width = _bucket_width(first, last, buckets, width)
+
+    rows = _Rows()
+    kinds = {}
+    for series in series_list:
+        kinds.update(series.kinds)
+        count = len(series.timestamps)
+        if resolution is None and max_points is not None and count <= max_points:
+            rows.add_range(series, 0, count)
+        elif method == "lttb":
+            threshold = max_points or math.ceil(
+                (series.timestamps[-1] - series.timestamps[0] + 1) / width
+            )
+            rows.add_indices(
+                series,
+                _lttb_indices(series.timestamps, series.metrics[metric], threshold),
+            )
+        elif method == "avg":
+            _avg(series, width, rows)
+        else:
+            _minmax(series, width, rows)
+    return rows.to_columns(kinds, first_sequence, next_sequence)
@@ -1,5 +1,14 @@
-from typing import NamedTuple, List, Optional, Dict, Any
+from typing import NamedTuple, List, Optional, Dict, Any, Iterable, Iterator, Tuple
 from helpers.memory_helper import MemoryUtilization
+from array import array
+from bisect import bisect_left, bisect_right
+from itertools import repeat
+from operator import add, itemgetter
+from threading import Lock
+import csv
+import gzip
+import io
+import math
 import time
 
 
@@ -10,7 +19,8 @@ class ProcessKind(NamedTuple):
 
 
 class HistoryRecord(NamedTuple):
-    timestamp_seconds: int
+    # 精确到毫秒
+    timestamp_seconds: float
     process: ProcessKind
     memory_utilization: MemoryUtilization
     cpu_percent: float
@@ -35,20 +45,39 @@ class HistoryRecord(NamedTuple):
             "vsize": self.memory_utilization.vsize,
         }
 
+    def metric_values(self) -> Tuple:
+        """
+        按 METRIC_FIELDS 的顺序取出所有指标
+        """
+        m = self.memory_utilization
+        return (
+            self.cpu_percent,
+            self.gpu_percent,
+            m.taskmgr_mb,
+            m.uss_mb,
+            m.rss_mb,
+            m.vms_mb,
+            m.wset_mb,
+            m.pwset_mb,
+            m.system_total_memory_mb,
+            m.system_free_memory_mb,
+            m.vsize,
+        )
+
     def serialize(self) -> str:
-        pairs = self.to_dict()
-        return ",".join(map(str, pairs.values()))
+        values = iter(self.to_dict().values())
+        return ",".join([_format_timestamp(next(values)), *map(_format_value, values)])
 
     @staticmethod
     def parse(s: str) -> "HistoryRecord":
-        values = s.split(",")
+        values = next(csv.reader([s]))
         return HistoryRecord(
-            timestamp_seconds=int(values[0]),
+            timestamp_seconds=_parse_timestamp(values[0]),
             process=ProcessKind(pid=int(values[1]), name=values[2], label=values[3]),
             cpu_percent=float(values[4]),
             gpu_percent=float(values[5]),
             memory_utilization=MemoryUtilization(
-                taskmgr_mb=float(values(6)),
+                taskmgr_mb=float(values[6]),
                 uss_mb=float(values[7]),
                 rss_mb=float(values[8]),
                 vms_mb=float(values[9]),
@@ -61,11 +90,446 @@ class HistoryRecord(NamedTuple):
         )
 
 
+class HistorySlice(NamedTuple):
+    records: List[HistoryRecord]
+    # 本次返回的记录之前，保留的最旧一条记录的序号
+    first_sequence: int
+    # 下一次增量请求应当使用的游标
+    next_sequence: int
+    # 请求的游标已经被淘汰或清空，中间有记录永久丢失了
+    gap: bool
+
+
+class HistoryColumns(NamedTuple):
+    """
+    与 HistorySlice 含义相同，但按列返回，不为每条记录创建对象
+    """
+
+    kinds: Dict[int, ProcessKind]
+    kind_ids: array
+    timestamps: array
+    metrics: Dict[str, array]
+    first_sequence: int
+    next_sequence: int
+    gap: bool
+
+
+# 列存储里每一列对应的指标，顺序与 MemoryUtilization 无关
+METRIC_FIELDS = (
+    "cpu_percent",
+    "gpu_percent",
+    "taskmgr_mb",
+    "uss_mb",
+    "rss_mb",
+    "vms_mb",
+    "wset_mb",
+    "pwset_mb",
+    "system_total_memory_mb",
+    "system_free_memory_mb",
+    "vsize",
+)
+
+# CSV 中与 HistoryRecord.to_dict 同名的列，后面的指标列与 METRIC_FIELDS 同序
+CSV_COLUMNS = (
+    "timestamp_seconds",
+    "process_id",
+    "process_name",
+    "process_label",
+) + METRIC_FIELDS
+
+
+# 载入 CSV 时每攒够这么多行批量写入存储和汇总一次
+LOAD_CHUNK_ROWS = 4096
+
+
+class LoadReport(NamedTuple):
+    # 成功载入的行数（超过 history_upperbound 的部分会被环形缓冲区挤掉）
+    # 为 0 时现有的记录保持不变
+    loaded: int
+    failed: int
+    # 前若干个解析失败的行：(行号, 原因)；原因只给出列名，不包含行的内容
+    errors: List[Tuple[int, str]]
+
+
+def _csv_column_indices(header: List[str]) -> List[int]:
+    missing = [column for column in CSV_COLUMNS if column not in header]
+    if len(missing) > 0:
+        raise ValueError(f"CSV 缺少列：{', '.join(missing)}")
+    return [header.index(column) for column in CSV_COLUMNS]
+
+
+def _row_error(row: List[str], indices: List[int]) -> str:
+    """
+    解析失败的原因；不把字段的值放进去，以免把载入的文件内容原样回显给调用方
+    """
+    # 与 load_stream 中的转换一一对应
+    metrics = (float,) * len(METRIC_FIELDS)
+    converters = (_parse_timestamp, int, str, str) + metrics
+    for column, index, convert in zip(CSV_COLUMNS, indices, converters):
+        if index >= len(row):
+            return f"缺少列 {column}"
+        try:
+            convert(row[index])
+        except (ValueError, OverflowError):
+            return f"列 {column} 不是有效的数字"
+    return "无法解析"
+
+
+def _gather(column: array, slots: List[int]) -> tuple:
+    # itemgetter 在 C 里逐个取值，比列表推导快得多
+    if len(slots) == 0:
+        return ()
+    if len(slots) == 1:
+        return (column[slots[0]],)
+    return itemgetter(*slots)(column)
+
+
+def _format_value(value: Any) -> str:
+    # 指标以 float32 存储，按 7 位有效数字输出，避免 12.300000190734863 这种尾巴
+    if isinstance(value, float):
+        return format(value, ".7g")
+    text = str(value)
+    # 进程名和标签可能含有逗号或引号，按 CSV 规则加引号
+    if any(c in text for c in ',"\r\n'):
+        return '"' + text.replace('"', '""') + '"'
+    return text
+
+
+def _parse_timestamp(text: str) -> float:
+    # int(float(...)) 会拒绝 nan / inf，换成浮点数之后需要自己检查
+    value = float(text)
+    if not math.isfinite(value):
+        raise ValueError("时间戳不是有限的数")
+    return value
+
+
+def _format_timestamp(value: float) -> str:
+    # 精确到毫秒；整秒时不带小数，与以前的日志相同
+    text = format(value, ".3f").rstrip("0")
+    return text[:-1] if text.endswith(".") else text
+
+
+def _overwritten(store: "_ColumnStore", seqs) -> Tuple[int, int]:
+    """
+    seqs 为升序的序号，对应的记录已经读出
+    返回 (开头有几条在读取期间被覆盖, 此刻仍然有效的最小序号)
+    """
+    valid_from = store.valid_from()
+    if len(seqs) == 0 or seqs[0] >= valid_from:
+        return 0, valid_from
+    return bisect_left(seqs, valid_from), valid_from
+
+
+class _ColumnStore:
+    """
+    定长环形缓冲区，每个指标一列 array('f')，进程信息驻留为整数 id
+    每条记录大约 56 字节，原先的 NamedTuple 嵌套大约 500+ 字节
+
+    每条记录有一个绝对序号 seq，从 base_seq 开始单调递增，淘汰旧记录不会改变它
+
+    另外维护两个二级索引，在 append 时增量更新：
+    - pid_to_seqs: 每个 pid 的记录序号（升序），前面已淘汰的部分会被惰性地截掉
+    - 时间戳按序号单调不减时，直接在环形缓冲区上二分查找
+    """
+
+    def __init__(self, capacity: int, base_seq: int = 0) -> None:
+        self.capacity = max(1, capacity)
+        self.timestamps = array("d")
+        self.kind_ids = array("I")
+        self.metrics = {field: array("f") for field in METRIC_FIELDS}
+        self.kinds: List[ProcessKind] = []
+        self.kind_to_id: Dict[ProcessKind, int] = {}
+        self.base_seq = base_seq
+        self.start_seq = base_seq
+        self.next_seq = base_seq
+        # 最近一次开始写入的序号，写完也不清除：读者只读这一个属性，不会与写入交错
+        self.writing_seq = base_seq - 1
+        self.pid_to_seqs: Dict[int, array] = {}
+        # pid_to_seqs 中每个 pid 第一个可能仍然有效的下标
+        self.pid_to_head: Dict[int, int] = {}
+        # 时钟回拨或载入乱序数据时，时间戳不再有序，只能退回线性扫描
+        self.timestamps_sorted = True
+        self.last_timestamp = None
+
+    @property
+    def size(self) -> int:
+        return self.next_seq - self.start_seq
+
+    def intern(self, kind: ProcessKind) -> int:
+        kind_id = self.kind_to_id.get(kind)
+        if kind_id is None:
+            kind_id = len(self.kinds)
+            self.kinds.append(kind)
+            self.kind_to_id[kind] = kind_id
+        return kind_id
+
+    def append(self, timestamp_seconds: float, kind_id: int, values: Tuple) -> None:
+        if self.last_timestamp is not None and timestamp_seconds < self.last_timestamp:
+            self.timestamps_sorted = False
+        self.last_timestamp = timestamp_seconds
+        seq = self.next_seq
+        # 先登记再写入，读者据此排除正在被覆盖的那一条
+        self.writing_seq = seq
+
+        if len(self.timestamps) < self.capacity:
+            self.timestamps.append(timestamp_seconds)
+            self.kind_ids.append(kind_id)
+            for field, value in zip(METRIC_FIELDS, values):
+                self.metrics[field].append(value)
+        else:
+            # 缓冲区已满，覆盖最旧的一条，O(1)
+            slot = self.slot_of(self.next_seq)
+            self.timestamps[slot] = timestamp_seconds
+            self.kind_ids[slot] = kind_id
+            for field, value in zip(METRIC_FIELDS, values):
+                self.metrics[field][slot] = value
+            self.start_seq += 1
+        self.next_seq += 1
+        # 写完之后才加入索引，读者按索引拿到的序号对应的总是完整的记录
+        self._index_pid(self.kinds[kind_id].pid, seq)
+
+    def extend(
+        self, timestamps: array, kind_ids: array, metrics: Dict[str, array]
+    ) -> None:
+        """
+        批量追加，用于载入历史；缓冲区还有空位的部分直接 array.extend，其余逐条追加
+        """
+        count = len(timestamps)
+        bulk = min(max(0, self.capacity - len(self.timestamps)), count)
+        if bulk > 0:
+            head = timestamps[:bulk]
+            if self.last_timestamp is not None and head[0] < self.last_timestamp:
+                self.timestamps_sorted = False
+            if self.timestamps_sorted and any(b < a for a, b in zip(head, head[1:])):
+                self.timestamps_sorted = False
+            self.last_timestamp = head[-1]
+
+            self.timestamps.extend(head)
+            self.kind_ids.extend(kind_ids[:bulk])
+            for field in METRIC_FIELDS:
+                self.metrics[field].extend(metrics[field][:bulk])
+
+            self.writing_seq = self.next_seq + bulk - 1
+            kind_pids = [kind.pid for kind in self.kinds]
+            for offset, kind_id in enumerate(kind_ids[:bulk]):
+                self._index_pid(kind_pids[kind_id], self.next_seq + offset)
+            self.next_seq += bulk
+
+        for i in range(bulk, count):
+            self.append(
+                timestamps[i],
+                kind_ids[i],
+                tuple(metrics[field][i] for field in METRIC_FIELDS),
+            )
+
+    def _index_pid(self, pid: int, seq: int) -> None:
+        seqs = self.pid_to_seqs.get(pid)
+        if seqs is None:
+            seqs = self.pid_to_seqs[pid] = array("q")
+            self.pid_to_head[pid] = 0
+        seqs.append(seq)
+        if len(seqs) % 1024 != 0:
+            return
+        # 已淘汰的前缀超过一半时才真正删除，均摊 O(1)
+        # 换成新的数组而不是原地删除，正在读旧数组的请求不受影响
+        head = bisect_left(seqs, self.start_seq, lo=self.pid_to_head[pid])
+        if head > 1024 and head * 2 > len(seqs):
+            self.pid_to_seqs[pid] = seqs[head:]
+            head = 0
+        self.pid_to_head[pid] = head
+
+    def rebase(self, base_seq: int) -> None:
+        """
+        整体平移序号，使第一条记录的序号为 base_seq；只用于还没有替换上去的新存储
+        """
+        delta = base_seq - self.base_seq
+        if delta == 0:
+            return
+        # 三者一起平移，slot_of 算出的位置不变
+        self.base_seq += delta
+        self.start_seq += delta
+        self.next_seq += delta
+        self.writing_seq += delta
+        for pid, seqs in self.pid_to_seqs.items():
+            self.pid_to_seqs[pid] = array("q", map(add, seqs, repeat(delta)))
+
+    def slot_of(self, seq: int) -> int:
+        return (seq - self.base_seq) % self.capacity
+
+    def column_range(self, column: array, start_seq: int, end_seq: int) -> array:
+        """
+        取出 [start_seq, end_seq) 这一段，跨越环形缓冲区末尾时拼接两段切片
+        """
+        count = end_seq - start_seq
+        if count <= 0:
+            return column[:0]
+        slot = self.slot_of(start_seq)
+        if slot + count <= len(column):
+            return column[slot : slot + count]
+        return column[slot:] + column[: slot + count - len(column)]
+
+    def timestamp_of(self, seq: int) -> float:
+        return self.timestamps[(seq - self.base_seq) % self.capacity]
+
+    def pid_seqs(self, pid: int) -> Tuple[array, int]:
+        """
+        返回 pid 的序号数组，以及其中第一条未被淘汰的记录的下标
+        """
+        seqs = self.pid_to_seqs.get(pid)
+        if seqs is None:
+            return array("q"), 0
+        # pid_to_head 只由写入的线程维护，这里不回写，直接二分
+        return seqs, bisect_left(seqs, self.start_seq)
+
+    def valid_from(self) -> int:
+        """
+        读出记录之后调用：序号不小于它的记录在读取期间没有被覆盖（正在写入的那一条也算被覆盖）
+        采样线程写入时不加锁，读者读完再检查一次、丢掉被改写的部分，思路同 seqlock
+        没有正在进行的写入时等于 start_seq，不会多丢一条
+        """
+        return self.writing_seq + 1 - self.capacity
+
+    def filter_target(self, seqs, target: Optional[str]):
+        """
+        只保留属于 target 的记录；所有记录都属于同一个目标时原样返回，单目标没有额外开销
+        """
+        if target is None:
+            return seqs
+        kind_ids = {i for i, kind in enumerate(self.kinds) if kind.name == target}
+        if len(kind_ids) == len(self.kinds):
+            return seqs
+        column = self.kind_ids
+        return [seq for seq in seqs if column[self.slot_of(seq)] in kind_ids]
+
+    def select(
+        self,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        pid: Optional[int] = None,
+        target: Optional[str] = None,
+    ):
+        """
+        按时间窗口、pid 和目标筛选，返回升序的序号序列，O(log n + k)
+        """
+        return self.filter_target(self._select(start_time, end_time, pid), target)
+
+    def _select(
+        self,
+        start_time: Optional[float],
+        end_time: Optional[float],
+        pid: Optional[int],
+    ):
+        if pid is None:
+            seqs, lo, hi = range(self.start_seq, self.next_seq), 0, self.size
+        else:
+            seqs, lo = self.pid_seqs(pid)
+            hi = len(seqs)
+
+        if start_time is None and end_time is None:
+            return seqs[lo:hi]
+
+        if not self.timestamps_sorted:
+            return [
+                seq
+                for seq in seqs[lo:hi]
+                if (start_time is None or self.timestamp_of(seq) >= start_time)
+                and (end_time is None or self.timestamp_of(seq) <= end_time)
+            ]
+
+        key = self.timestamp_of
+        if start_time is not None:
+            lo = bisect_left(seqs, start_time, lo=lo, hi=hi, key=key)
+        if end_time is not None:
+            hi = bisect_right(seqs, end_time, lo=lo, hi=hi, key=key)
+        return seqs[lo:hi]
+
+    def record_at(self, slot: int) -> HistoryRecord:
+        m = self.metrics
+        return HistoryRecord(
+            timestamp_seconds=self.timestamps[slot],
+            process=self.kinds[self.kind_ids[slot]],
+            memory_utilization=MemoryUtilization(
+                system_total_memory_mb=m["system_total_memory_mb"][slot],
+                system_free_memory_mb=m["system_free_memory_mb"][slot],
+                taskmgr_mb=m["taskmgr_mb"][slot],
+                uss_mb=m["uss_mb"][slot],
+                rss_mb=m["rss_mb"][slot],
+                vms_mb=m["vms_mb"][slot],
+                wset_mb=m["wset_mb"][slot],
+                pwset_mb=m["pwset_mb"][slot],
+                vsize=m["vsize"][slot],
+            ),
+            cpu_percent=m["cpu_percent"][slot],
+            gpu_percent=m["gpu_percent"][slot],
+        )
+
+    def ordered_columns(self) -> Tuple[array, array, Dict[str, array]]:
+        """
+        按序号从旧到新取出时间戳、种类和各指标列
+        """
+        start, end = self.start_seq, self.next_seq
+        return (
+            self.column_range(self.timestamps, start, end),
+            self.column_range(self.kind_ids, start, end),
+            {
+                field: self.column_range(column, start, end)
+                for field, column in self.metrics.items()
+            },
+        )
+
+    def iter_slots(self, since_seq: int = 0) -> Iterator[int]:
+        for seq in range(max(since_seq, self.start_seq), self.next_seq):
+            yield self.slot_of(seq)
+
+
 class History:
-    def __init__(self, history_upperbound: int) -> None:
-        self.records: List[HistoryRecord] = []
+    def __init__(
+        self, history_upperbound: int, base_seq: int = 0, rollup_tiers=None
+    ) -> None:
+        from .rollup import Rollups
+
         self.history_upperbound = history_upperbound
         self.version = 0
+        self._store = _ColumnStore(history_upperbound, base_seq)
+        # 多级汇总，保留时长与 history_upperbound 无关，见 core/rollup.py
+        self.rollups = Rollups(rollup_tiers)
+        # 采样线程写入与替换存储互斥，替换时才能确定新存储从哪个序号开始
+        self.swap_lock = Lock()
+
+    def __len__(self) -> int:
+        return self._store.size
+
+    @property
+    def first_sequence(self) -> int:
+        """
+        目前保留的最旧一条记录的序号
+        """
+        return self._store.start_seq
+
+    @property
+    def next_sequence(self) -> int:
+        """
+        下一条记录将获得的序号，也就是目前为止写入过的记录总数
+        """
+        return self._store.next_seq
+
+    @property
+    def timestamps_sorted(self) -> bool:
+        """
+        时间戳是否按序号单调不减；时钟回拨或载入乱序的数据后为 False
+        """
+        return self._store.timestamps_sorted
+
+    def get_time_range(self) -> Optional[Tuple[float, float]]:
+        """
+        目前保留的最旧、最新一条记录的时间戳，没有记录时为 None
+        """
+        store = self._store
+        if store.size == 0:
+            return None
+        return store.timestamp_of(store.start_seq), store.timestamp_of(
+            store.next_seq - 1
+        )
 
     def add_record(
         self,
@@ -73,44 +537,276 @@ class History:
         cpu_percent: float,
         memory_utilization: MemoryUtilization,
         gpu_percent: float,
-    ) -> None:
-        self.records.append(
-            HistoryRecord(
-                int(time.time()),
-                process,
-                memory_utilization,
-                cpu_percent,
-                gpu_percent,
-            )
+        timestamp_seconds: Optional[float] = None,
+    ) -> HistoryRecord:
+        record = HistoryRecord(
+            round(time.time(), 3) if timestamp_seconds is None else timestamp_seconds,
+            process,
+            memory_utilization,
+            cpu_percent,
+            gpu_percent,
         )
+        self._append_record(record)
+        return record
 
-        if len(self.records) > self.history_upperbound:
-            self.records = self.records[-self.history_upperbound :]
+    def _append_record(self, record: HistoryRecord) -> None:
+        values = record.metric_values()
+        with self.swap_lock:
+            store = self._store
+            store.append(record.timestamp_seconds, store.intern(record.process), values)
+            self.rollups.add(record.timestamp_seconds, record.process, values)
 
     def get_all(
         self, time_window=None, pid: Optional[int] = None
     ) -> List[HistoryRecord]:
-        return [
-            r
-            for r in self.records
-            if r.timestamp_seconds >= time_window.start
-            and r.timestamp_seconds <= time_window.end
-            and (pid is None or r.process.pid == pid)
-        ]
+        store = self._store
+        seqs = store.select(
+            start_time=time_window.start if time_window is not None else None,
+            end_time=time_window.end if time_window is not None else None,
+            pid=pid,
+        )
+        return self._read_records(store, seqs)
+
+    @staticmethod
+    def _read_records(store: _ColumnStore, seqs) -> List[HistoryRecord]:
+        records = [store.record_at(store.slot_of(seq)) for seq in seqs]
+        dropped, _ = _overwritten(store, seqs)
+        return records[dropped:] if dropped > 0 else records
 
     def get_latest(self, count: int, pid: Optional[int] = None) -> List[HistoryRecord]:
-        records = (
-            self.records
-            if pid is None
-            else [r for r in self.records if r.process.pid == pid]
-        )
-        return records[-count:]
+        store = self._store
+        if pid is None:
+            return self.get_offset(store.next_seq - count)
+        seqs, head = store.pid_seqs(pid)
+        tail = seqs[max(head, len(seqs) - count) :]
+        return self._read_records(store, tail)
 
     def get_offset(self, offset: int) -> List[HistoryRecord]:
-        return self.records[offset:]
+        """
+        offset 是绝对序号：返回序号 >= offset 的所有记录
+        旧记录被淘汰后，前端手上的 offset 依然指向同一条记录
+        """
+        store = self._store
+        return self._read_records(
+            store, range(max(offset, store.start_seq), store.next_seq)
+        )
+
+    def get_since(self, seq: int, target: Optional[str] = None) -> HistorySlice:
+        """
+        增量读取：返回序号 >= seq 的记录，以及下一次请求的游标
+        给出 target 时只返回该目标的记录，游标不受影响
+        """
+        store = self._store
+        first_seq, next_seq = store.start_seq, store.next_seq
+        # 游标比现存记录还新，说明对方拿的是另一份历史（例如服务端重启过）
+        gap = seq < first_seq or seq > next_seq
+        since = first_seq if seq > next_seq else max(seq, first_seq)
+        seqs = store.filter_target(range(since, next_seq), target)
+        records = [store.record_at(store.slot_of(s)) for s in seqs]
+        dropped, valid_from = _overwritten(store, seqs)
+        if dropped > 0:
+            # 读取期间最旧的几条被覆盖了，当作已经淘汰
+            records = records[dropped:]
+            first_seq, gap = valid_from, True
+        return HistorySlice(
+            records=records,
+            first_sequence=first_seq,
+            next_sequence=next_seq,
+            gap=gap,
+        )
+
+    def get_columns_since(
+        self, seq: int, target: Optional[str] = None
+    ) -> HistoryColumns:
+        """
+        列式的 get_since，供紧凑的传输格式使用
+        """
+        store = self._store
+        first_seq, next_seq = store.start_seq, store.next_seq
+        gap = seq < first_seq or seq > next_seq
+        since = first_seq if seq > next_seq else max(seq, first_seq)
+        seqs = range(since, next_seq)
+        selected = store.filter_target(seqs, target)
+        if selected is seqs:
+            kind_ids = store.column_range(store.kind_ids, since, next_seq)
+            timestamps = store.column_range(store.timestamps, since, next_seq)
+            metrics = {
+                field: store.column_range(column, since, next_seq)
+                for field, column in store.metrics.items()
+            }
+        else:
+            slots = [store.slot_of(s) for s in selected]
+            kind_ids = array("I", _gather(store.kind_ids, slots))
+            timestamps = array("d", _gather(store.timestamps, slots))
+            metrics = {
+                field: array("f", _gather(column, slots))
+                for field, column in store.metrics.items()
+            }
+        dropped, valid_from = _overwritten(store, selected)
+        if dropped > 0:
+            kind_ids = kind_ids[dropped:]
+            timestamps = timestamps[dropped:]
+            metrics = {field: column[dropped:] for field, column in metrics.items()}
+            first_seq, gap = valid_from, True
+        return HistoryColumns(
+            kinds={kind_id: store.kinds[kind_id] for kind_id in set(kind_ids)},
+            kind_ids=kind_ids,
+            timestamps=timestamps,
+            metrics=metrics,
+            first_sequence=first_seq,
+            next_sequence=next_seq,
+            gap=gap,
+        )
+
+    def get_targets(self) -> List[str]:
+        """
+        出现过的目标，按第一次出现的顺序
+        """
+        return list(dict.fromkeys(kind.name for kind in self._store.kinds))
+
+    def get_series_keys(self, target: Optional[str] = None) -> List[Tuple[int, str]]:
+        """
+        目前保留的记录中出现过的 (pid, 目标)
+        多目标时总值（pid 0）等汇总行每个目标各有一份，按 pid 分组会把它们混在一起
+        """
+        pids = set(self.get_pids())
+        keys = {
+            (kind.pid, kind.name)
+            for kind in self._store.kinds
+            if kind.pid in pids and (target is None or kind.name == target)
+        }
+        return sorted(keys)
+
+    def get_pids(self) -> List[int]:
+        """
+        目前保留的记录中出现过的 pid
+        """
+        store = self._store
+        ret = []
+        for pid in list(store.pid_to_seqs.keys()):
+            seqs, head = store.pid_seqs(pid)
+            if head < len(seqs):
+                ret.append(pid)
+        return ret
+
+    def get_series(
+        self,
+        pid: int,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        target: Optional[str] = None,
+    ) -> HistoryColumns:
+        """
+        单个 pid 在时间窗口内的全部记录，按列返回；给出 target 时只取该目标的记录
+        """
+        store = self._store
+        next_seq = store.next_seq
+        seqs = store.select(
+            start_time=start_time, end_time=end_time, pid=pid, target=target
+        )
+        slots = [store.slot_of(seq) for seq in seqs]
+        kind_ids = array("I", _gather(store.kind_ids, slots))
+        timestamps = array("d", _gather(store.timestamps, slots))
+        metrics = {
+            field: array("f", _gather(column, slots))
+            for field, column in store.metrics.items()
+        }
+        dropped, _ = _overwritten(store, seqs)
+        if dropped > 0:
+            kind_ids = kind_ids[dropped:]
+            timestamps = timestamps[dropped:]
+            metrics = {field: column[dropped:] for field, column in metrics.items()}
+        return HistoryColumns(
+            kinds={kind_id: store.kinds[kind_id] for kind_id in set(kind_ids)},
+            kind_ids=kind_ids,
+            timestamps=timestamps,
+            metrics=metrics,
+            first_sequence=store.start_seq,
+            next_sequence=next_seq,
+            gap=False,
+        )
+
+    def iter_record_chunks(
+        self,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        pid: Optional[int] = None,
+        label: Optional[str] = None,
+        target: Optional[str] = None,
+        chunk_rows: int = 4096,
+    ) -> Iterator[List[HistoryRecord]]:
+        """
+        分块导出，每次只物化 chunk_rows 条记录
+        导出的是开始时已有的记录，之后追加的不会出现；
+        导出期间被环形缓冲区覆盖的最旧的若干条会被跳过，而不是输出被改写过的数据
+        """
+        store = self._store
+        seqs = store.select(
+            start_time=start_time, end_time=end_time, pid=pid, target=target
+        )
+        for i in range(0, len(seqs), chunk_rows):
+            chunk = seqs[i : i + chunk_rows]
+            records = self._read_records(store, chunk)
+            if label is not None:
+                records = [r for r in records if r.process.label == label]
+            if len(records) > 0:
+                yield records
+
+    def new_store(self) -> _ColumnStore:
+        # 新的存储接着现有的序号继续编号，而不是从 0 重新开始
+        # 填充期间采样线程仍在写旧的存储，replace_store 时还会再对齐一次
+        return _ColumnStore(self.history_upperbound, self._store.next_seq)
+
+    def replace_store(self, store: _ColumnStore, rollups=None) -> None:
+        """
+        没有给出 rollups 时由 store 中的记录重新汇总
+        """
+        if rollups is None:
+            rollups = self.rollups.new()
+            timestamps, kind_ids, metrics = store.ordered_columns()
+            rollups.extend(timestamps, kind_ids, store.kinds, metrics)
+        with self.swap_lock:
+            # 此刻旧存储的 next_seq 不会再变，新存储从这里接着编号，序号不会重复或倒退
+            store.rebase(self._store.next_seq)
+            self._store = store
+            self.rollups = rollups
+            self.upgrade()
+
+    def get_rollup(
+        self,
+        seconds: int,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        pid: Optional[int] = None,
+        target: Optional[str] = None,
+    ):
+        return self.rollups.get(seconds, start_time, end_time, pid, target)
+
+    def clear(self) -> None:
+        self.replace_store(self.new_store(), self.rollups.new())
+
+    def iter_csv(self, **filters) -> Iterator[str]:
+        """
+        逐块生成 CSV 文本（含表头），参数同 iter_record_chunks
+        """
+        yield ",".join(CSV_COLUMNS) + "\n"
+        # 与 HistoryRecord.serialize 输出相同，但进程信息只格式化一次
+        kind_to_text: Dict[ProcessKind, str] = {}
+        for records in self.iter_record_chunks(**filters):
+            lines = []
+            for record in records:
+                kind_text = kind_to_text.get(record.process)
+                if kind_text is None:
+                    kind_text = kind_to_text[record.process] = ",".join(
+                        map(_format_value, record.process)
+                    )
+                metrics = ",".join(map(_format_value, record.metric_values()))
+                timestamp = _format_timestamp(record.timestamp_seconds)
+                lines.append(f"{timestamp},{kind_text},{metrics}")
+            yield "\n".join(lines) + "\n"
 
     def serialize(self, last_count: Optional[int] = None) -> str:
-        records = self.get_latest(last_count) if last_count else self.records
+        records = self.get_latest(last_count) if last_count else self.get_offset(0)
         if len(records) == 0:
             return ""
         header: str = ",".join(map(str, records[0].to_dict().keys()))
@@ -118,33 +814,126 @@ class History:
         return header + "\n" + data
 
     @staticmethod
-    def parse(s: Optional[str], history_upperbound: int) -> "History":
-        ret = History(history_upperbound)
+    def parse(
+        s: Optional[str], history_upperbound: int, base_seq: int = 0
+    ) -> "History":
+        ret = History(history_upperbound, base_seq)
         if not s or s == "":
             return ret
-        lines = s.split("\n")[1:]
-        records = []
-        for line in lines:
-            try:
-                records.append(HistoryRecord.parse(line))
-            except:
-                pass
-        ret.records = records
+        ret.load_stream(io.StringIO(s), history_upperbound)
         return ret
 
-    def parse_and_load(self, s: str, history_upperbound: int) -> None:
+    def load_stream(
+        self, lines: Iterable[str], history_upperbound: int, max_errors: int = 100
+    ) -> LoadReport:
+        """
+        逐行解析 CSV 并替换当前的记录，就地修改当前对象；没有任何一行能解析时不替换
+        lines 可以是打开的文件或任何逐行产生字符串的迭代器，不会一次读进内存；
+        先写入新的存储，全部读完才替换，载入过程中查询看到的仍是旧数据
+        有表头时按列名取值，没有表头时按 CSV_COLUMNS 的顺序
+        """
+        self.history_upperbound = history_upperbound
+        store = self.new_store()
+        rollups = self.rollups.new()
+        reader = csv.reader(lines)
+        indices = None
+        loaded = 0
+        failed = 0
+        errors: List[Tuple[int, str]] = []
+        # 攒一批再写入，存储和汇总都按列批量追加
+        timestamps = array("d")
+        kind_ids = array("I")
+        rows: List[Tuple] = []
+        # 进程信息的三列原文 -> 存储中的种类 id，同一个进程只解析一次
+        text_to_kind_id: Dict[Tuple[str, str, str], int] = {}
+        for row in reader:
+            if len(row) == 0:
+                continue
+            if indices is None:
+                header = row[0] == CSV_COLUMNS[0]
+                indices = (
+                    _csv_column_indices(row)
+                    if header
+                    else list(range(len(CSV_COLUMNS)))
+                )
+                # 进程信息和指标列各自一次取出，指标在 C 里逐个转换
+                kind_getter = itemgetter(*indices[1:4])
+                metric_getter = itemgetter(*indices[4:])
+                if header:
+                    continue
+            try:
+                timestamp_seconds = _parse_timestamp(row[indices[0]])
+                kind_text = kind_getter(row)
+                kind_id = text_to_kind_id.get(kind_text)
+                if kind_id is None:
+                    pid, name, label = kind_text
+                    kind = ProcessKind(pid=int(pid), name=name, label=label)
+                values = tuple(map(float, metric_getter(row)))
+            except (ValueError, IndexError, OverflowError):
+                failed += 1
+                if len(errors) < max_errors:
+                    errors.append((reader.line_num, _row_error(row, indices)))
+                continue
+            if kind_id is None:
+                # 整行都解析成功才驻留，解析失败的行不会留下种类
+                kind_id = text_to_kind_id[kind_text] = store.intern(kind)
+            timestamps.append(timestamp_seconds)
+            kind_ids.append(kind_id)
+            rows.append(values)
+            loaded += 1
+            if len(rows) >= LOAD_CHUNK_ROWS:
+                self._load_chunk(store, rollups, timestamps, kind_ids, rows)
+                timestamps, kind_ids, rows = array("d"), array("I"), []
+        self._load_chunk(store, rollups, timestamps, kind_ids, rows)
+        # 一行都没有载入（例如传入的根本不是历史文件）时保留现有的记录
+        if loaded > 0:
+            self.replace_store(store, rollups)
+        return LoadReport(loaded=loaded, failed=failed, errors=errors)
+
+    @staticmethod
+    def _load_chunk(
+        store: _ColumnStore,
+        rollups,
+        timestamps: array,
+        kind_ids: array,
+        rows: List[Tuple],
+    ) -> None:
+        if len(rows) == 0:
+            return
+        columns = dict(zip(METRIC_FIELDS, zip(*rows)))
+        store.extend(
+            timestamps,
+            kind_ids,
+            {field: array("f", column) for field, column in columns.items()},
+        )
+        # 汇总覆盖文件中的全部记录，即使原始记录超出了 history_upperbound；
+        # 与实时采样一样用未转成 float32 的原值
+        rollups.extend(timestamps, kind_ids, store.kinds, columns)
+
+    def parse_and_load(self, s: str, history_upperbound: int) -> LoadReport:
         """
         与parse返回新对象不同，parse_and_load就地修改当前对象
         """
-        history = History.parse(s, history_upperbound)
-        self.records = history.records
+        return self.load_stream(io.StringIO(s), history_upperbound)
 
-    def parse_file_and_load(self, path: str, history_upperbound: int) -> None:
+    def parse_file_and_load(self, path: str, history_upperbound: int) -> LoadReport:
         """
         与parse返回新对象不同，parse_file_and_load就地修改当前对象
+        支持 CSV、轮转后压缩的 .csv.gz 和分段文件
         """
-        with open(path, "r", encoding="utf-8") as f:
-            self.parse_and_load(f.read(), history_upperbound)
+        from .segment import is_segment_file, load_segments
+
+        if is_segment_file(path):
+            self.history_upperbound = history_upperbound
+            loaded = load_segments(self, [path])
+            return LoadReport(loaded=loaded, failed=0, errors=[])
+        with open(path, "rb") as f:
+            compressed = f.read(2) == b"\x1f\x8b"
+        if compressed:
+            with gzip.open(path, "rt", encoding="utf-8", newline="") as f:
+                return self.load_stream(f, history_upperbound)
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            return self.load_stream(f, history_upperbound)
 
     def upgrade(self):
         self.version += 1
@@ -153,11 +942,11 @@ class History:
         """
         不存在会创建
         """
-        records = self.get_latest(last_count) if last_count else self.records
+        records = self.get_latest(last_count) if last_count else self.get_offset(0)
         with open(path, "a", encoding="utf-8") as f:
             for record in records:
                 row = record.to_dict()
                 if f.tell() == 0:
                     f.write(",".join(row.keys()) + "\n")
-                row_str = ",".join([str(row[key]) for key in row])
+                row_str = ",".join([_format_value(row[key]) for key in row])
                 f.write(row_str + "\n")
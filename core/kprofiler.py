@@ -1,9 +1,11 @@
 from helpers.config import Config
-from helpers.process_utils import ProcessUtils
+from helpers.process_tracker import ProcessTracker
 from core.kprofiler_worker import KProfilerWorker
 from core.process_map import ProcessMap
 from core.history import History
+from core.broadcaster import SampleBroadcaster
 from psutil import Process
+from threading import Lock
 from typing import List, Tuple, NamedTuple
 
 
@@ -22,11 +24,18 @@ class KProfiler:
         self.config = config
         self.process_map = ProcessMap([], self.config)
         self.subscribers = []
+        self.reload_lock = Lock()
+        self.broadcaster = SampleBroadcaster()
+        self.process_tracker = ProcessTracker(
+            self.config.targets, follow_children=self.config.follow_children
+        )
         self.reload_processes(skip_optimization=True)
         self.worker = KProfilerWorker(
             process_map=self.process_map,
             config=self.config,
             history=self.history,
+            broadcaster=self.broadcaster,
+            reload_processes=self.reload_processes,
         )
 
     def subscribe_to_process_change(self, callback) -> None:
@@ -37,16 +46,21 @@ class KProfiler:
             subscriber()
 
     def reload_processes(self, skip_optimization: bool = False) -> None:
+        # 采样线程每个周期都会调用
+        with self.reload_lock:
+            self._reload_processes(skip_optimization)
+
+    def _reload_processes(self, skip_optimization: bool) -> None:
         diff = self._diff_processes(
             current=self.process_map.processes,
-            next_state=self.list_processes(self.config.target),
+            next_state=self.list_processes(),
         )
         if not skip_optimization:
             if not diff.any_change:
                 # 进程列表未发生变化，无需重新加载
                 return
         self.processes = diff.current_processes
-        self.process_map.update_processes(self.processes)
+        self.process_map.update_processes(self.processes, self.process_tracker.targets)
         self.trigger_subscribers()
 
     def start(self) -> None:
@@ -58,8 +72,9 @@ class KProfiler:
     def wait_all(self) -> None:
         self.worker.wait_all()
 
-    def list_processes(self, target: str) -> List[Process]:
-        return ProcessUtils.get_processes_by_name(target)
+    def list_processes(self) -> List[Process]:
+        # 所有目标共用一次扫描
+        return self.process_tracker.scan()
 
     @staticmethod
     def _diff_processes(
@@ -69,26 +84,22 @@ class KProfiler:
         增量地获得进程列表，从而尽量不销毁现有对象
         返回值的第二个元素表示是否有新的进程加入
         """
-        new_processes = []
-        disappeared_processes = []
-        any_new = False
-        any_disappeared = False
-
-        present_pids = [process.pid for process in current]
-        may_contain_new_pids = [process.pid for process in next_state]
+        key_of = ProcessTracker.key_of
+        current_by_key = {key_of(process): process for process in current}
+        next_by_key = {key_of(process): process for process in next_state}
 
-        for process in next_state:
-            if process.pid not in present_pids:
-                new_processes.append(process)
-                any_new = True
-
-        for process in current:
-            if process.pid not in may_contain_new_pids:
-                disappeared_processes.append(process)
-                any_disappeared = True
+        new_processes = [
+            process for key, process in next_by_key.items() if key not in current_by_key
+        ]
+        disappeared_processes = [
+            process for key, process in current_by_key.items() if key not in next_by_key
+        ]
+        any_new = len(new_processes) > 0
+        any_disappeared = len(disappeared_processes) > 0
 
+        # 尽量保留现有的 Process 对象，psutil 在对象上缓存了 CPU 时间等状态
         current_processes = new_processes + [
-            process for process in current if process not in disappeared_processes
+            process for key, process in current_by_key.items() if key in next_by_key
         ]
 
         return ProcessDiff(
@@ -1,34 +1,53 @@
-from .process_map import ProcessMap
-from .history import History, ProcessKind
+from .process_map import ProcessMap, ProcessSnapshot
+from .history import History, HistoryRecord, ProcessKind
+from .broadcaster import SampleBroadcaster, SampleBatch
+from .sampler import IntervalController, Sampler, MetricSnapshot
+from .segment import SegmentLogWriter
 from helpers.config import Config
 from helpers.memory_helper import CPUHelper, MemoryUtilization
 from helpers.performance_counter import PerformanceCounter
-from threading import Thread
-from typing import List, Dict
+from helpers.log_writer import CsvLogWriter
+from threading import Event, Thread
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
 import psutil
 import time
 
 
+class ProfileSnapshot(NamedTuple):
+    """
+    采样线程每个周期发布一份，发布之后不再修改
+    接口只需取 worker.snapshot 的引用，不用加锁，也不会读到采样线程改了一半的状态
+    """
+
+    tick: int
+    metrics: MetricSnapshot
+    processes: ProcessSnapshot
+    # IntervalController.stats() 在本周期的值
+    sampling: Dict[str, Any]
+    history_cursor: int
+    history_version: int
+
+
 class KProfilerWorker:
     def __init__(
         self,
         process_map: ProcessMap,
         config: Config,
         history: History,
+        broadcaster: SampleBroadcaster,
+        reload_processes: Optional[Callable[[], None]] = None,
     ):
         self.config = config
         self.process_map = process_map
         self.history = history
-        self.cpu_helper = CPUHelper()
+        self.broadcaster = broadcaster
+        self.reload_processes = reload_processes
+        self.cpu_helper = CPUHelper(
+            uss_source=config.uss_source,
+            uss_duration_millis=config.uss_duration_millis,
+        )
         self.should_stop = False
-        self.cpu_thread = None
-        self.gpu_thread = None
-        self.memory_thread = None
         self.worker_thread = None
-        self.pid_to_gpu_percent_cache = {}
-        self.pid_to_cpu_percent_cache = {}
-        self.pid_to_memory_mb_cache = {}
-        self.pid_to_vsize_mb_cache = {}
         self.paused = False
 
         tss_port = config.tss_port
@@ -37,146 +56,84 @@ class KProfilerWorker:
         self.performance_counter = PerformanceCounter(
             self.config.cpu_duration_millis, tss_arguments
         )
+        self.sampler = Sampler(self.performance_counter, self.cpu_helper, self.config)
+        self.interval_controller = IntervalController(self.config)
+        self.tick = 0
+        self.snapshot: Optional[ProfileSnapshot] = None
+        # 第一份快照发布后置位，用于测量启动到第一次采样的耗时
+        self.first_sample = Event()
+
+        self.log_writer: Optional[CsvLogWriter] = None
+        if self.config.write_logs:
+            rotate_mb = self.config.log_rotate_mb
+            if self.config.log_format == "segment":
+                writer_class, extension = SegmentLogWriter, "kpseg"
+            else:
+                writer_class, extension = CsvLogWriter, "csv"
+            self.log_writer = writer_class(
+                f"history-{self.config.targets_name}.{extension}",
+                flush_interval_millis=self.config.log_flush_millis,
+                rotate_bytes=rotate_mb * 1024 * 1024 if rotate_mb else None,
+            )
 
     def start(self) -> None:
+        if self.log_writer is not None:
+            self.log_writer.start()
+
         worker = self._make_worker()
         self.worker_thread = Thread(target=worker, daemon=True)
         self.worker_thread.start()
 
-        cpu_worker = self._make_cpu_worker()
-        self.cpu_thread = Thread(target=cpu_worker, daemon=True)
-        self.cpu_thread.start()
-
-        memory_worker = self._make_memory_worker()
-        self.memory_thread = Thread(target=memory_worker, daemon=True)
-        self.memory_thread.start()
-
-        vsize_worker = self._make_vsize_worker()
-        self.vsize_thread = Thread(target=vsize_worker, daemon=True)
-        self.vsize_thread.start()
-
-        if not self.config.disable_gpu:
-            gpu_worker = self._make_gpu_worker()
-            self.gpu_thread = Thread(target=gpu_worker, daemon=True)
-            self.gpu_thread.start()
-
     def wait_all(self) -> None:
         self.worker_thread.join()
 
     def notify_stop(self) -> None:
         self.should_stop = True
+        if self.log_writer is not None:
+            self.log_writer.close()
 
     def set_process_map(self, process_map: ProcessMap) -> None:
         self.process_map = process_map
 
-    """
-    TODO: 这块的缓存写的太乱了！
-    """
-
-    def _make_worker_routine(self, duration_millis: int, proc):
+    def _make_worker_routine(self, proc):
         def _routine():
             while not self.should_stop:
-                start_time = time.time()
+                start_time = time.monotonic()
                 proc()
-                seconds_elapsed = time.time() - start_time
-                time.sleep(max(0.1, duration_millis / 1000.0 - seconds_elapsed))
+                seconds_elapsed = time.monotonic() - start_time
+                time.sleep(self.interval_controller.finish_tick(seconds_elapsed))
 
         return _routine
 
-    def _make_cpu_worker(self):
-        def _proc():
-            pid_to_cpu = self.performance_counter.get_pid_to_cpu_percent_map(
-                self.process_map.processes
-            )
-            for pid, cpu_percent in pid_to_cpu.items():
-                self.pid_to_cpu_percent_cache[pid] = cpu_percent
-
-        return self._make_worker_routine(self.config.cpu_duration_millis, _proc)
-
-    def _make_gpu_worker(self):
-        def _proc():
-            pid_to_gpu = self.performance_counter.get_pid_to_gpu_percent_map(
-                [p.pid for p in self.process_map.processes]
-            )
-            for pid, gpu_percent in pid_to_gpu.items():
-                self.pid_to_gpu_percent_cache[pid] = gpu_percent
-
-        return self._make_worker_routine(self.config.gpu_duration_millis, _proc)
-
-    def _make_memory_worker(self):
-        def _proc():
-            pid_to_memory = self.performance_counter.get_pid_to_memory_mb_map(
-                [p.pid for p in self.process_map.processes]
-            )
-            for pid, memory_mb in pid_to_memory.items():
-                self.pid_to_memory_mb_cache[pid] = memory_mb
-
-        # 故意使用的是 CPU 的时间间隔
-        return self._make_worker_routine(self.config.cpu_duration_millis, _proc)
-
-    def _make_vsize_worker(self):
-        def _proc():
-            pid_to_vsize = self.performance_counter.get_pid_to_vsize_mb_map(
-                [p.pid for p in self.process_map.processes]
-            )
-            for pid, vsize_mb in pid_to_vsize.items():
-                self.pid_to_vsize_mb_cache[pid] = vsize_mb
-
-        return self._make_worker_routine(self.config.cpu_duration_millis, _proc)
-
     def _make_worker(self):
         def _proc():
             try:
+                if self.reload_processes is not None and self.tick > 0:
+                    # 进程扫描是增量的，每个周期都做一次，新进程不必等前端来触发
+                    # 第一个周期直接使用构造 KProfiler 时刚扫描到的列表，尽快完成第一次采样
+                    self.reload_processes()
+                # 本周期内的标签、目标都以同一份进程快照为准
+                processes = self.process_map.snapshot
+                # 无论是否暂停都照常采样，保证 CPU 增量等状态是连续的
+                metrics = self.sampler.sample(processes.processes)
+                self.interval_controller.observe(metrics)
                 if not self.paused:
-                    self._capture_profile(self.process_map.processes)
+                    self._capture_profile(metrics, processes)
+                self.tick += 1
+                self.snapshot = ProfileSnapshot(
+                    tick=self.tick,
+                    metrics=metrics,
+                    processes=processes,
+                    sampling=self.interval_controller.stats(),
+                    history_cursor=self.history.next_sequence,
+                    history_version=self.history.version,
+                )
+                if self.tick == 1:
+                    self.first_sample.set()
             except:
                 pass
 
-        return self._make_worker_routine(self.config.duration_millis, _proc)
-
-    """
-    TODO: 这块的缓存写的太乱了！
-    """
-
-    def get_pid_to_cpu_percent_map(self, pids: List[int]) -> Dict[int, float]:
-        ret = {}
-        for pid in pids:
-            if pid in self.pid_to_cpu_percent_cache:
-                ret[pid] = self.pid_to_cpu_percent_cache[pid]
-            else:
-                ret[pid] = 0
-        ret[0] = self.pid_to_cpu_percent_cache.get(0, 0)
-        return ret
-
-    def get_pid_to_gpu_percent_map(self, pids: List[int]) -> Dict[int, float]:
-        ret = {}
-        for pid in pids:
-            if pid in self.pid_to_gpu_percent_cache:
-                ret[pid] = self.pid_to_gpu_percent_cache[pid]
-            else:
-                ret[pid] = 0
-        ret[0] = self.pid_to_gpu_percent_cache.get(0, 0)
-        return ret
-
-    def get_pid_to_memory_mb_map(self, pids: List[int]) -> Dict[int, float]:
-        ret = {}
-        for pid in pids:
-            if pid in self.pid_to_memory_mb_cache:
-                ret[pid] = self.pid_to_memory_mb_cache[pid]
-            else:
-                ret[pid] = 0
-        ret[0] = self.pid_to_memory_mb_cache.get(0, 0)
-        return ret
-
-    def get_pid_to_vsize_mb_map(self, pids: List[int]) -> Dict[int, float]:
-        ret = {}
-        for pid in pids:
-            if pid in self.pid_to_vsize_mb_cache:
-                ret[pid] = self.pid_to_vsize_mb_cache[pid]
-            else:
-                ret[pid] = 0
-        ret[0] = self.pid_to_vsize_mb_cache.get(0, 0)
-        return ret
+        return self._make_worker_routine(_proc)
 
     def pause(self):
         self.paused = True
@@ -184,24 +141,82 @@ class KProfilerWorker:
     def resume(self):
         self.paused = False
 
-    def _capture_profile(self, processes: List[psutil.Process]):
-        count = len(processes)
+    def _capture_profile(self, snapshot: MetricSnapshot, processes: ProcessSnapshot):
+        # 精确到毫秒，间隔小于 1 秒的采样各有各的时间戳
+        timestamp_seconds = round(snapshot.timestamp_seconds, 3)
 
         if self.should_stop:
             return
 
-        if count == 0:
+        # 按目标分组，每个目标各自有一行总值和一行整个系统
+        target_to_processes: Dict[str, List[psutil.Process]] = {}
+        default_target = self.config.target
+        for process in snapshot.processes:
+            target = processes.get_target(process.pid) or default_target
+            target_to_processes.setdefault(target, []).append(process)
+
+        if len(target_to_processes) == 0:
             return
 
-        pids = [process.pid for process in processes]
-        pid_to_gpu_percent = self.get_pid_to_gpu_percent_map(pids)
-        pid_to_cpu_percent = self.get_pid_to_cpu_percent_map(pids)
-        pid_to_memory_mb = self.get_pid_to_memory_mb_map(pids)
-        pid_to_vsize = self.get_pid_to_vsize_mb_map(pids)
+        since = self.history.next_sequence
+        batch = []
+
+        cpu_percents_system = psutil.cpu_percent(percpu=True)
+        overall_cpu_percent_system = sum(cpu_percents_system) / len(cpu_percents_system)
+
+        for target, target_processes in target_to_processes.items():
+            self._capture_target(
+                snapshot=snapshot,
+                process_snapshot=processes,
+                target=target,
+                processes=target_processes,
+                timestamp_seconds=timestamp_seconds,
+                overall_cpu_percent_system=overall_cpu_percent_system,
+                batch=batch,
+            )
+
+        self.broadcaster.publish(
+            SampleBatch(
+                records=batch,
+                since=since,
+                cursor=self.history.next_sequence,
+                version=self.history.version,
+            )
+        )
+
+        if self.should_stop:
+            return
+
+        if self.log_writer is not None:
+            self.log_writer.submit(batch)
+
+    def _capture_target(
+        self,
+        snapshot: MetricSnapshot,
+        process_snapshot: ProcessSnapshot,
+        target: str,
+        processes: List[psutil.Process],
+        timestamp_seconds: float,
+        overall_cpu_percent_system: float,
+        batch: List[HistoryRecord],
+    ):
+        pid_to_gpu_percent = snapshot.pid_to_gpu_percent
+        pid_to_cpu_percent = snapshot.pid_to_cpu_percent
+        pid_to_memory_mb = snapshot.pid_to_memory_mb
+        pid_to_vsize = snapshot.pid_to_vsize
+
+        if len(self.config.targets) == 1:
+            # 只有一个目标时沿用计数器给出的总值（pid 0）
+            cpu_percent_total = pid_to_cpu_percent.get(0, 0)
+            gpu_percent_total = pid_to_gpu_percent.get(0, 0)
+            memory_mb_total = pid_to_memory_mb.get(0, 0)
+        else:
+            # 计数器的总值包含了所有目标，各个目标的总值由各自的进程相加
+            pids = [process.pid for process in processes]
+            cpu_percent_total = sum(pid_to_cpu_percent.get(pid, 0) for pid in pids)
+            gpu_percent_total = sum(pid_to_gpu_percent.get(pid, 0) for pid in pids)
+            memory_mb_total = sum(pid_to_memory_mb.get(pid, 0) for pid in pids)
 
-        cpu_percent_total = pid_to_cpu_percent.get(0, 0)
-        gpu_percent_total = pid_to_gpu_percent.get(0, 0)
-        memory_mb_total = pid_to_memory_mb.get(0, 0)
         system_total_memory_mb_total = 0
         system_free_memory_mb_total = 0
         uss_mb_total = 0
@@ -211,12 +226,12 @@ class KProfilerWorker:
         pwset_mb_total = 0
         vsize_mb_total = 0
 
-        cpu_percents_system = psutil.cpu_percent(percpu=True)
-        overall_cpu_percent_system = sum(cpu_percents_system) / len(cpu_percents_system)
-
         if not self.config.total_only:
             for process in processes:
-                memory_utilization = self.cpu_helper.query_process(process)
+                memory_utilization = snapshot.pid_to_memory_utilization.get(process.pid)
+                if memory_utilization is None:
+                    # 进程在采样过程中退出了
+                    continue
                 memory_utilization = MemoryUtilization(
                     system_total_memory_mb=memory_utilization.system_total_memory_mb,
                     system_free_memory_mb=memory_utilization.system_free_memory_mb,
@@ -233,8 +248,8 @@ class KProfilerWorker:
                 gpu_percent = pid_to_gpu_percent.get(process.pid, 0)
                 process_kind = ProcessKind(
                     pid=process.pid,
-                    name=self.config.target,
-                    label=self.process_map.get_label(process.pid),
+                    name=target,
+                    label=process_snapshot.get_label(process.pid),
                 )
 
                 system_total_memory_mb_total = memory_utilization.system_total_memory_mb
@@ -247,15 +262,17 @@ class KProfilerWorker:
                 pwset_mb_total += memory_utilization.pwset_mb
                 vsize_mb_total += memory_utilization.vsize
 
-                self.history.add_record(
+                record = self.history.add_record(
                     process=process_kind,
                     memory_utilization=memory_utilization,
                     cpu_percent=cpu_percent,
                     gpu_percent=gpu_percent,
+                    timestamp_seconds=timestamp_seconds,
                 )
+                batch.append(record)
 
-            self.history.add_record(
-                process=ProcessKind(pid=4, name=self.config.target, label="整个系统"),
+            record = self.history.add_record(
+                process=ProcessKind(pid=4, name=target, label="整个系统"),
                 memory_utilization=MemoryUtilization(
                     system_total_memory_mb=system_total_memory_mb_total,
                     system_free_memory_mb=system_free_memory_mb_total,
@@ -269,10 +286,12 @@ class KProfilerWorker:
                 ),
                 cpu_percent=overall_cpu_percent_system,
                 gpu_percent=0,
+                timestamp_seconds=timestamp_seconds,
             )
+            batch.append(record)
 
-        self.history.add_record(
-            process=ProcessKind(pid=0, name=self.config.target, label="总值"),
+        record = self.history.add_record(
+            process=ProcessKind(pid=0, name=target, label="总值"),
             memory_utilization=MemoryUtilization(
                 system_total_memory_mb=system_total_memory_mb_total,
                 system_free_memory_mb=system_free_memory_mb_total,
@@ -286,12 +305,6 @@ class KProfilerWorker:
             ),
             cpu_percent=cpu_percent_total,
             gpu_percent=gpu_percent_total,
+            timestamp_seconds=timestamp_seconds,
         )
-
-        if self.should_stop:
-            return
-
-        if self.config.write_logs:
-            self.history.append_to_csv(
-                f"history-{self.config.target}.csv", last_count=count
-            )
+        batch.append(record)
@@ -1,45 +1,135 @@
 from psutil import Process
-from typing import List
+from typing import Counter, Dict, List, NamedTuple, Optional, Tuple
 from helpers.config import Config
+from helpers.process_tracker import ProcessKey, ProcessTracker
+import collections
+import psutil
+
+MAIN_PROCESS_LABEL = "主进程"
+
+
+class ProcessSnapshot(NamedTuple):
+    """
+    某一时刻的进程列表和它们的标签、目标、进程名，发布之后不再修改
+    generation 每次进程列表变化时加一
+    """
+
+    generation: int
+    processes: Tuple[Process, ...]
+    pid_to_label: Dict[int, str]
+    pid_to_target: Dict[int, str]
+    pid_to_name: Dict[int, str]
+    label_counts: Counter[str]
+
+    def get_label(self, pid: int) -> str:
+        if pid == 0:
+            return "总值"
+        return self.pid_to_label.get(pid)
+
+    def get_target(self, pid: int) -> Optional[str]:
+        return self.pid_to_target.get(pid)
+
+
+EMPTY_SNAPSHOT = ProcessSnapshot(
+    generation=0,
+    processes=(),
+    pid_to_label={},
+    pid_to_target={},
+    pid_to_name={},
+    label_counts=collections.Counter(),
+)
 
 
 class ProcessMap:
+    """
+    进程的标签按 (pid, create_time) 缓存，进程列表变化时只读取新进程的 cmdline 和进程名
+    每次更新都构造一份新的 ProcessSnapshot 再整体替换 snapshot，
+    其他线程先取 snapshot 的引用再读，读到的要么全是旧的、要么全是新的，不需要加锁
+    多目标时同时记录每个进程属于哪个目标，没有给出的一律算作主目标
+    """
+
     def __init__(self, processes: List[Process], config: Config) -> None:
         self.config = config
+        self.matcher = config.label_matcher
+        # 只有更新进程列表的线程会读写
+        self.key_to_label: Dict[ProcessKey, str] = {}
+        self.key_to_name: Dict[ProcessKey, str] = {}
+        self.snapshot = EMPTY_SNAPSHOT
         self.update_processes(processes)
 
-    def update_processes(self, processes: List[Process]):
-        self.pid_to_label = {}
-        self.processes = processes
-        self.available_labels = set()
-        criteria = self.config.label_criteria
+    def _classify(self, process: Process) -> str:
+        cmdline = " ".join(process.cmdline())
+        criterion = self.matcher.match(cmdline)
+        return MAIN_PROCESS_LABEL if criterion is None else criterion.label
+
+    def update_processes(
+        self,
+        processes: List[Process],
+        targets: Optional[Dict[ProcessKey, str]] = None,
+    ):
+        key_to_label = {}
+        key_to_name = {}
+        pid_to_target = {}
+        default_target = self.config.target
+        label_counts = self.snapshot.label_counts.copy()
         for process in processes:
             try:
-                cmdline = " ".join(process.cmdline())
-            except:
+                key = ProcessTracker.key_of(process)
+            except psutil.Error:
                 continue
-            labelled = False
-            for criterion in criteria:
-                self.available_labels.add(criterion.label)
-                if criterion.keyword in cmdline:
-                    self.pid_to_label[process.pid] = criterion.label
-                    labelled = True
-                    break
-            if not labelled:
-                self.available_labels.add("主进程")
-                self.pid_to_label[process.pid] = "主进程"
+            label = self.key_to_label.get(key)
+            name = self.key_to_name.get(key)
+            if label is None:
+                try:
+                    label = self._classify(process)
+                    name = process.name()
+                except psutil.Error:
+                    # 读不到 cmdline 的进程不打标签，下次更新时再试
+                    continue
+                label_counts[label] += 1
+            key_to_label[key] = label
+            key_to_name[key] = name
+            pid_to_target[key[0]] = (
+                default_target if targets is None else targets.get(key, default_target)
+            )
+
+        for key, label in self.key_to_label.items():
+            if key not in key_to_label:
+                label_counts[label] -= 1
+                if label_counts[label] <= 0:
+                    del label_counts[label]
+
+        self.key_to_label = key_to_label
+        self.key_to_name = key_to_name
+        self.snapshot = ProcessSnapshot(
+            generation=self.snapshot.generation + 1,
+            processes=tuple(processes),
+            pid_to_label={pid: label for (pid, _), label in key_to_label.items()},
+            pid_to_target=pid_to_target,
+            pid_to_name={pid: name for (pid, _), name in key_to_name.items()},
+            label_counts=label_counts,
+        )
+
+    @property
+    def processes(self) -> Tuple[Process, ...]:
+        return self.snapshot.processes
 
     def get_label(self, pid: int) -> str:
-        if pid == 0:
-            return "总值"
-        return self.pid_to_label.get(pid)
+        return self.snapshot.get_label(pid)
+
+    def get_target(self, pid: int) -> str:
+        return self.snapshot.pid_to_target.get(pid, self.config.target)
 
     def exists(self, pid: int) -> bool:
-        return pid in self.pid_to_label
+        return pid in self.snapshot.pid_to_label
 
     @property
     def labels(self) -> List[str]:
-        return list(self.available_labels)
+        snapshot = self.snapshot
+        if len(snapshot.pid_to_label) == 0:
+            return []
+        labels = {criterion.label for criterion in self.matcher.criteria}
+        return list(labels | set(snapshot.label_counts))
 
     def count_label(self, label: str) -> int:
-        return sum([1 for l in self.pid_to_label.values() if l == label])
+        return self.snapshot.label_counts.get(label, 0)
@@ -0,0 +1,539 @@
+"""
+多级汇总：在原始记录之外，按 10 秒 / 1 分钟 / 10 分钟分桶保存每个进程每个指标的 min / max / avg / p95
+
+- 每来一条记录只把这一行追加到最细一级当前桶的缓冲里；时间进入下一个桶时才结算，
+  结算出的桶再作为一条汇总追加到下一级，一级级向上合并
+- 载入历史时用 extend 批量汇总：每个桶按种类分组一次，每组的行用 itemgetter 整体取出；
+  结算时同一级所有进程的桶一起计算，按指标整列处理
+- 最细一级的 p95 由原始值精确计算；每个桶另外保留每个指标的 32 个分位点，
+  更粗的级别合并下一级的分位点来估算 p95，是近似值
+- 每一级按自己的时长淘汰，与 history_upperbound 无关：原始记录只保留几个小时，
+  粗粒度数据可以保留几天，缩小视图和汇总统计的开销只与桶数有关
+- 进程来来去去，各级都不再引用的 (pid, 目标, 标签) 会被清理，id 不会复用
+"""
+
+from .history import ProcessKind, METRIC_FIELDS, _gather
+from helpers.rollup_tier import RollupTier, DEFAULT_ROLLUP_TIERS
+from array import array
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from itertools import chain, repeat
+from operator import getitem, itemgetter, lt, mul, truediv
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+import math
+
+STATS = ("min", "max", "avg", "p95")
+
+FIELD_COUNT = len(METRIC_FIELDS)
+
+# 每个桶为每个指标保留的分位点个数，用于向上一级合并时估算 p95
+SKETCH_POINTS = 32
+
+# 一个指标的分位点：(升序的值, 每个值代表的样本数)
+Sketch = Tuple[List[float], float]
+
+# 一个桶的结算结果：样本数，按 STATS 的顺序每个统计量一个元组（元组内按 METRIC_FIELDS 排列），
+# 以及每个指标的分位点；按统计量而不是按指标排列，合并时可以用 map 整列计算
+Summary = Tuple[int, Tuple[Tuple[float, ...], ...], List[Sketch]]
+
+# 进程种类达到这个数之后才开始检查哪些已经不再被引用
+KIND_EVICTION_MIN = 1024
+
+
+class RollupColumns(NamedTuple):
+    seconds: int
+    kinds: Dict[int, ProcessKind]
+    kind_ids: array
+    # 桶的起始时刻
+    timestamps: array
+    counts: array
+    # 指标 -> 统计量 -> 每个桶的值
+    stats: Dict[str, Dict[str, array]]
+
+
+def _rank(count: int, q: float) -> int:
+    # nearest-rank 百分位的下标
+    return max(1, math.ceil(q * count)) - 1
+
+
+@lru_cache(maxsize=1024)
+def _sketch_picker(count: int) -> itemgetter:
+    # 同样的样本数取同样的下标，各个桶的样本数通常只有几种
+    step = count / SKETCH_POINTS
+    return itemgetter(*(int((i + 0.5) * step) for i in range(SKETCH_POINTS)))
+
+
+def _sketch(ordered: List[float], weight: float) -> Sketch:
+    """
+    等间隔取 SKETCH_POINTS 个点，每个点代表同样多的样本
+    """
+    count = len(ordered)
+    if count <= SKETCH_POINTS:
+        return ordered, weight
+    return list(_sketch_picker(count)(ordered)), weight * count / SKETCH_POINTS
+
+
+def _merge_sketches(sketches: List[Sketch]) -> Tuple[float, Sketch]:
+    """
+    返回合并后的 p95 和分位点
+    """
+    weights = set(map(itemgetter(1), sketches))
+    if len(weights) == 1:
+        # 常见情况：各个子桶的点代表的样本数相同，直接按下标取
+        merged = sorted(chain.from_iterable(map(itemgetter(0), sketches)))
+        return merged[_rank(len(merged), 0.95)], _sketch(merged, weights.pop())
+
+    pairs = sorted((value, weight) for values, weight in sketches for value in values)
+    total = math.fsum(weight for _, weight in pairs)
+    step = total / SKETCH_POINTS
+    p95 = pairs[-1][0]
+    points = []
+    seen = 0.0
+    p95_target = 0.95 * total
+    next_target = step / 2
+    for value, weight in pairs:
+        seen += weight
+        if seen >= p95_target and p95_target >= 0:
+            p95 = value
+            p95_target = -1
+        while seen >= next_target and len(points) < SKETCH_POINTS:
+            points.append(value)
+            next_target += step
+    return p95, (points, step)
+
+
+def _merge_summaries(children: List[Summary]) -> Summary:
+    counts = [count for count, _, _ in children]
+    total = sum(counts)
+    # 转置之后每一项是所有子桶中同一个指标的值
+    mins, maxs, avgs, _ = (
+        zip(*(child[1][i] for child in children)) for i in range(len(STATS))
+    )
+    sketch_columns = list(zip(*(child[2] for child in children)))
+    weights = set(map(itemgetter(1), chain.from_iterable(sketch_columns)))
+    if len(weights) == 1:
+        # 常见情况：所有分位点代表的样本数相同，各个指标直接拼接排序，按下标取
+        weight = weights.pop()
+        merged = [
+            sorted(chain.from_iterable(map(itemgetter(0), sketches)))
+            for sketches in sketch_columns
+        ]
+        p95s = tuple(
+            map(getitem, merged, [_rank(len(values), 0.95) for values in merged])
+        )
+        sketches = list(map(_sketch, merged, repeat(weight)))
+    else:
+        pairs = list(map(_merge_sketches, sketch_columns))
+        p95s = tuple(map(itemgetter(0), pairs))
+        sketches = list(map(itemgetter(1), pairs))
+    stats = (
+        tuple(map(min, mins)),
+        tuple(map(max, maxs)),
+        tuple(sum(map(mul, column, counts)) / total for column in avgs),
+        p95s,
+    )
+    return total, stats, sketches
+
+
+def _summarize_rows(row_lists: List[List[Tuple]]) -> List[Summary]:
+    """
+    一次结算多个桶：外层按指标循环，同一个指标在所有桶上的计算都在 map 里完成
+    """
+    counts = list(map(len, row_lists))
+    ranks = [_rank(count, 0.95) for count in counts]
+    # transposed[g][m]：第 g 个桶第 m 个指标的全部取值
+    transposed = [list(zip(*rows)) for rows in row_lists]
+    mins, maxs, avgs, p95s, sketches = [], [], [], [], []
+    for i in range(FIELD_COUNT):
+        ordered = list(map(sorted, map(itemgetter(i), transposed)))
+        mins.append(map(itemgetter(0), ordered))
+        maxs.append(map(itemgetter(-1), ordered))
+        avgs.append(map(truediv, map(sum, ordered), counts))
+        p95s.append(map(getitem, ordered, ranks))
+        if max(counts) <= SKETCH_POINTS:
+            # 样本不多时分位点就是全部取值
+            sketches.append(zip(ordered, repeat(1.0)))
+        else:
+            sketches.append(map(_sketch, ordered, repeat(1.0)))
+    # 再转置回每个桶一份
+    stats = zip(zip(*mins), zip(*maxs), zip(*avgs), zip(*p95s))
+    return list(zip(counts, stats, zip(*sketches)))
+
+
+class _RawBucket:
+    """
+    每条记录一个元组，追加只有一次 list.append；结算时再转置成各列
+    """
+
+    __slots__ = ("rows",)
+
+    def __init__(self) -> None:
+        self.rows: List[Tuple] = []
+
+    def add(self, values: Tuple) -> None:
+        self.rows.append(values)
+
+    def extend(self, rows: Iterable[Tuple]) -> None:
+        self.rows.extend(rows)
+
+    @staticmethod
+    def summarize_all(buckets: List["_RawBucket"]) -> List[Summary]:
+        # 查询当前桶时采样线程可能正在追加，先复制一份，每一行都是完整的
+        return _summarize_rows([bucket.rows[:] for bucket in buckets])
+
+
+class _MergedBucket:
+    __slots__ = ("children",)
+
+    def __init__(self) -> None:
+        self.children: List[Summary] = []
+
+    def add(self, summary: Summary) -> None:
+        self.children.append(summary)
+
+    @staticmethod
+    def summarize_all(buckets: List["_MergedBucket"]) -> List[Summary]:
+        return [_merge_summaries(bucket.children[:]) for bucket in buckets]
+
+
+class _TierColumns:
+    """
+    已结算的桶，列存储；head 之前的已经过期
+    每个统计量一个 array，第 i 个桶占 [i * FIELD_COUNT, (i + 1) * FIELD_COUNT)，
+    按 METRIC_FIELDS 排列，追加一个桶只需要每个统计量 extend 一次
+    压缩时换成新的对象而不是原地删除，正在读取旧对象的请求不受影响
+    """
+
+    def __init__(self) -> None:
+        self.head = 0
+        self.kind_ids = array("I")
+        self.timestamps = array("q")
+        self.stats = {stat: array("f") for stat in STATS}
+        # 最后追加，读取时以它的长度为准
+        self.counts = array("I")
+
+    def append(self, kind_id: int, start: int, summary: Summary) -> None:
+        count, stats, _ = summary
+        self.kind_ids.append(kind_id)
+        self.timestamps.append(start)
+        for column, values in zip(self.stats.values(), stats):
+            column.extend(values)
+        self.counts.append(count)
+
+    def stat_column(self, stat: str, field_index: int, rows) -> array:
+        """
+        取出 rows 这些桶中某个指标的某个统计量
+        """
+        column = self.stats[stat]
+        if isinstance(rows, range):
+            first = rows.start * FIELD_COUNT + field_index
+            return column[first : rows.stop * FIELD_COUNT : FIELD_COUNT]
+        return array("f", (column[i * FIELD_COUNT + field_index] for i in rows))
+
+    def compacted(self) -> "_TierColumns":
+        ret = _TierColumns()
+        head = self.head
+        ret.kind_ids = self.kind_ids[head:]
+        ret.timestamps = self.timestamps[head:]
+        ret.stats = {
+            stat: column[head * FIELD_COUNT :] for stat, column in self.stats.items()
+        }
+        ret.counts = self.counts[head:]
+        return ret
+
+
+class _Tier:
+    def __init__(self, tier: RollupTier, raw: bool) -> None:
+        self.seconds = tier.seconds
+        self.retention_seconds = tier.retention_seconds
+        self.bucket_type = _RawBucket if raw else _MergedBucket
+        self.current_start: Optional[int] = None
+        self.open: Dict[int, object] = {}
+        self.columns = _TierColumns()
+
+    def bucket_start(self, timestamp_seconds: float) -> int:
+        # 时间戳精确到毫秒，桶的起始时刻仍是整秒
+        return int(timestamp_seconds // self.seconds) * self.seconds
+
+    def advance(self, start: int) -> List[tuple]:
+        """
+        时间进入 start 开始的桶；返回因此结算的 (kind_id, 起始时刻, Summary)
+        时间回退（载入乱序的文件、系统改时间）时并入当前桶
+        """
+        if self.current_start is None:
+            self.current_start = start
+        elif start > self.current_start:
+            closed = self.close()
+            self.current_start = start
+            return closed
+        return []
+
+    def add(self, timestamp_seconds: float, kind_id: int, item) -> List[tuple]:
+        """
+        item 为原始指标值（最细一级）或下一级结算出的 Summary
+        返回因为时间进入下一个桶而结算的 (kind_id, 起始时刻, Summary)
+        """
+        # 每条记录都会走到这里，直接计算，省一次方法调用
+        start = int(timestamp_seconds // self.seconds) * self.seconds
+        closed = self.advance(start) if start != self.current_start else []
+
+        bucket = self.open.get(kind_id)
+        if bucket is None:
+            bucket = self.bucket_type()
+            # 先放入数据再发布：partial() 在接口线程上运行，不能看到空的桶
+            bucket.add(item)
+            self.open[kind_id] = bucket
+        else:
+            bucket.add(item)
+        return closed
+
+    def _summarize_open(self) -> List[tuple]:
+        buckets = list(self.open.items())
+        start = self.current_start
+        summaries = self.bucket_type.summarize_all([bucket for _, bucket in buckets])
+        return [
+            (kind_id, start, summary)
+            for (kind_id, _), summary in zip(buckets, summaries)
+        ]
+
+    def close(self) -> List[tuple]:
+        closed = self._summarize_open()
+        self.open = {}
+        columns = self.columns
+        for kind_id, start, summary in closed:
+            columns.append(kind_id, start, summary)
+        self._evict()
+        return closed
+
+    def _evict(self) -> None:
+        columns = self.columns
+        cutoff = self.current_start - self.retention_seconds
+        columns.head = bisect_left(
+            columns.timestamps, cutoff, lo=columns.head, hi=len(columns.counts)
+        )
+        if columns.head > 4096 and columns.head * 2 > len(columns.counts):
+            self.columns = columns.compacted()
+
+    def referenced_kind_ids(self) -> set:
+        columns = self.columns
+        ids = set(columns.kind_ids[columns.head : len(columns.counts)])
+        ids.update(self.open.keys())
+        return ids
+
+    def partial(self) -> List[tuple]:
+        """
+        还没结算的桶，按目前收到的数据结算一份，不影响之后的累积
+        """
+        return self._summarize_open()
+
+
+class Rollups:
+    def __init__(self, tiers: Optional[List[RollupTier]] = None) -> None:
+        self.tier_configs = sorted(
+            tiers or DEFAULT_ROLLUP_TIERS, key=lambda tier: tier.seconds
+        )
+        self.tiers = [
+            _Tier(tier, raw=(i == 0)) for i, tier in enumerate(self.tier_configs)
+        ]
+        # id -> 种类；新增时原地加入，清理时换成新的字典，正在读取旧字典的请求不受影响
+        self.kinds: Dict[int, ProcessKind] = {}
+        self.kind_to_id: Dict[ProcessKind, int] = {}
+        self.next_kind_id = 0
+        self.evict_kinds_at = KIND_EVICTION_MIN
+
+    def new(self) -> "Rollups":
+        return Rollups(self.tier_configs)
+
+    @property
+    def resolutions(self) -> List[int]:
+        return [tier.seconds for tier in self.tiers]
+
+    def _intern(self, kind: ProcessKind) -> int:
+        kind_id = self.kind_to_id.get(kind)
+        if kind_id is None:
+            if len(self.kinds) >= self.evict_kinds_at:
+                self._evict_kinds()
+            kind_id = self.kind_to_id[kind] = self.next_kind_id
+            self.next_kind_id += 1
+            self.kinds[kind_id] = kind
+        return kind_id
+
+    def add(self, timestamp_seconds: float, kind: ProcessKind, values: Tuple) -> None:
+        closed = self.tiers[0].add(timestamp_seconds, self._intern(kind), values)
+        if closed:
+            self._propagate(1, closed)
+
+    def extend(
+        self,
+        timestamps: array,
+        kind_ids: array,
+        kinds: List[ProcessKind],
+        metrics: Dict[str, Sequence[float]],
+    ) -> None:
+        """
+        批量汇总一段记录，kind_ids 为 kinds 中的下标，结果与逐条 add 相同
+        时间戳有序时每个桶只分组一次，每组的行整体取出；乱序时退回逐条 add
+        """
+        count = len(timestamps)
+        if count == 0:
+            return
+        # 一次转置成行，之后每组只需要一次 itemgetter
+        values = list(zip(*(metrics[field] for field in METRIC_FIELDS)))
+        tier = self.tiers[0]
+        if (
+            tier.current_start is not None
+            and tier.bucket_start(timestamps[0]) < tier.current_start
+        ) or any(map(lt, timestamps[1:], timestamps)):
+            for i in range(count):
+                self.add(timestamps[i], kinds[kind_ids[i]], values[i])
+            return
+
+        lo = 0
+        while lo < count:
+            start = tier.bucket_start(timestamps[lo])
+            hi = bisect_left(timestamps, start + tier.seconds, lo=lo)
+            closed = tier.advance(start)
+            if closed:
+                self._propagate(1, closed)
+            groups: Dict[int, List[int]] = {}
+            for i in range(lo, hi):
+                groups.setdefault(kind_ids[i], []).append(i)
+            for index, rows in groups.items():
+                # 逐组驻留，紧接着放入数据：种类清理只会去掉没有被引用的种类
+                kind_id = self._intern(kinds[index])
+                bucket = tier.open.get(kind_id)
+                if bucket is None:
+                    bucket = _RawBucket()
+                    bucket.extend(_gather(values, rows))
+                    tier.open[kind_id] = bucket
+                else:
+                    bucket.extend(_gather(values, rows))
+            lo = hi
+
+    def _evict_kinds(self) -> None:
+        """
+        去掉各级都不再引用的种类；之后种类数翻倍才再检查，均摊 O(1)
+        """
+        referenced = set()
+        for tier in self.tiers:
+            referenced |= tier.referenced_kind_ids()
+        self.kinds = {
+            kind_id: kind
+            for kind_id, kind in self.kinds.items()
+            if kind_id in referenced
+        }
+        self.kind_to_id = {kind: kind_id for kind_id, kind in self.kinds.items()}
+        self.evict_kinds_at = max(KIND_EVICTION_MIN, len(self.kinds) * 2)
+
+    def _propagate(self, level: int, closed: List[tuple]) -> None:
+        """
+        把下一级结算出的桶并入第 level 级，再把因此结算的桶继续向上合并
+        """
+        if level >= len(self.tiers):
+            return
+        tier = self.tiers[level]
+        for kind_id, start, summary in closed:
+            more = tier.add(start, kind_id, summary)
+            if more:
+                self._propagate(level + 1, more)
+
+    def _partial(self, level: int) -> List[tuple]:
+        """
+        第 level 级还没结算的桶，连同更细各级还没结算、尚未并入这一级的数据一起结算一份
+        不合并的话，粗粒度的最后一个桶会缺少最细一级当前桶那部分样本
+        """
+        tier = self.tiers[level]
+        if level == 0:
+            return tier.partial()
+        # 先取这一级再取下一级：两次读取之间下一级结算时，样本最多少算，不会重复
+        current_start = tier.current_start
+        groups: Dict[Tuple[int, int], List[Summary]] = {
+            (current_start, kind_id): bucket.children[:]
+            for kind_id, bucket in list(tier.open.items())
+        }
+        for kind_id, start, summary in self._partial(level - 1):
+            start = tier.bucket_start(start)
+            if current_start is not None and start < current_start:
+                # 与 _Tier.advance 一致，时间回退的数据并入当前桶
+                start = current_start
+            groups.setdefault((start, kind_id), []).append(summary)
+        return [
+            (kind_id, start, _merge_summaries(children))
+            for (start, kind_id), children in groups.items()
+        ]
+
+    def _kind_ids(self, pid: Optional[int], target: Optional[str]) -> Optional[set]:
+        if pid is None and target is None:
+            return None
+        return {
+            kind_id
+            for kind_id, kind in list(self.kinds.items())
+            if (pid is None or kind.pid == pid)
+            and (target is None or kind.name == target)
+        }
+
+    def get(
+        self,
+        seconds: int,
+        start_time: Optional[int] = None,
+        end_time: Optional[int] = None,
+        pid: Optional[int] = None,
+        target: Optional[str] = None,
+    ) -> RollupColumns:
+        """
+        按桶的起始时刻、pid 和目标筛选；结果包含尚未结算的当前桶，
+        粗粒度的当前桶也包含更细各级还没结算的样本，与原始记录的样本数一致
+        """
+        level = next(
+            (i for i, tier in enumerate(self.tiers) if tier.seconds == seconds), None
+        )
+        if level is None:
+            raise ValueError(f"没有 {seconds} 秒粒度的汇总，可选：{self.resolutions}")
+        # 先取种类：之后读到的行引用的种类要么在这份字典里，要么是之后新增的
+        kinds = self.kinds
+        columns = self.tiers[level].columns
+        partial = self._partial(level)
+
+        lo, hi = columns.head, len(columns.counts)
+        if start_time is not None:
+            lo = bisect_left(columns.timestamps, start_time, lo=lo, hi=hi)
+        if end_time is not None:
+            hi = bisect_right(columns.timestamps, end_time, lo=lo, hi=hi)
+        rows = range(lo, hi)
+        wanted = self._kind_ids(pid, target)
+        if wanted is not None:
+            rows = [i for i in rows if columns.kind_ids[i] in wanted]
+
+        kind_ids = array("I", (columns.kind_ids[i] for i in rows))
+        timestamps = array("q", (columns.timestamps[i] for i in rows))
+        counts = array("I", (columns.counts[i] for i in rows))
+        stats = {
+            field: {stat: columns.stat_column(stat, i, rows) for stat in STATS}
+            for i, field in enumerate(METRIC_FIELDS)
+        }
+
+        for kind_id, start, (count, summary, _) in partial:
+            if start_time is not None and start < start_time:
+                continue
+            if end_time is not None and start > end_time:
+                continue
+            if wanted is not None and kind_id not in wanted:
+                continue
+            kind_ids.append(kind_id)
+            timestamps.append(start)
+            counts.append(count)
+            for stat, values in zip(STATS, summary):
+                for field, value in zip(METRIC_FIELDS, values):
+                    stats[field][stat].append(value)
+
+        return RollupColumns(
+            seconds=seconds,
+            kinds={
+                kind_id: kinds.get(kind_id) or self.kinds[kind_id]
+                for kind_id in set(kind_ids)
+            },
+            kind_ids=kind_ids,
+            timestamps=timestamps,
+            counts=counts,
+            stats=stats,
+        )
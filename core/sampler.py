@@ -0,0 +1,162 @@
+from helpers.config import Config
+from helpers.memory_helper import CPUHelper, MemoryUtilization
+from typing import Any, List, Dict, NamedTuple, Optional
+import psutil
+import time
+
+
+class MetricSnapshot(NamedTuple):
+    """
+    一次采样得到的所有指标，共用同一个时间戳
+    """
+
+    timestamp_seconds: float
+    processes: List[psutil.Process]
+    pid_to_cpu_percent: Dict[int, float]
+    pid_to_gpu_percent: Dict[int, float]
+    pid_to_memory_mb: Dict[int, float]
+    pid_to_vsize: Dict[int, float]
+    # psutil 采集的内存明细，已退出的进程不在其中；total_only 时为空
+    pid_to_memory_utilization: Dict[int, MemoryUtilization]
+    # GPU 按更低的频率采集，这里是 pid_to_gpu_percent 实际采集的时刻；从未采集过时为 None
+    gpu_sampled_at: Optional[float]
+
+    def gpu_age_millis(self) -> Optional[float]:
+        """
+        GPU 数据比本次采样旧了多少毫秒，本次刚采集的为 0；从未采集过（例如停用了 GPU）时为 None
+        """
+        if self.gpu_sampled_at is None:
+            return None
+        return (self.timestamp_seconds - self.gpu_sampled_at) * 1000
+
+
+class Sampler:
+    """
+    每个周期对所有进程只采集一遍，取代原先 cpu / memory / vsize / gpu 四个各自轮询的线程
+    """
+
+    def __init__(
+        self, performance_counter, cpu_helper: CPUHelper, config: Config
+    ) -> None:
+        self.performance_counter = performance_counter
+        self.cpu_helper = cpu_helper
+        self.config = config
+        self.pid_to_gpu_percent: Dict[int, float] = {}
+        self.gpu_sampled_at: Optional[float] = None
+
+    def _should_sample_gpu(self, now: float) -> bool:
+        if self.config.disable_gpu:
+            return False
+        if self.gpu_sampled_at is None:
+            return True
+        return now - self.gpu_sampled_at >= self.config.gpu_duration_millis / 1000.0
+
+    def sample(self, processes: List[psutil.Process]) -> MetricSnapshot:
+        now = time.time()
+        pids = [process.pid for process in processes]
+        counter = self.performance_counter
+        # 先取 CPU：Windows 计数器在这一步固定本周期用的那一份结果，其余指标随后从中读取
+        pid_to_cpu_percent = dict(counter.get_pid_to_cpu_percent_map(processes))
+
+        if self._should_sample_gpu(now):
+            self.pid_to_gpu_percent = dict(counter.get_pid_to_gpu_percent_map(pids))
+            self.gpu_sampled_at = now
+
+        return MetricSnapshot(
+            timestamp_seconds=now,
+            processes=processes,
+            # 复制一份，之后计数器线程再怎么更新也不会影响这次快照
+            pid_to_cpu_percent=pid_to_cpu_percent,
+            pid_to_gpu_percent=self.pid_to_gpu_percent,
+            pid_to_memory_mb=dict(counter.get_pid_to_memory_mb_map(pids)),
+            pid_to_vsize=dict(counter.get_pid_to_vsize_mb_map(pids)),
+            pid_to_memory_utilization=(
+                {}
+                if self.config.total_only
+                else self.cpu_helper.query_processes(processes)
+            ),
+            gpu_sampled_at=self.gpu_sampled_at,
+        )
+
+
+class IntervalController:
+    """
+    决定下一次采样的间隔，并统计超时
+
+    固定模式下间隔始终是 duration_millis；自适应模式下，总 CPU / 总内存的变化超过阈值、
+    或者 CPU 高于阈值时立即降到最短间隔，之后每次平稳的采样把间隔放大 1.5 倍，直到最长间隔
+    一次采样的耗时超过了间隔就记为一次超时，下一次采样立即开始，不补采也不额外等待
+    """
+
+    BACKOFF = 1.5
+
+    def __init__(self, config: Config) -> None:
+        self.adaptive = config.adaptive_sampling
+        self.min_millis = config.adaptive_min_millis
+        self.max_millis = config.adaptive_max_millis
+        self.cpu_delta = config.adaptive_cpu_delta
+        self.memory_delta_mb = config.adaptive_memory_delta_mb
+        self.cpu_threshold = config.adaptive_cpu_threshold
+        self.interval_millis = float(config.duration_millis)
+        self.last_cpu: Optional[float] = None
+        self.last_memory_mb: Optional[float] = None
+
+        self.samples = 0
+        self.fast_samples = 0
+        self.overruns = 0
+        self.overrun_millis_total = 0.0
+        self.last_work_millis = 0.0
+        self.max_work_millis = 0.0
+
+    def _is_active(self, cpu: float, memory_mb: float) -> bool:
+        if self.cpu_threshold is not None and cpu >= self.cpu_threshold:
+            return True
+        if self.last_cpu is None or self.last_memory_mb is None:
+            return False
+        return (
+            abs(cpu - self.last_cpu) >= self.cpu_delta
+            or abs(memory_mb - self.last_memory_mb) >= self.memory_delta_mb
+        )
+
+    def observe(self, snapshot: MetricSnapshot) -> None:
+        if not self.adaptive:
+            return
+        cpu = snapshot.pid_to_cpu_percent.get(0, 0)
+        memory_mb = snapshot.pid_to_memory_mb.get(0, 0)
+        if self._is_active(cpu, memory_mb):
+            self.interval_millis = self.min_millis
+        else:
+            self.interval_millis = min(
+                self.max_millis,
+                max(self.min_millis, self.interval_millis * self.BACKOFF),
+            )
+        self.last_cpu = cpu
+        self.last_memory_mb = memory_mb
+
+    def finish_tick(self, work_seconds: float) -> float:
+        """
+        记录本次采样的耗时，返回距离下一次采样还需要等待的秒数
+        """
+        work_millis = work_seconds * 1000
+        self.samples += 1
+        if self.interval_millis <= self.min_millis:
+            self.fast_samples += 1
+        self.last_work_millis = work_millis
+        self.max_work_millis = max(self.max_work_millis, work_millis)
+        if work_millis > self.interval_millis:
+            self.overruns += 1
+            self.overrun_millis_total += work_millis - self.interval_millis
+            return 0.0
+        return (self.interval_millis - work_millis) / 1000.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "adaptive": self.adaptive,
+            "intervalMillis": self.interval_millis,
+            "samples": self.samples,
+            "fastSamples": self.fast_samples,
+            "overruns": self.overruns,
+            "overrunMillisTotal": self.overrun_millis_total,
+            "lastWorkMillis": self.last_work_millis,
+            "maxWorkMillis": self.max_work_millis,
+        }
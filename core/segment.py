@@ -0,0 +1,382 @@
+"""
+二进制分段格式，用于长时间录制
+
+文件 = 文件头 + 若干数据块，全部小端：
+- 文件头：magic "KPSG" | 版本 u16 | 保留 u16
+- 数据块：magic "KPBK" | 行数 u32 | 字典长度 u32 | 数据长度 u32 | 字典 | 数据
+  - 字典：JSON，本块用到的进程 [[id, pid, name, label], ...]，块内 id 从 0 开始
+  - 数据：zlib 压缩的列存储：kind id u32、时间戳 f64、各指标 f32（顺序同 METRIC_FIELDS）
+    版本 1 的时间戳为整秒的 i64，仍然可以读取
+    每一列先做字节重排（所有元素的第 0 字节、第 1 字节……依次排列），
+    相邻采样的高位字节几乎相同，重排后 zlib 的压缩率会高很多
+
+每个块都自带字典，写到一半被强行结束的文件也能读出已经写完的块
+"""
+
+from .history import History, HistoryRecord, ProcessKind, METRIC_FIELDS
+from helpers.log_writer import CsvLogWriter
+from helpers.memory_helper import MemoryUtilization
+from array import array
+from typing import Dict, Iterator, List, NamedTuple, Tuple
+import json
+import mmap
+import os
+import struct
+import sys
+import zlib
+
+FILE_MAGIC = b"KPSG"
+BLOCK_MAGIC = b"KPBK"
+VERSION = 2
+_FILE_HEADER = struct.Struct("<4sHH")
+_BLOCK_HEADER = struct.Struct("<4sIII")
+_METRIC_TYPES = [(field, "f") for field in METRIC_FIELDS]
+# 各版本的列类型，写入时总用最新的版本
+_COLUMN_TYPES = {
+    1: [("kind_ids", "I"), ("timestamps", "q")] + _METRIC_TYPES,
+    2: [("kind_ids", "I"), ("timestamps", "d")] + _METRIC_TYPES,
+}
+
+
+class SegmentBlock(NamedTuple):
+    kinds: List[ProcessKind]
+    kind_ids: array
+    timestamps: array
+    metrics: Dict[str, array]
+
+    def records(self) -> Iterator[HistoryRecord]:
+        m = self.metrics
+        for i in range(len(self.timestamps)):
+            yield HistoryRecord(
+                timestamp_seconds=self.timestamps[i],
+                process=self.kinds[self.kind_ids[i]],
+                memory_utilization=MemoryUtilization(
+                    system_total_memory_mb=m["system_total_memory_mb"][i],
+                    system_free_memory_mb=m["system_free_memory_mb"][i],
+                    taskmgr_mb=m["taskmgr_mb"][i],
+                    uss_mb=m["uss_mb"][i],
+                    rss_mb=m["rss_mb"][i],
+                    vms_mb=m["vms_mb"][i],
+                    wset_mb=m["wset_mb"][i],
+                    pwset_mb=m["pwset_mb"][i],
+                    vsize=m["vsize"][i],
+                ),
+                cpu_percent=m["cpu_percent"][i],
+                gpu_percent=m["gpu_percent"][i],
+            )
+
+
+def _to_le_bytes(column: array) -> bytes:
+    if sys.byteorder == "big":
+        column = array(column.typecode, column)
+        column.byteswap()
+    return column.tobytes()
+
+
+def _shuffle(data: bytes, itemsize: int) -> bytes:
+    return b"".join(data[i::itemsize] for i in range(itemsize))
+
+
+def _unshuffle(data: bytes, itemsize: int) -> bytes:
+    count = len(data) // itemsize
+    out = bytearray(len(data))
+    for i in range(itemsize):
+        out[i::itemsize] = data[i * count : (i + 1) * count]
+    return bytes(out)
+
+
+def _column_bytes(column, typecode: str) -> bytes:
+    if typecode == "q":
+        # 版本 1 的时间戳只能存整秒
+        column = map(int, column)
+    return _shuffle(_to_le_bytes(array(typecode, column)), array(typecode).itemsize)
+
+
+def encode_block(
+    kinds: List[ProcessKind],
+    kind_ids: array,
+    timestamps: array,
+    metrics: Dict[str, array],
+    version: int = VERSION,
+) -> bytes:
+    columns = {"kind_ids": kind_ids, "timestamps": timestamps, **metrics}
+    payload = zlib.compress(
+        b"".join(
+            _column_bytes(columns[name], typecode)
+            for name, typecode in _COLUMN_TYPES[version]
+        ),
+        6,
+    )
+    dictionary = json.dumps(
+        [[i, k.pid, k.name, k.label] for i, k in enumerate(kinds)], ensure_ascii=False
+    ).encode("utf-8")
+    header = _BLOCK_HEADER.pack(
+        BLOCK_MAGIC, len(timestamps), len(dictionary), len(payload)
+    )
+    return header + dictionary + payload
+
+
+class SegmentWriter:
+    """
+    攒够 block_rows 行写一个块；close 时把剩下的写掉
+    """
+
+    def __init__(self, path: str, block_rows: int = 4096) -> None:
+        self.path = path
+        self.block_rows = block_rows
+        self.file = open(path, "ab")
+        self.version = VERSION
+        if self.file.tell() == 0:
+            self.file.write(_FILE_HEADER.pack(FILE_MAGIC, VERSION, 0))
+        else:
+            try:
+                reader = SegmentReader(path)
+            except ValueError:
+                self.file.close()
+                raise
+            # 接着写以前的文件时沿用它的版本，同一个文件里的块格式一致
+            self.version = reader.version
+            valid_end = reader.valid_end
+            # 先关掉 mmap，Windows 下被映射的文件不能截断
+            reader.close()
+            if valid_end < self.file.tell():
+                # 上次写到一半被强行结束，截掉没写完的块，否则之后追加的块都读不到
+                print("截掉分段文件末尾未写完的块", path, self.file.tell() - valid_end)
+                self.file.truncate(valid_end)
+                self.file.seek(valid_end)
+        self._reset()
+
+    def _reset(self) -> None:
+        self.kinds: List[ProcessKind] = []
+        self.kind_to_id: Dict[ProcessKind, int] = {}
+        self.kind_ids = array("I")
+        self.timestamps = array("d")
+        self.metrics = {field: array("f") for field in METRIC_FIELDS}
+
+    def append(self, records: List[HistoryRecord]) -> None:
+        for record in records:
+            kind_id = self.kind_to_id.get(record.process)
+            if kind_id is None:
+                kind_id = self.kind_to_id[record.process] = len(self.kinds)
+                self.kinds.append(record.process)
+            self.kind_ids.append(kind_id)
+            self.timestamps.append(record.timestamp_seconds)
+            for field, value in zip(METRIC_FIELDS, record.metric_values()):
+                self.metrics[field].append(value)
+            if len(self.timestamps) >= self.block_rows:
+                self.flush()
+
+    def flush(self) -> None:
+        if len(self.timestamps) == 0:
+            return
+        self.file.write(
+            encode_block(
+                self.kinds,
+                self.kind_ids,
+                self.timestamps,
+                self.metrics,
+                self.version,
+            )
+        )
+        self.file.flush()
+        self._reset()
+
+    def tell(self) -> int:
+        return self.file.tell()
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
+
+
+class SegmentReader:
+    """
+    用 mmap 读取，只有真正访问某个块时才解压它
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.buffer = (
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+            )
+        if len(self.buffer) < _FILE_HEADER.size:
+            raise ValueError(f"{path} 不是 KProfiler 分段文件")
+        magic, version, _ = _FILE_HEADER.unpack_from(self.buffer, 0)
+        if magic != FILE_MAGIC or version not in _COLUMN_TYPES:
+            raise ValueError(f"{path} 不是 KProfiler 分段文件")
+        self.version = version
+        self.block_offsets, self.valid_end = self._scan_blocks()
+
+    def _scan_blocks(self) -> Tuple[List[tuple], int]:
+        """
+        返回各个完整块的 (偏移, 行数)，以及最后一个完整块的结束位置
+        """
+        offsets = []
+        offset = _FILE_HEADER.size
+        while offset + _BLOCK_HEADER.size <= len(self.buffer):
+            magic, rows, dict_len, payload_len = _BLOCK_HEADER.unpack_from(
+                self.buffer, offset
+            )
+            end = offset + _BLOCK_HEADER.size + dict_len + payload_len
+            if magic != BLOCK_MAGIC or end > len(self.buffer):
+                # 最后一个块没写完，忽略
+                break
+            offsets.append((offset, rows))
+            offset = end
+        return offsets, offset
+
+    @property
+    def total_rows(self) -> int:
+        return sum(rows for _, rows in self.block_offsets)
+
+    def read_block(self, index: int) -> SegmentBlock:
+        offset, rows = self.block_offsets[index]
+        _, _, dict_len, payload_len = _BLOCK_HEADER.unpack_from(self.buffer, offset)
+        start = offset + _BLOCK_HEADER.size
+        dictionary = json.loads(bytes(self.buffer[start : start + dict_len]))
+        payload = zlib.decompress(
+            self.buffer[start + dict_len : start + dict_len + payload_len]
+        )
+
+        columns = {}
+        position = 0
+        for name, typecode in _COLUMN_TYPES[self.version]:
+            column = array(typecode)
+            length = rows * column.itemsize
+            column.frombytes(
+                _unshuffle(payload[position : position + length], column.itemsize)
+            )
+            if sys.byteorder == "big":
+                column.byteswap()
+            columns[name] = column
+            position += length
+
+        return SegmentBlock(
+            kinds=[ProcessKind(pid, name, label) for _, pid, name, label in dictionary],
+            kind_ids=columns.pop("kind_ids"),
+            timestamps=array("d", columns.pop("timestamps")),
+            metrics=columns,
+        )
+
+    def blocks(self) -> Iterator[SegmentBlock]:
+        for index in range(len(self.block_offsets)):
+            yield self.read_block(index)
+
+    def close(self) -> None:
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+
+
+def is_segment_file(path: str) -> bool:
+    with open(path, "rb") as f:
+        return f.read(len(FILE_MAGIC)) == FILE_MAGIC
+
+
+def load_segments(history: History, paths: List[str]) -> int:
+    """
+    把若干分段文件按顺序载入 history，替换其中现有的记录，返回载入的行数
+    只解压最后 history_upperbound 行所在的块；文件中没有记录时保留现有的记录
+    """
+    readers = [SegmentReader(path) for path in paths]
+    try:
+        total = sum(reader.total_rows for reader in readers)
+        if total == 0:
+            return 0
+        skip = max(0, total - history.history_upperbound)
+        store = history.new_store()
+        # 汇总与原始记录覆盖同样的行，逐块批量汇总，不必等替换时再逐行读回来
+        rollups = history.rollups.new()
+        for reader in readers:
+            for index, (_, rows) in enumerate(reader.block_offsets):
+                if skip >= rows:
+                    skip -= rows
+                    continue
+                block = reader.read_block(index)
+                kind_map = [store.intern(kind) for kind in block.kinds]
+                timestamps = block.timestamps[skip:]
+                kind_ids = block.kind_ids[skip:]
+                metrics = {
+                    field: column[skip:] for field, column in block.metrics.items()
+                }
+                store.extend(
+                    timestamps, array("I", [kind_map[k] for k in kind_ids]), metrics
+                )
+                rollups.extend(timestamps, kind_ids, block.kinds, metrics)
+                skip = 0
+        history.replace_store(store, rollups)
+        return store.size
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def iter_segment(history: History, **filters) -> Iterator[bytes]:
+    """
+    逐块生成分段文件的内容，用于流式下载，参数同 History.iter_record_chunks
+    """
+    yield _FILE_HEADER.pack(FILE_MAGIC, VERSION, 0)
+    for records in history.iter_record_chunks(**filters):
+        kinds = list(dict.fromkeys(record.process for record in records))
+        kind_to_id = {kind: i for i, kind in enumerate(kinds)}
+        columns = zip(*(record.metric_values() for record in records))
+        yield encode_block(
+            kinds,
+            array("I", [kind_to_id[record.process] for record in records]),
+            array("d", [record.timestamp_seconds for record in records]),
+            {
+                field: array("f", column)
+                for field, column in zip(METRIC_FIELDS, columns)
+            },
+        )
+
+
+def segment_to_csv(segment_path: str, csv_path: str) -> None:
+    reader = SegmentReader(segment_path)
+    try:
+        with open(csv_path, "w", encoding="utf-8") as f:
+            header_written = False
+            for block in reader.blocks():
+                for record in block.records():
+                    if not header_written:
+                        f.write(",".join(record.to_dict().keys()) + "\n")
+                        header_written = True
+                    f.write(record.serialize() + "\n")
+    finally:
+        reader.close()
+
+
+class SegmentLogWriter(CsvLogWriter):
+    """
+    与 CsvLogWriter 相同的后台线程和队列，只是写成分段文件
+    文件超过 rotate_bytes 时另起一个新文件（已经压缩过，不再 gzip）
+    """
+
+    def _open(self) -> None:
+        self.file = SegmentWriter(self.path)
+
+    def _write(self, rows: List) -> None:
+        if len(rows) == 0:
+            return
+        if self.file is None:
+            self._open()
+        self.file.append(rows)
+        # 每次落盘都写成完整的块，进程被强行结束时最多丢失一个刷新周期的数据
+        self.file.flush()
+        if self.rotate_bytes and self.file.tell() >= self.rotate_bytes:
+            self.file.close()
+            self.file = None
+            base, ext = os.path.splitext(self.path)
+            index = 1
+            while os.path.exists(f"{base}-{index}{ext}"):
+                index += 1
+            os.replace(self.path, f"{base}-{index}{ext}")
+
+
+if __name__ == "__main__":
+    # python -m core.segment history-KOOK.exe.kpseg history-KOOK.exe.csv
+    if len(sys.argv) != 3:
+        print("用法: python -m core.segment <分段文件> <输出 csv>")
+        sys.exit(1)
+    segment_to_csv(sys.argv[1], sys.argv[2])
@@ -0,0 +1,555 @@
+"""
+服务端统计：每个进程、每个标签以及总值的 mean / min / max / stddev / p50 / p95 / p99 / slope
+
+- 标签的统计对象是同一时刻该标签下所有进程之和，例如「所有渲染进程一共占了多少内存」
+- 多目标时每个目标分开统计，各有各的总值和标签
+- slope 是指标对时间的最小二乘斜率（每秒），内存指标的斜率就是增长速度
+
+增量计算：时间轴按 BLOCK_SECONDS 分块，每条曲线在每一块上的统计量可以合并
+（样本数、各种和、最值、分位点草图），已经结束且不会再被淘汰的块算一次就缓存起来，
+每 GROUP_BLOCKS 块再合并成一组缓存；一次请求只需要重新读取首尾不完整的块和正在写入的块，
+与历史的长度几乎无关
+- 求和、平方和、交叉项都交给 sum(map(...)) 在 C 里完成，不逐个元素走 Python 循环
+- mean / min / max / stddev / slope 是精确的；p50 / p95 / p99 用到缓存的块时，
+  由各块的 SKETCH_POINTS 个分位点合并估算，名次误差在 1% 以内
+- 时间戳乱序时（时钟回拨、载入乱序的文件）不分块，整段从原始记录精确计算
+"""
+
+from .history import History, HistoryColumns, METRIC_FIELDS
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from functools import partial
+from itertools import accumulate, chain, repeat
+from operator import mul
+from threading import Lock
+from typing import Any, Dict, Hashable, List, Optional, Tuple
+import math
+
+# 不是真实进程的汇总行，不计入标签
+TOTAL_PID = 0
+SYSTEM_PID = 4
+
+PERCENTILES = (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))
+
+# 缓存的粒度：块的时长（秒），以及多少块合并成一组
+BLOCK_SECONDS = 600
+GROUP_BLOCKS = 16
+
+# 各段的点代表的样本数不同时，合并结果最多保留的点数
+MERGE_POINTS = 4096
+
+# 开始时刻与最旧的记录至少相隔这么久的块才缓存，留出一次请求期间被淘汰的余量
+EVICTION_MARGIN_SECONDS = 60
+
+# 缓存的块为每个指标保留的分位点个数
+SKETCH_POINTS = 64
+
+# 缓存的块和组的总数上限；每个约 3 KB，20 条曲线可以缓存两天多
+CACHE_CAPACITY = 8192
+
+# 一个指标的分位点：(升序的值, 每个值代表的样本数)
+# 取点后的误差约为 1 / points 的名次，与记录本身一样用单精度保存
+Sketch = Tuple[array, float]
+
+
+def _sketch(ordered: List[float], points: Optional[int]) -> Sketch:
+    """
+    等间隔取 points 个点，每个点代表同样多的样本；points 为 None 或样本更少时原样保留
+    """
+    count = len(ordered)
+    if points is None or count <= points:
+        return array("d", ordered), 1.0
+    step = count / points
+    return array("f", [ordered[int((i + 0.5) * step)] for i in range(points)]), step
+
+
+def _merge_sketches(sketches: List[Sketch], points: Optional[int]) -> Sketch:
+    """
+    合并后重新等间隔取点；points 为 None 时最多保留 MERGE_POINTS 个点
+    """
+    weights = {weight for _, weight in sketches}
+    if len(weights) == 1:
+        # 常见情况：各段的点代表的样本数相同，直接排序
+        merged = []
+        for values, _ in sketches:
+            merged.extend(values)
+        merged.sort()
+        weight = weights.pop()
+        if points is None or len(merged) <= points:
+            return array("d", merged), weight
+        values, step = _sketch(merged, points)
+        return values, weight * step
+
+    # 按值排序后累计各点代表的样本数，再在累计值上二分出等间隔的名次
+    values = []
+    weights = []
+    for sketch_values, weight in sketches:
+        values.extend(sketch_values)
+        weights.extend([weight] * len(sketch_values))
+    order = sorted(range(len(values)), key=values.__getitem__)
+    typecode = "d" if points is None else "f"
+    points = min(points or MERGE_POINTS, len(values))
+    step = sum(weights) / points
+    # 第 i 个点取累计样本数首次达到 (i + 0.5) * step 的值；全部交给 map 在 C 里完成
+    cumulative = list(accumulate(map(weights.__getitem__, order), initial=-step / 2))
+    del cumulative[0]
+    cumulative[-1] = math.inf
+    targets = map(mul, range(points), repeat(step))
+    positions = map(bisect_left, repeat(cumulative), targets)
+    ret = array(typecode, map(values.__getitem__, map(order.__getitem__, positions)))
+    return ret, step
+
+
+def _percentile(sketch: Sketch, q: float) -> float:
+    # nearest-rank：第一个累计样本数不小于 q * 总数的值
+    values, _ = sketch
+    return values[max(1, math.ceil(q * len(values))) - 1]
+
+
+class _Aggregate:
+    """
+    一条曲线在一段时间内可以合并的统计量
+    时间相关的和以 origin 为原点，避免大数相乘丢精度；合并时再平移到同一个原点
+    """
+
+    __slots__ = (
+        "count",
+        "start",
+        "end",
+        "origin",
+        "st",
+        "stt",
+        "sx",
+        "sxx",
+        "stx",
+        "mins",
+        "maxs",
+        "sketches",
+        "label",
+        "pids",
+        "block_labels",
+    )
+
+    @staticmethod
+    def of(
+        timestamps: array,
+        metrics: Dict[str, array],
+        label: str,
+        pids: frozenset,
+        block: Any,
+        points: Optional[int],
+    ) -> "_Aggregate":
+        """
+        block 为所在块的开始时刻；points 为 None 时保留全部的值，分位数是精确的
+        """
+        ret = _Aggregate()
+        origin = timestamps[0]
+        times = [t - origin for t in timestamps]
+        ret.count = len(timestamps)
+        ret.start, ret.end, ret.origin = timestamps[0], timestamps[-1], origin
+        ret.st = math.fsum(times)
+        ret.stt = sum(map(mul, times, times))
+        ret.sx, ret.sxx, ret.stx = [], [], []
+        ret.mins, ret.maxs, ret.sketches = [], [], []
+        for field in METRIC_FIELDS:
+            column = metrics[field]
+            ordered = sorted(column)
+            ret.sx.append(math.fsum(column))
+            ret.sxx.append(sum(map(mul, column, column)))
+            ret.stx.append(sum(map(mul, times, column)))
+            ret.mins.append(ordered[0])
+            ret.maxs.append(ordered[-1])
+            ret.sketches.append(_sketch(ordered, points))
+        ret.label, ret.pids = label, pids
+        ret.block_labels = ((block, label),)
+        return ret
+
+    @staticmethod
+    def merge(items: List["_Aggregate"], points: Optional[int]) -> "_Aggregate":
+        """
+        items 按时间先后排列
+        """
+        ret = _Aggregate()
+        origin = items[0].origin
+        ret.count = sum(item.count for item in items)
+        ret.start, ret.end, ret.origin = items[0].start, items[-1].end, origin
+        ret.st = ret.stt = 0.0
+        ret.sx = [0.0] * len(METRIC_FIELDS)
+        ret.sxx = [0.0] * len(METRIC_FIELDS)
+        ret.stx = [0.0] * len(METRIC_FIELDS)
+        for item in items:
+            shift = item.origin - origin
+            n = item.count
+            ret.st += item.st + n * shift
+            ret.stt += item.stt + 2 * shift * item.st + n * shift * shift
+            for i in range(len(METRIC_FIELDS)):
+                ret.sx[i] += item.sx[i]
+                ret.sxx[i] += item.sxx[i]
+                ret.stx[i] += item.stx[i] + shift * item.sx[i]
+        ret.mins = [min(values) for values in zip(*(item.mins for item in items))]
+        ret.maxs = [max(values) for values in zip(*(item.maxs for item in items))]
+        ret.sketches = [
+            _merge_sketches(list(sketches), points)
+            for sketches in zip(*(item.sketches for item in items))
+        ]
+        ret.label = items[-1].label
+        ret.pids = frozenset().union(*(item.pids for item in items))
+        # 每一块中这条曲线的标签，按块计算标签之和时用到
+        ret.block_labels = tuple(chain.from_iterable(i.block_labels for i in items))
+        return ret
+
+    def describe(self) -> Dict[str, Any]:
+        count = self.count
+        mean_t = self.st / count
+        variance_t = self.stt / count - mean_t * mean_t
+        metrics = {}
+        for i, field in enumerate(METRIC_FIELDS):
+            mean = self.sx[i] / count
+            variance = max(0.0, self.sxx[i] / count - mean * mean)
+            covariance = self.stx[i] / count - mean_t * mean
+            metrics[field] = {
+                "mean": mean,
+                "min": self.mins[i],
+                "max": self.maxs[i],
+                "stddev": math.sqrt(variance),
+                **{name: _percentile(self.sketches[i], q) for name, q in PERCENTILES},
+                # 时间跨度为 0（只有一个时刻）时没有斜率
+                "slope": covariance / variance_t if variance_t > 1e-9 else 0.0,
+            }
+        return {
+            "count": count,
+            "start": self.start,
+            "end": self.end,
+            "metrics": metrics,
+        }
+
+
+def _sum_by_timestamp(series_list: List[HistoryColumns]) -> Tuple[array, Dict]:
+    """
+    把同一标签下各个进程的记录按时间戳相加
+    同一进程同一时间戳有多条记录时（例如整秒的时间戳、采样间隔小于 1 秒），先取它们的平均
+    """
+    timestamps = sorted(set().union(*(series.timestamps for series in series_list)))
+    position_of = {timestamp: i for i, timestamp in enumerate(timestamps)}
+    sums = {field: [0.0] * len(timestamps) for field in METRIC_FIELDS}
+    for series in series_list:
+        positions = list(map(position_of.__getitem__, series.timestamps))
+        counts = Counter(positions)
+        weights = None
+        if len(counts) != len(positions):
+            weights = [1.0 / counts[position] for position in positions]
+        for field, column in series.metrics.items():
+            acc = sums[field]
+            values = column if weights is None else map(mul, column, weights)
+            for position, value in zip(positions, values):
+                acc[position] += value
+    return array("d", timestamps), {
+        field: array("d", acc) for field, acc in sums.items()
+    }
+
+
+class _AggregateCache:
+    """
+    已经结束的块和组的统计量，按最近使用淘汰；接口线程池中的多个线程共用，需要加锁
+    值为 None 表示这条曲线在这一块中没有记录
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.cache: "OrderedDict[Hashable, Optional[_Aggregate]]" = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key: Hashable) -> Tuple[bool, Optional[_Aggregate]]:
+        with self.lock:
+            if key not in self.cache:
+                return False, None
+            self.cache.move_to_end(key)
+            return True, self.cache[key]
+
+    def put(self, key: Hashable, value: Optional[_Aggregate]) -> None:
+        with self.lock:
+            self.cache[key] = value
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+
+
+class _StatsQuery:
+    """
+    一次统计请求：把 [start, end] 切成块，能用缓存的用缓存，其余从原始记录计算
+    """
+
+    def __init__(
+        self,
+        history: History,
+        cache: Optional[_AggregateCache],
+        start_time: Optional[float],
+        end_time: Optional[float],
+    ) -> None:
+        self.history = history
+        self.cache = cache
+        self.start_time = start_time
+        self.end_time = end_time
+        # 时间戳乱序时（时钟回拨、载入乱序的文件）块会被后来的记录改变，不分块也不缓存
+        time_range = history.get_time_range()
+        self.cacheable = (
+            cache is not None and history.timestamps_sorted and time_range is not None
+        )
+        if self.cacheable:
+            oldest, newest = time_range
+            self.start_time = oldest if start_time is None else max(start_time, oldest)
+            self.end_time = newest if end_time is None else min(end_time, newest)
+            # 结束时刻不晚于最新记录、开始时刻晚于 evictable_before 的块不会再变化：
+            # 之后追加的记录时间戳不会更早，淘汰也还没有进行到这里
+            self.evictable_before = oldest + EVICTION_MARGIN_SECONDS
+        self.version = history.version
+        # 本次请求中读出的原始记录，标签的计算会再用到
+        self.raw: Dict[Tuple, HistoryColumns] = {}
+
+    def blocks(self) -> List[Tuple[Optional[float], Optional[float]]]:
+        """
+        覆盖 [start_time, end_time] 的各块 [start, end)；不缓存时整段作为一块，end 为 None
+        """
+        if not self.cacheable:
+            return [(self.start_time, None)]
+        first = int(self.start_time // BLOCK_SECONDS * BLOCK_SECONDS)
+        return [
+            (start, start + BLOCK_SECONDS)
+            for start in range(first, int(self.end_time) + 1, BLOCK_SECONDS)
+        ]
+
+    def is_settled(self, start: float, end: float) -> bool:
+        return (
+            self.cacheable
+            and start > self.evictable_before
+            and start >= self.start_time
+            and end <= self.end_time
+        )
+
+    def _read(
+        self, pid: int, name: str, start: Optional[float], end: Optional[float]
+    ) -> HistoryColumns:
+        key = (pid, name, start)
+        ret = self.raw.get(key)
+        if ret is not None:
+            return ret
+        lo = start if self.start_time is None else max(start, self.start_time)
+        hi = self.end_time if end is None else min(end, self.end_time)
+        ret = self.history.get_series(pid, lo, hi, name)
+        if end is not None:
+            # 只要 [start, end) 内的记录；get_series 的结束时刻是闭区间，去掉恰好在 end 的
+            cut = bisect_left(ret.timestamps, end)
+            if cut < len(ret.timestamps):
+                ret = ret._replace(
+                    kind_ids=ret.kind_ids[:cut],
+                    timestamps=ret.timestamps[:cut],
+                    metrics={f: column[:cut] for f, column in ret.metrics.items()},
+                )
+        self.raw[key] = ret
+        return ret
+
+    def cached(
+        self, key: Tuple, settled: bool, compute, store: bool = True
+    ) -> Optional[_Aggregate]:
+        """
+        已经结束的部分先查缓存，算出来之后存入；其余直接计算，保留全部的值
+        store 为 False 时只取点、不存入，用于整组缓存的组内的块，免得挤掉其他组
+        """
+        if not settled:
+            return compute(None)
+        if not store:
+            return compute(SKETCH_POINTS)
+        key = (self.version,) + key
+        found, value = self.cache.get(key)
+        if not found:
+            value = compute(SKETCH_POINTS)
+            self.cache.put(key, value)
+        return value
+
+    def series_block(
+        self,
+        pid: int,
+        name: str,
+        start: Optional[float],
+        end: Optional[float],
+        store: bool,
+    ) -> Optional[_Aggregate]:
+        def _compute(points):
+            series = self._read(pid, name, start, end)
+            if len(series.timestamps) == 0:
+                return None
+            label = series.kinds[series.kind_ids[-1]].label
+            return _Aggregate.of(
+                series.timestamps,
+                series.metrics,
+                label,
+                frozenset([pid]),
+                start,
+                points,
+            )
+
+        settled = end is not None and self.is_settled(start, end)
+        return self.cached(("series", pid, name, start), settled, _compute, store)
+
+    def label_block(
+        self,
+        name: str,
+        label: str,
+        pids: List[int],
+        start: Optional[float],
+        end: Optional[float],
+        store: bool,
+    ) -> Optional[_Aggregate]:
+        def _compute(points):
+            series_list = [self._read(pid, name, start, end) for pid in pids]
+            series_list = [s for s in series_list if len(s.timestamps) > 0]
+            timestamps, metrics = _sum_by_timestamp(series_list)
+            return _Aggregate.of(
+                timestamps, metrics, label, frozenset(pids), start, points
+            )
+
+        settled = end is not None and self.is_settled(start, end)
+        key = ("label", name, label, tuple(pids), start)
+        return self.cached(key, settled, _compute, store)
+
+    def combine(
+        self, blocks: List[Tuple], key: Tuple, block_of
+    ) -> Optional[_Aggregate]:
+        """
+        把一条曲线在各块上的统计量按时间顺序合并
+        对齐的完整的一组块整体缓存，合并的开销与组数而不是块数有关
+        """
+        group_seconds = BLOCK_SECONDS * GROUP_BLOCKS
+        groups: List[List[Tuple]] = []
+        for block in blocks:
+            if len(groups) == 0 or not self.cacheable or block[0] % group_seconds == 0:
+                groups.append([])
+            groups[-1].append(block)
+
+        parts = []
+        for group in groups:
+            group_start, group_end = group[0][0], group[-1][1]
+            whole = (
+                len(group) == GROUP_BLOCKS
+                and self.cacheable
+                and self.is_settled(group_start, group_end)
+            )
+            if not whole:
+                parts.extend(block_of(start, end, True) for start, end in group)
+                continue
+
+            def _compute(points, group=group):
+                items = [block_of(start, end, False) for start, end in group]
+                items = [item for item in items if item is not None]
+                return _Aggregate.merge(items, points) if len(items) > 0 else None
+
+            parts.append(self.cached(("group",) + key + (group_start,), True, _compute))
+
+        parts = [part for part in parts if part is not None]
+        if len(parts) <= 1:
+            return parts[0] if len(parts) == 1 else None
+        return _Aggregate.merge(parts, None)
+
+
+def compute_stats(
+    history: History,
+    start_time: Optional[float] = None,
+    end_time: Optional[float] = None,
+    target: Optional[str] = None,
+    cache: Optional[_AggregateCache] = None,
+) -> Dict[str, Any]:
+    """
+    totals 为每个目标的总值；只有一个目标（或指定了 target）时 total 就是它，否则为 None
+    不给出 cache 时整段从原始记录计算，分位数也是精确的
+    """
+    processes = []
+    totals = []
+    labels = []
+    if len(history) == 0:
+        return {"processes": [], "labels": [], "total": None, "totals": []}
+
+    query = _StatsQuery(history, cache, start_time, end_time)
+    blocks = query.blocks()
+
+    # 每一块中各个标签下有哪些进程，标签的统计对象是它们在这一块中的和
+    members: Dict[Any, Dict[Tuple[str, str], List[int]]] = {}
+    for pid, name in history.get_series_keys(target):
+        block_of = partial(query.series_block, pid, name)
+        aggregate = query.combine(blocks, ("series", pid, name), block_of)
+        if aggregate is None:
+            continue
+        if pid not in (TOTAL_PID, SYSTEM_PID):
+            for start, label in aggregate.block_labels:
+                block_members = members.setdefault(start, {})
+                block_members.setdefault((name, label), []).append(pid)
+        item = aggregate.describe()
+        item.update(pid=pid, name=name, label=aggregate.label)
+        if pid == TOTAL_PID:
+            totals.append(item)
+        else:
+            processes.append(item)
+
+    label_keys = dict.fromkeys(
+        key for block_members in members.values() for key in block_members
+    )
+    for name, label in label_keys:
+
+        def _label_block(start, end, store, name=name, label=label):
+            pids = members.get(start, {}).get((name, label))
+            if pids is None:
+                return None
+            return query.label_block(name, label, pids, start, end, store)
+
+        aggregate = query.combine(blocks, ("label", name, label), _label_block)
+        if aggregate is None:
+            continue
+        item = aggregate.describe()
+        item.update(name=name, label=label, processCount=len(aggregate.pids))
+        labels.append(item)
+
+    return {
+        "processes": processes,
+        "labels": labels,
+        "total": totals[0] if len(totals) == 1 else None,
+        "totals": totals,
+    }
+
+
+class StatsCache:
+    """
+    只要历史没有变化（version 与 next_sequence 都相同），同样的参数直接返回上次的结果；
+    历史在增长时，已经结束的块的统计量也会被复用，见模块说明
+    """
+
+    def __init__(self, history: History, capacity: int = 16) -> None:
+        self.history = history
+        self.capacity = capacity
+        self.cache: "OrderedDict[tuple, Dict[str, Any]]" = OrderedDict()
+        self.aggregates = _AggregateCache(CACHE_CAPACITY)
+        self.lock = Lock()
+
+    def get(
+        self,
+        start_time: Optional[float] = None,
+        end_time: Optional[float] = None,
+        target: Optional[str] = None,
+    ) -> Dict[str, Any]:
+        key = (
+            self.history.version,
+            self.history.next_sequence,
+            start_time,
+            end_time,
+            target,
+        )
+        with self.lock:
+            ret = self.cache.get(key)
+            if ret is not None:
+                self.cache.move_to_end(key)
+                return ret
+        ret = compute_stats(self.history, start_time, end_time, target, self.aggregates)
+        with self.lock:
+            self.cache[key] = ret
+            while len(self.cache) > self.capacity:
+                self.cache.popitem(last=False)
+        return ret
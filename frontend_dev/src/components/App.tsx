@@ -1,12 +1,17 @@
 import { useEffect, useRef, useState } from 'react'
 import {
   Config,
-  downloadHistory,
+  getDownloadHistoryUrl,
+  GetHistoryResponse,
+  getTarget,
   HistoryRecord,
+  HistoryStreamFrame,
   loadHistory,
+  openHistoryStream,
   Process,
   request,
   requestClearHistory,
+  setTarget,
 } from '@/utils/request'
 import {
   Button,
@@ -32,11 +37,17 @@ import { useStateSync } from '@/utils/hooks'
 
 import '@/styles/App.scss'
 
+/** 从头同步时每个进程最多拉取的点数，约为图表宽度的两倍 */
+const InitialSyncMaxPoints = 4000
+
 let records: HistoryRecord[] = []
-let version = 0
+let version: number | undefined = undefined
+let cursor = 0
 let processes: Process[] = []
 let config: Config = {} as Config
 let isPaused = false
+let isStreaming = false
+let isSyncing = false
 
 function App() {
   const [, setCount] = useState(0)
@@ -398,6 +409,10 @@ function App() {
 
   async function reloadConfig() {
     config = await request.getConfig()
+    // 多目标时各目标的总值混在一起没有意义，默认显示第一个目标
+    if (getTarget() === null && (config.targets?.length ?? 0) > 1) {
+      setTarget(config.targets[0])
+    }
     manualUpdate()
   }
 
@@ -445,21 +460,90 @@ function App() {
       return
     }
 
-    const offset = records.length
-    const response = await request.getHistory({
-      offset: offset,
-      version: version,
-    })
-    version = response.version ?? version
-    const responseRecords = response.history?.records ?? []
     setLastUpdate(new Date())
     reloadProcesses()
-    if (responseRecords.length === 0) {
-      scheduleNextCall()
+    scheduleNextCall()
+
+    // 推送模式下数据由 handleStreamFrame 接收，无需轮询
+    if (!isStreaming) {
+      await syncHistory()
+    }
+  }
+
+  /**
+   * 返回 false 表示服务端的历史已经换了一份，这次响应被丢弃，需要从头重新同步
+   */
+  function applyHistoryResponse(response: GetHistoryResponse): boolean {
+    if (response.version !== undefined && response.version !== version) {
+      const isFirstResponse = version === undefined
+      version = response.version
+      if (!isFirstResponse) {
+        // 服务端历史被清空或重新载入，本地记录作废；
+        // 这次响应是按旧的游标取的，会漏掉新历史开头的记录，不能直接使用
+        records = []
+        cursor = 0
+        return false
+      }
+    }
+    if (response.gap && version !== undefined && records.length > 0) {
+      console.warn(
+        `部分记录已被服务端淘汰，从 #${response.firstSequence} 继续同步`
+      )
+    }
+    cursor = response.cursor ?? cursor
+    const responseRecords = response.history?.records ?? []
+    if (responseRecords.length > 0) {
+      records = [...records, ...responseRecords]
+    }
+    return true
+  }
+
+  async function syncHistory() {
+    // 同一时刻只允许一个请求，否则两次响应会重复追加同一段记录
+    if (isSyncing) {
       return
     }
-    scheduleNextCall()
-    records = [...records, ...responseRecords]
+    isSyncing = true
+    let shouldResync = false
+    try {
+      // 从头同步时只要概览，长时间录制的全部原始记录会拖垮浏览器
+      const response = await request.getHistory({
+        since: cursor,
+        format: 'binary',
+        maxPoints: cursor === 0 ? InitialSyncMaxPoints : undefined,
+      })
+      shouldResync = !applyHistoryResponse(response)
+    } finally {
+      isSyncing = false
+    }
+    if (shouldResync) {
+      await syncHistory()
+    }
+  }
+
+  function handleStreamFrame(frame: HistoryStreamFrame) {
+    if (isPaused) {
+      // 暂停期间丢弃推送，恢复后第一帧会因为 since 不连续而触发一次补齐
+      return
+    }
+    if (frame.since !== cursor || frame.version !== version) {
+      syncHistory()
+      return
+    }
+    applyHistoryResponse({
+      history: { records: frame.records },
+      cursor: frame.cursor,
+      version: frame.version,
+    })
+    setLastUpdate(new Date())
+  }
+
+  function startStreaming() {
+    isStreaming = true
+    openHistoryStream(handleStreamFrame, () => {
+      // 推送不可用时退回轮询
+      isStreaming = false
+    })
   }
 
   function makeProcessCard(process: Process, i: number) {
@@ -493,28 +577,18 @@ function App() {
   }
 
   function handleDownloadData() {
-    downloadHistory().then((response) => {
-      const historyFullText = response.fullHistory
-      downloadString(
-        `history-${config.targetProcessName}.csv`,
-        'text/csv',
-        historyFullText
-      )
-    })
-  }
-
-  function downloadString(filename: string, mimeType: string, text: string) {
     const pom = document.createElement('a')
+    pom.setAttribute('href', getDownloadHistoryUrl())
     pom.setAttribute(
-      'href',
-      `data:${mimeType};charset=utf-8,` + encodeURIComponent(text)
+      'download',
+      `history-${getTarget() ?? config.targetProcessName}.csv`
     )
-    pom.setAttribute('download', filename)
     pom.click()
   }
 
   function handleClearScreen() {
     records = []
+    cursor = 0
     manualUpdate()
     requestClearHistory()
   }
@@ -522,13 +596,15 @@ function App() {
   function handleLoadData() {
     setPaused(false)
     openFile().then((file) => {
-      file.text().then((text) => {
-        records = []
-        loadHistory(text).then(() => {
-          setTimeout(() => {
-            setPaused(true)
-          }, config.pageUpdateIntervalMillis)
-        })
+      records = []
+      cursor = 0
+      loadHistory(file).then((response) => {
+        if (response.failed > 0) {
+          console.warn(`${response.failed} 行解析失败`, response.errors)
+        }
+        setTimeout(() => {
+          setPaused(true)
+        }, config.pageUpdateIntervalMillis)
       })
     })
   }
@@ -582,7 +658,10 @@ function App() {
   }
 
   useEffect(() => {
-    reloadConfig().then(reloadProcesses).then(handleRefreshData)
+    reloadConfig()
+      .then(reloadProcesses)
+      .then(handleRefreshData)
+      .then(startStreaming)
     // eslint-disable-next-line
   }, [])
 
@@ -605,7 +684,7 @@ function App() {
     processes.length === 0 ? (
       <center>
         <SSProgress className="progress" />
-        等待目标 {config.targetProcessName} 运行...
+        等待目标 {getTarget() ?? config.targetProcessName} 运行...
       </center>
     ) : records.length === 0 ? (
       <center>
@@ -667,7 +746,25 @@ function App() {
     <div>
       <div className="header">
         <div className="title">
-          {config.targetProcessName} {isPaused && <Chip>已暂停更新</Chip>}
+          {getTarget() ?? config.targetProcessName}{' '}
+          {isPaused && <Chip>已暂停更新</Chip>}
+          {(config.targets?.length ?? 0) > 1 && (
+            <ButtonGroup size="sm" className="target-switch">
+              {config.targets.map((target) => (
+                <Button
+                  key={target}
+                  color={target === getTarget() ? 'primary' : 'default'}
+                  onClick={() => {
+                    window.location.search = `?target=${encodeURIComponent(
+                      target
+                    )}`
+                  }}
+                >
+                  {target}
+                </Button>
+              ))}
+            </ButtonGroup>
+          )}
         </div>
         <div className="sub-button-area">
           <div className="right-part">&#9825; \^-^/</div>
@@ -1,6 +1,15 @@
 export interface GetDiagramRequest {
-  offset: number
-  version: number
+  /** 上次响应中的 cursor，首次请求传 0 */
+  since: number
+
+  /** binary 为紧凑的列式二进制格式，体积和解析开销都小得多，默认 json */
+  format?: 'json' | 'binary'
+
+  /**
+   * 每个进程最多返回的点数，超过时服务端按 min/max 分桶降采样，
+   * 此时忽略 since，返回全部历史的概览，cursor 仍可用于之后的增量请求
+   */
+  maxPoints?: number
 }
 
 export interface GetConfigRequest {}
@@ -8,10 +17,28 @@ export interface GetConfigRequest {}
 export interface GetHistoryResponse {
   history?: History
 
-  // 如果后端给了version应当更新然后重置offset
+  /** 下次请求应当使用的 since */
+  cursor?: number
+
+  /** 服务端目前保留的最旧一条记录的序号 */
+  firstSequence?: number
+
+  /** since 之后有记录已被服务端淘汰，这部分数据永久缺失 */
+  gap?: boolean
+
+  /** 服务端历史被清空或重新载入时会变化，此时前端应当丢弃本地记录 */
   version?: number
 }
 
+export interface HistoryStreamFrame {
+  records: HistoryRecord[]
+
+  /** 本批第一条记录的序号，与本地 cursor 不一致说明中间丢了帧 */
+  since: number
+  cursor: number
+  version: number
+}
+
 export interface GetConfigResponse {
   config?: Config
 }
@@ -20,6 +47,14 @@ export interface GetProcessesResponse {
   processes?: Process[]
 }
 
+export interface LoadHistoryResponse {
+  loaded: number
+  failed: number
+
+  /** 前若干个解析失败的行 */
+  errors: { line: number; message: string }[]
+}
+
 export interface RequestDownloadResponse {
   fullHistory: string
 }
@@ -40,6 +75,9 @@ export interface Process {
   processId: number
   name: string
   label: string
+
+  /** 进程所属的目标，只有 /api/processes 返回 */
+  target?: string
 }
 
 export interface MemoryUtilization {
@@ -73,6 +111,9 @@ export interface MemoryUtilization {
 
 export interface Config {
   targetProcessName: string
+
+  /** 同时监控的所有目标，第一个即 targetProcessName */
+  targets: string[]
   durationMillis: number
   shouldShowRealtimeDiagram: boolean
   latestRecordCount: number
@@ -95,6 +136,28 @@ export interface LabelCriterion {
 const BaseUrl =
   process.env.NODE_ENV === 'development' ? 'http://localhost:6308' : ''
 
+/** 页面只显示一个目标的数据，由地址中的 ?target= 指定 */
+let currentTarget: string | null = new URLSearchParams(
+  window.location.search
+).get('target')
+
+export function getTarget(): string | null {
+  return currentTarget
+}
+
+export function setTarget(target: string | null) {
+  currentTarget = target
+}
+
+/** 给接口地址加上当前目标的筛选条件 */
+function withTarget(url: string): string {
+  if (currentTarget === null) {
+    return url
+  }
+  const separator = url.includes('?') ? '&' : '?'
+  return `${url}${separator}target=${encodeURIComponent(currentTarget)}`
+}
+
 async function get<T>(url: string, fallback: T): Promise<T> {
   try {
     const response = await fetch(BaseUrl + url)
@@ -120,27 +183,168 @@ export async function getConfig(): Promise<Config> {
   return await get<Config>('/api/config', {} as Config)
 }
 
+const BinaryHistoryMagic = 'KPH2'
+
+interface BinaryHistoryHeader {
+  processes: (Process & { id: number })[]
+  count: number
+  timestampBase: number
+  cursor: number
+  firstSequence: number
+  gap: boolean
+  version: number
+  columns: string[]
+}
+
+/**
+ * 解码 /api/history?format=binary，格式见 server/codec.py
+ *
+ * magic(4) | header 长度 u32 | header JSON | 时间戳 f64[]（秒）| kinds u32[] | 各列 f32[]
+ */
+export function decodeBinaryHistory(buffer: ArrayBuffer): GetHistoryResponse {
+  const view = new DataView(buffer)
+  const magic = new TextDecoder().decode(new Uint8Array(buffer, 0, 4))
+  if (magic !== BinaryHistoryMagic) {
+    throw new Error(`未知的历史数据格式: ${magic}`)
+  }
+  const headerLength = view.getUint32(4, true)
+  const header = JSON.parse(
+    new TextDecoder().decode(new Uint8Array(buffer, 8, headerLength))
+  ) as BinaryHistoryHeader
+
+  const count = header.count
+  let offset = 8 + headerLength
+  const timestamps = new Float64Array(buffer, offset, count)
+  offset += count * 8
+  const kinds = new Uint32Array(buffer, offset, count)
+  offset += count * 4
+  const columns: Record<string, Float32Array> = {}
+  for (const name of header.columns) {
+    columns[name] = new Float32Array(buffer, offset, count)
+    offset += count * 4
+  }
+
+  const processById = new Map<number, Process>()
+  for (const p of header.processes) {
+    processById.set(p.id, {
+      processId: p.processId,
+      name: p.name,
+      label: p.label,
+    })
+  }
+
+  const records: HistoryRecord[] = new Array(count)
+  for (let i = 0; i < count; i++) {
+    records[i] = {
+      timestampSeconds: timestamps[i],
+      process: processById.get(kinds[i])!,
+      cpuPercentage: columns.cpuPercentage[i],
+      gpuPercentage: columns.gpuPercentage[i],
+      memoryUtilization: {
+        uniqueSetSize: columns.uniqueSetSize[i],
+        residentSetSize: columns.residentSetSize[i],
+        virtualSize: columns.virtualSize[i],
+        workingSet: columns.workingSet[i],
+        privateWorkingSet: columns.privateWorkingSet[i],
+        systemTotal: columns.systemTotal[i],
+        systemAvailable: columns.systemAvailable[i],
+        fromTaskmgr: columns.fromTaskmgr[i],
+        vsize: columns.vsize[i],
+      },
+    }
+  }
+
+  return {
+    history: { records },
+    cursor: header.cursor,
+    firstSequence: header.firstSequence,
+    gap: header.gap,
+    version: header.version,
+  }
+}
+
 export async function getHistory(
   request: GetDiagramRequest
 ): Promise<GetHistoryResponse> {
-  return await get<GetHistoryResponse>(
-    `/api/history?offset=${request.offset}&version=${request.version}`,
-    {}
-  )
+  let url = `/api/history?since=${request.since}`
+  if (request.maxPoints !== undefined) {
+    url += `&max_points=${request.maxPoints}`
+  }
+  url = withTarget(url)
+  if (request.format !== 'binary') {
+    return await get<GetHistoryResponse>(url, {})
+  }
+  try {
+    const response = await fetch(BaseUrl + url + '&format=binary')
+    return decodeBinaryHistory(await response.arrayBuffer())
+  } catch {
+    return {}
+  }
+}
+
+/**
+ * 订阅 /api/stream，服务端每采样一次就推送一批新记录
+ *
+ * @returns 关闭订阅的函数
+ */
+export function openHistoryStream(
+  onFrame: (frame: HistoryStreamFrame) => void,
+  onError: () => void
+): () => void {
+  const source = new EventSource(BaseUrl + withTarget('/api/stream'))
+  source.onmessage = (event) => {
+    onFrame(JSON.parse(event.data) as HistoryStreamFrame)
+  }
+  source.onerror = () => {
+    source.close()
+    onError()
+  }
+  return () => source.close()
 }
 
 export async function getProcesses(): Promise<GetProcessesResponse> {
-  return await get<GetProcessesResponse>('/api/processes', {})
+  return await get<GetProcessesResponse>(withTarget('/api/processes'), {})
+}
+
+export interface DownloadHistoryOptions {
+  format?: 'csv' | 'segment'
+  gzip?: boolean
+  pid?: number
+  label?: string
+  start?: number
+  end?: number
+}
+
+/**
+ * 服务端流式导出的地址，交给浏览器直接下载，不经过 JS 内存
+ */
+export function getDownloadHistoryUrl(options: DownloadHistoryOptions = {}) {
+  const params = new URLSearchParams()
+  for (const [key, value] of Object.entries(options)) {
+    if (value !== undefined) {
+      params.set(key, String(value))
+    }
+  }
+  const query = params.toString()
+  return BaseUrl + withTarget('/api/download' + (query ? '?' + query : ''))
 }
 
 export async function downloadHistory(): Promise<RequestDownloadResponse> {
   return await post<RequestDownloadResponse>('/api/download', {})
 }
 
-export async function loadHistory(fullHistory: string): Promise<void> {
-  await post<GetHistoryResponse>('/api/load', {
-    full_history: fullHistory,
+/**
+ * 直接上传文件本身，服务端边接收边解析，不需要先把整个文件读成字符串
+ */
+export async function loadHistory(file: File): Promise<LoadHistoryResponse> {
+  const response = await fetch(BaseUrl + '/api/load', {
+    method: 'POST',
+    headers: {
+      'Content-Type': 'application/octet-stream',
+    },
+    body: file,
   })
+  return (await response.json()) as LoadHistoryResponse
 }
 
 export async function requestClearHistory(): Promise<void> {
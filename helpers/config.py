@@ -1,32 +1,56 @@
 import yaml
 import os
+import zlib
 from typing import Optional, List
-from .label_criterion import LabelCriterion
+from .label_criterion import LabelCriterion, LabelMatcher
+from .rollup_tier import RollupTier, DEFAULT_ROLLUP_TIERS
 
 
 class Config:
     def __init__(self, config_file: str):
         self.config_file = config_file
+        self._label_criteria: Optional[List[LabelCriterion]] = None
+        self._label_matcher: Optional[LabelMatcher] = None
 
         if not os.path.exists(self.config_file):
             raise FileNotFoundError(f"Config file {self.config_file} not found")
 
-        with open(self.config_file, "r", encoding="utf-8") as stream:
-            try:
-                self.config = yaml.safe_load(stream)
-            except yaml.YAMLError as exc:
-                print(exc)
+        with open(self.config_file, "rb") as stream:
+            content = stream.read()
+        # 配置文件内容的校验值，用作 /api/config 的缓存版本
+        self.version = zlib.crc32(content)
+        try:
+            self.config = yaml.safe_load(content.decode("utf-8"))
+        except yaml.YAMLError as exc:
+            print(exc)
 
     def __getitem__(self, key: str):
         return self.config.get(key)
 
+    @property
+    def targets(self) -> List[str]:
+        # 没有配置 targets 时退回到单个的 target
+        targets = self["targets"]
+        if targets:
+            return [str(target) for target in targets]
+        return [self["target"]]
+
     @property
     def target(self) -> str:
-        return self["target"]
+        """
+        主目标，多目标时为第一个
+        """
+        return self.targets[0]
+
+    @property
+    def targets_name(self) -> str:
+        # 用于日志和导出的文件名
+        return "+".join(self.targets)
 
     @property
     def tss_target(self) -> str:
-        return self["tss_target"]
+        # 没有单独配置时，关注所有目标
+        return self["tss_target"] or ",".join(self.targets)
 
     @property
     def duration_millis(self) -> int:
@@ -44,6 +68,10 @@ class Config:
     def write_logs(self) -> bool:
         return self["write_logs"]
 
+    @property
+    def log_format(self) -> str:
+        return self.config.get("log_format", "csv")
+
     @property
     def disable_gpu(self) -> bool:
         return self["disable_gpu"]
@@ -72,10 +100,74 @@ class Config:
     def gpu_duration_millis(self) -> int:
         return self["advanced"]["gpu_duration_millis"]
 
+    @property
+    def log_flush_millis(self) -> int:
+        return self["advanced"].get("log_flush_millis", 5000)
+
+    @property
+    def log_rotate_mb(self) -> Optional[int]:
+        return self["advanced"].get("log_rotate_mb")
+
+    @property
+    def follow_children(self) -> bool:
+        return self["advanced"].get("follow_children", False)
+
+    @property
+    def uss_source(self) -> str:
+        return self["advanced"].get("uss_source", "full")
+
+    @property
+    def uss_duration_millis(self) -> Optional[int]:
+        return self["advanced"].get("uss_duration_millis")
+
+    @property
+    def adaptive_sampling(self) -> bool:
+        return self["advanced"].get("adaptive_sampling", False)
+
+    @property
+    def adaptive_min_millis(self) -> int:
+        return self["advanced"].get("adaptive_min_millis", 50)
+
+    @property
+    def adaptive_max_millis(self) -> int:
+        return self["advanced"].get("adaptive_max_millis", 2000)
+
+    @property
+    def adaptive_cpu_delta(self) -> float:
+        return self["advanced"].get("adaptive_cpu_delta", 5)
+
+    @property
+    def adaptive_memory_delta_mb(self) -> float:
+        return self["advanced"].get("adaptive_memory_delta_mb", 20)
+
+    @property
+    def adaptive_cpu_threshold(self) -> Optional[float]:
+        return self["advanced"].get("adaptive_cpu_threshold", 80)
+
+    @property
+    def api_workers(self) -> int:
+        return self["advanced"].get("api_workers", 2)
+
+    @property
+    def rollup_tiers(self) -> List[RollupTier]:
+        tiers = self["advanced"].get("rollup_tiers")
+        if not tiers:
+            return DEFAULT_ROLLUP_TIERS
+        return [RollupTier(tier["seconds"], tier["retention_hours"]) for tier in tiers]
+
     @property
     def label_criteria(self) -> List[LabelCriterion]:
-        criteria = self["advanced"]["label_criteria"]
-        ret = []
-        for criterion in criteria:
-            ret.append(LabelCriterion(criterion["keyword"], criterion["label"]))
-        return ret
+        # 配置在运行期间不会变化，只构造一次
+        if self._label_criteria is None:
+            criteria = self["advanced"]["label_criteria"]
+            ret = []
+            for criterion in criteria:
+                ret.append(LabelCriterion(criterion["keyword"], criterion["label"]))
+            self._label_criteria = ret
+        return self._label_criteria
+
+    @property
+    def label_matcher(self) -> LabelMatcher:
+        if self._label_matcher is None:
+            self._label_matcher = LabelMatcher(self.label_criteria)
+        return self._label_matcher
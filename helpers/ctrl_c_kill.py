@@ -1,12 +1,22 @@
+from utils import platform
+from typing import Callable, Optional
 import signal
-import win32api
 import os
 
+if platform.is_windows():
+    import win32api
 
-def kill_on_ctrl_c():
+
+def kill_on_ctrl_c(before_kill: Optional[Callable[[], None]] = None):
     def handler(sig, frame):
         print("Ctrl+C pressed. Killing the process.")
+        if before_kill is not None:
+            # 例如把还在内存里的日志写完
+            before_kill()
         self_pid = os.getpid()
+        if not platform.is_windows():
+            os.kill(self_pid, signal.SIGKILL)
+            return
         hProcess = win32api.OpenProcess(2035711, False, self_pid)
         if hProcess:
             win32api.TerminateProcess(hProcess, 0)
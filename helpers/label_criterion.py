@@ -1,3 +1,7 @@
+from typing import List, Optional
+import re
+
+
 class LabelCriterion:
     def __init__(self, keyword: str, label: str):
         self.keyword = keyword
@@ -5,3 +9,32 @@ class LabelCriterion:
 
     def match(self, text: str) -> bool:
         return self.keyword in text
+
+
+class LabelMatcher:
+    """
+    把所有关键字编译成一个正则，一次扫描找出命中的规则
+    与逐条调用 LabelCriterion.match 的结果相同：多条规则命中时取配置中靠前的那条
+    """
+
+    def __init__(self, criteria: List[LabelCriterion]):
+        self.criteria = criteria
+        # 零宽断言：每个位置都尝试所有关键字，关键字互相包含时也不会漏掉
+        self.pattern = (
+            re.compile(
+                "(?=" + "|".join(f"({re.escape(c.keyword)})" for c in criteria) + ")"
+            )
+            if criteria
+            else None
+        )
+
+    def match(self, text: str) -> Optional[LabelCriterion]:
+        if self.pattern is None:
+            return None
+        best = None
+        for m in self.pattern.finditer(text):
+            if best is None or m.lastindex < best:
+                best = m.lastindex
+                if best == 1:
+                    break
+        return None if best is None else self.criteria[best - 1]
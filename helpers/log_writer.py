@@ -0,0 +1,142 @@
+from threading import Thread
+from typing import List, Optional
+import gzip
+import os
+import queue
+import shutil
+import time
+
+
+class CsvLogWriter:
+    """
+    后台写日志：采样线程只把每个周期的记录放进有界队列，从不碰磁盘
+    写线程攒够一批或者超过一定时间才写一次，文件句柄一直打开
+    文件超过 rotate_bytes 后改名并在另一个线程里压缩成 .gz
+    队列满了说明磁盘跟不上，直接丢弃并计数，不让采样等待
+    """
+
+    def __init__(
+        self,
+        path: str,
+        flush_rows: int = 1000,
+        flush_interval_millis: int = 5000,
+        rotate_bytes: Optional[int] = None,
+        max_pending_batches: int = 1024,
+    ) -> None:
+        self.path = path
+        self.flush_rows = flush_rows
+        self.flush_interval_millis = flush_interval_millis
+        self.rotate_bytes = rotate_bytes
+        self.queue: queue.Queue = queue.Queue(maxsize=max_pending_batches)
+        self.dropped_batches = 0
+        self.should_stop = False
+        self.thread: Optional[Thread] = None
+        self.file = None
+
+    def start(self) -> None:
+        self.thread = Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, records: List) -> None:
+        try:
+            self.queue.put_nowait(records)
+        except queue.Full:
+            self.dropped_batches += 1
+
+    def close(self, timeout: float = 5) -> None:
+        """
+        写完队列里剩下的记录再返回，最多等待 timeout 秒
+        Ctrl+C 时也会调用，任何情况下都不能无限期地阻塞
+        """
+        if self.thread is None:
+            return
+        self.should_stop = True
+        try:
+            # 只是为了唤醒空闲的写线程；队列满时写线程本来就醒着，会看到 should_stop
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+        self.thread.join(timeout)
+        self.thread = None
+
+    def _drain(self) -> List:
+        rows = []
+        while True:
+            try:
+                records = self.queue.get_nowait()
+            except queue.Empty:
+                return rows
+            if records is not None:
+                rows.extend(records)
+
+    def _open(self) -> None:
+        self.file = open(self.path, "a", encoding="utf-8")
+
+    def _write(self, rows: List) -> None:
+        if len(rows) == 0:
+            return
+        if self.file is None:
+            self._open()
+        if self.file.tell() == 0:
+            self.file.write(",".join(rows[0].to_dict().keys()) + "\n")
+        self.file.write("\n".join(record.serialize() for record in rows) + "\n")
+        self.file.flush()
+        if self.rotate_bytes and self.file.tell() >= self.rotate_bytes:
+            self._rotate()
+
+    def _rotate(self) -> None:
+        self.file.close()
+        self.file = None
+        base, ext = os.path.splitext(self.path)
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        rotated = f"{base}-{stamp}{ext}"
+        index = 1
+        while os.path.exists(rotated) or os.path.exists(rotated + ".gz"):
+            rotated = f"{base}-{stamp}-{index}{ext}"
+            index += 1
+        os.replace(self.path, rotated)
+        Thread(target=_compress, args=(rotated,), daemon=True).start()
+
+    def _run(self) -> None:
+        pending = []
+        last_flush = time.monotonic()
+        interval = self.flush_interval_millis / 1000.0
+        stopping = False
+        while not stopping:
+            timeout = max(0.0, interval - (time.monotonic() - last_flush))
+            try:
+                records = self.queue.get(timeout=timeout)
+                if records is None:
+                    stopping = True
+                else:
+                    pending.extend(records)
+            except queue.Empty:
+                pass
+            if self.should_stop and not stopping:
+                stopping = True
+                pending.extend(self._drain())
+
+            if (
+                stopping
+                or len(pending) >= self.flush_rows
+                or time.monotonic() - last_flush >= interval
+            ):
+                try:
+                    self._write(pending)
+                except Exception as e:
+                    print("写入日志失败", e)
+                pending = []
+                last_flush = time.monotonic()
+
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def _compress(path: str) -> None:
+    try:
+        with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(path)
+    except Exception as e:
+        print("压缩日志失败", path, e)
@@ -1,6 +1,8 @@
 import psutil
-from typing import NamedTuple
+from typing import NamedTuple, Dict, List, Optional
 from .process_utils import ProcessUtils
+from .process_tracker import ProcessKey, ProcessTracker
+import time
 
 
 class MemoryUtilization(NamedTuple):
@@ -15,25 +17,98 @@ class MemoryUtilization(NamedTuple):
     vsize: float
 
 
+# USS 的来源
+# full：memory_full_info()，要遍历整个内存映射，最准也最贵
+# estimate：从 memory_info() 估算（Windows 用 private，Linux 用 rss - shared）
+# off：不采集，记为 0
+USS_SOURCES = ("full", "estimate", "off")
+
+
 class CPUHelper:
-    def __init__(self) -> None:
+    def __init__(
+        self, uss_source: str = "full", uss_duration_millis: Optional[int] = None
+    ) -> None:
         self.cpu_count = psutil.cpu_count()
+        if uss_source not in USS_SOURCES:
+            raise ValueError(f"uss_source 只能是 {USS_SOURCES} 之一: {uss_source}")
+        self.uss_source = uss_source
+        self.uss_duration_millis = uss_duration_millis
+        # (pid, create_time) -> (uss_mb, 采集时刻)，full 模式下两次昂贵采样之间沿用
+        # 与 ProcessTracker 一样带上 create_time，pid 被复用时不会沿用旧进程的值
+        self.key_to_uss_mb: Dict[ProcessKey, tuple] = {}
 
-    def _typed_tuple_from_process(self, process: psutil.Process) -> MemoryUtilization:
-        memory_info = process.memory_full_info()
-        vm = psutil.virtual_memory()
+    def _should_query_full(self, key: ProcessKey, now: float) -> bool:
+        if self.uss_source != "full":
+            return False
+        cached = self.key_to_uss_mb.get(key)
+        if cached is None or self.uss_duration_millis is None:
+            return True
+        return now - cached[1] >= self.uss_duration_millis / 1000.0
+
+    def _estimate_uss(self, memory_info) -> float:
+        if self.uss_source == "off":
+            return 0
+        if hasattr(memory_info, "private"):
+            return memory_info.private
+        if hasattr(memory_info, "shared"):
+            return memory_info.rss - memory_info.shared
+        return memory_info.rss
+
+    def _typed_tuple_from_process(
+        self, process: psutil.Process, key: ProcessKey, vm, now: float
+    ) -> MemoryUtilization:
+        with process.oneshot():
+            if self._should_query_full(key, now):
+                memory_info = process.memory_full_info()
+                uss_mb = memory_info.uss / 1024 / 1024
+                self.key_to_uss_mb[key] = (uss_mb, now)
+            else:
+                memory_info = process.memory_info()
+                cached = self.key_to_uss_mb.get(key)
+                if cached is not None:
+                    uss_mb = cached[0]
+                else:
+                    uss_mb = self._estimate_uss(memory_info) / 1024 / 1024
 
         return MemoryUtilization(
             system_total_memory_mb=vm.total / 1024 / 1024,
             system_free_memory_mb=vm.free / 1024 / 1024,
             taskmgr_mb=0,
-            uss_mb=memory_info.uss / 1024 / 1024,
+            uss_mb=uss_mb,
             rss_mb=memory_info.rss / 1024 / 1024,
             vms_mb=memory_info.vms / 1024 / 1024,
-            wset_mb=memory_info.wset / 1024 / 1024,
-            pwset_mb=memory_info.private / 1024 / 1024,
+            # wset / private 只有 Windows 才有
+            wset_mb=getattr(memory_info, "wset", 0) / 1024 / 1024,
+            pwset_mb=getattr(memory_info, "private", 0) / 1024 / 1024,
             vsize=0,
         )
 
     def query_process(self, process: psutil.Process) -> MemoryUtilization:
-        return self._typed_tuple_from_process(process)
+        return self._typed_tuple_from_process(
+            process,
+            ProcessTracker.key_of(process),
+            psutil.virtual_memory(),
+            time.monotonic(),
+        )
+
+    def query_processes(
+        self, processes: List[psutil.Process]
+    ) -> Dict[int, MemoryUtilization]:
+        """
+        一次采集所有进程，系统内存只查询一次；已经退出的进程不会出现在结果里
+        """
+        vm = psutil.virtual_memory()
+        now = time.monotonic()
+        ret = {}
+        alive = set()
+        for process in processes:
+            try:
+                key = ProcessTracker.key_of(process)
+                ret[process.pid] = self._typed_tuple_from_process(process, key, vm, now)
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+            alive.add(key)
+        # 退出的进程、查询失败的进程都不在 alive 中，缓存随之清理
+        for key in [key for key in self.key_to_uss_mb if key not in alive]:
+            del self.key_to_uss_mb[key]
+        return ret
@@ -4,6 +4,10 @@ if platform.is_macos():
     from . import performance_counter_virtual
 
     PerformanceCounter = performance_counter_virtual.PerformanceCounter
+elif platform.is_linux():
+    from . import performance_counter_linux
+
+    PerformanceCounter = performance_counter_linux.PerformanceCounter
 else:
     from . import performance_counter_win
 
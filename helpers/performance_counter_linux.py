@@ -0,0 +1,139 @@
+from typing import List, Dict, Optional, Tuple
+import psutil
+import errno
+import os
+import time
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+CPU_COUNT = os.cpu_count() or 1
+
+STATM_CACHE_SECONDS = 0.01
+
+# /proc/<pid>/stat 中 ")" 之后的字段下标（从 state 开始数）
+_STAT_UTIME = 11
+_STAT_STIME = 12
+
+
+class PerformanceCounter:
+    """
+    直接读取 /proc 的实现，与 Windows 下 TaskStatsServer 客户端接口一致
+    - CPU%：/proc/<pid>/stat 中 utime + stime 的增量，按核数归一化，和任务管理器一致
+    - 内存：/proc/<pid>/statm 的 resident - shared，即匿名页（对应私有工作集）
+    - vsize：/proc/<pid>/statm 的 size，单位字节，与前端约定一致
+    每个文件只 open 一次，之后每次采样只做一次 os.pread
+    """
+
+    def __init__(self, tss_interval: int, tss_arguments: List[str]) -> None:
+        self.tss_interval = tss_interval
+        self.fds: Dict[Tuple[int, str], int] = {}
+        self.can_cache_fds = True
+        # pid -> (utime + stime, 读取时刻)
+        self.last_cpu_ticks: Dict[int, Tuple[int, float]] = {}
+        # statm 一次读取同时得到内存和 vsize，在一个采样周期内复用
+        self.statm_cache: Dict[int, Tuple[int, int]] = {}
+        self.statm_cache_time = 0.0
+        self.last_pids = set()
+
+    def _read(self, pid: int, name: str) -> Optional[bytes]:
+        key = (pid, name)
+        fd = self.fds.get(key)
+        try:
+            if fd is None:
+                fd = os.open(f"/proc/{pid}/{name}", os.O_RDONLY)
+                if self.can_cache_fds:
+                    self.fds[key] = fd
+                else:
+                    try:
+                        return os.pread(fd, 4096, 0)
+                    finally:
+                        os.close(fd)
+            return os.pread(fd, 4096, 0)
+        except OSError as e:
+            if e.errno == errno.EMFILE and self.can_cache_fds:
+                # 文件描述符用完了，之后不再缓存，每次打开再关闭
+                self.can_cache_fds = False
+                self._close_all()
+                return self._read(pid, name)
+            # 进程已退出（ENOENT / ESRCH），旧 fd 不会指向复用了同一 pid 的新进程
+            self._close(key)
+            return None
+
+    def _close(self, key: Tuple[int, str]) -> None:
+        fd = self.fds.pop(key, None)
+        if fd is not None:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _close_all(self) -> None:
+        for key in list(self.fds.keys()):
+            self._close(key)
+
+    def _read_statm(self, pids: List[int]) -> Dict[int, Tuple[int, int]]:
+        now = time.monotonic()
+        # 只在同一次采样内（先取内存、紧接着取 vsize）复用，自适应采样时间隔可能只有几十毫秒
+        if now - self.statm_cache_time < STATM_CACHE_SECONDS:
+            if all(pid in self.statm_cache for pid in pids):
+                return self.statm_cache
+        ret = {}
+        for pid in pids:
+            content = self._read(pid, "statm")
+            if content is None:
+                continue
+            fields = content.split()
+            size, resident, shared = int(fields[0]), int(fields[1]), int(fields[2])
+            ret[pid] = (size * PAGE_SIZE, (resident - shared) * PAGE_SIZE)
+        self.statm_cache = ret
+        self.statm_cache_time = now
+        return ret
+
+    def invalidate_cache(self):
+        """
+        进程列表变化时调用：关闭已经不再关注的进程的 fd
+        """
+        for key in [key for key in self.fds if key[0] not in self.last_pids]:
+            self._close(key)
+        for pid in [pid for pid in self.last_cpu_ticks if pid not in self.last_pids]:
+            del self.last_cpu_ticks[pid]
+        self.statm_cache_time = 0.0
+
+    def get_pid_to_cpu_percent_map(
+        self, processes: List[psutil.Process]
+    ) -> Dict[int, float]:
+        ret = {}
+        total = 0.0
+        pids = [process.pid for process in processes]
+        self.last_pids = set(pids)
+        for pid in pids:
+            content = self._read(pid, "stat")
+            if content is None:
+                self.last_cpu_ticks.pop(pid, None)
+                continue
+            now = time.monotonic()
+            fields = content[content.rfind(b")") + 2 :].split()
+            ticks = int(fields[_STAT_UTIME]) + int(fields[_STAT_STIME])
+            last = self.last_cpu_ticks.get(pid)
+            self.last_cpu_ticks[pid] = (ticks, now)
+            if last is None or now <= last[1]:
+                continue
+            seconds = (ticks - last[0]) / CLOCK_TICKS
+            percent = seconds / (now - last[1]) / CPU_COUNT * 100
+            ret[pid] = percent
+            total += percent
+        ret[0] = total
+        return ret
+
+    def get_pid_to_gpu_percent_map(self, pids: List[int]) -> Dict[int, float]:
+        return {}
+
+    def get_pid_to_memory_mb_map(self, pids: List[int]) -> Dict[int, float]:
+        statm = self._read_statm(pids)
+        ret = {pid: private / 1024 / 1024 for pid, (_, private) in statm.items()}
+        ret[0] = sum(ret.values())
+        return ret
+
+    def get_pid_to_vsize_mb_map(self, pids: List[int]) -> Dict[int, float]:
+        statm = self._read_statm(pids)
+        return {pid: size for pid, (size, _) in statm.items()}
@@ -3,7 +3,7 @@ import psutil
 
 
 class PerformanceCounter:
-    def __init__(self) -> None:
+    def __init__(self, tss_interval: int, tss_arguments: List[str]) -> None:
         pass
 
     def invalidate_cache(self):
@@ -19,3 +19,6 @@ class PerformanceCounter:
 
     def get_pid_to_memory_mb_map(self, pids: List[int]) -> Dict[int, float]:
         return {}
+
+    def get_pid_to_vsize_mb_map(self, pids: List[int]) -> Dict[int, float]:
+        return {}
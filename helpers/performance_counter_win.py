@@ -1,22 +1,61 @@
-from typing import List, Dict
+from typing import Any, List, Dict, FrozenSet, NamedTuple, Optional
 import psutil
-from threading import Thread
+from threading import Lock, Thread
 import subprocess
 import time
-import requests
-import json
-import sys
+
+# 连接超时和读取超时，单位：秒；TaskStatsServer 在本机，正常情况下远小于这个值
+TSS_TIMEOUT = (0.5, 2.0)
+
+# TaskStatsServer 刚启动时还没开始监听，这段时间内连不上不算错误，每隔一小段时间重试
+TSS_STARTUP_SECONDS = 5.0
+TSS_STARTUP_RETRY_SECONDS = 0.05
+
+
+def _parse_number(text: str) -> float:
+    # "12.5 %"、"300.1 MB" 之类，去掉末尾的单位
+    return float(text.rstrip("%MB ").strip())
+
+
+class CounterMaps(NamedTuple):
+    """
+    同一次轮询解析出的四个字典，整体发布，读到的总是同一次轮询的结果
+    """
+
+    cpu_percent: Dict[int, float]
+    gpu_percent: Dict[int, float]
+    memory_mb: Dict[int, float]
+    vsize_mb: Dict[int, float]
+
+
+EMPTY_MAPS = CounterMaps({}, {}, {}, {})
 
 
 class PerformanceCounter:
+    """
+    TaskStatsServer 客户端
+    - 复用同一个 keep-alive 连接，不再每次轮询都重新握手
+    - 只解析本次关心的进程（最近一次采样的 pid 加上总值 0），其他行直接跳过
+    - 每次轮询构造新的字典，打包成一个 CounterMaps 只替换一次引用；
+      采样线程每个周期在取 CPU 时固定一份，之后的内存、vsize 都从这一份里取
+    - 出现新的目标进程时立即用最近一次的响应重新解析，不用等下一次轮询才有数据
+    - 不再固定等待 1 秒：TaskStatsServer 一开始监听就立即轮询；
+      requests 在轮询线程中导入，不拖慢第一次采样
+    """
+
     def __init__(self, tss_interval: int, tss_arguments: List[str]) -> None:
         tss_arguments.insert(0, "tss/TaskStatsServer.exe")
         self.tss_arguments = tss_arguments
         self._launch_tss()
-        self.pid_to_cpu_percent_map = {}
-        self.pid_to_gpu_percent_map = {}
-        self.pid_to_memory_mb_map = {}
-        self.pid_to_vsize_mb_map = {}
+        # 轮询线程发布的最新结果，以及采样线程本周期固定下来的那一份
+        self.maps = EMPTY_MAPS
+        self.cycle_maps = EMPTY_MAPS
+        # None 表示还不知道关心哪些进程，全部解析
+        self.wanted_pids: Optional[FrozenSet[int]] = None
+        # 最近一次的响应，新的目标进程出现时拿来重新解析
+        self.last_processes: List[Dict[str, Any]] = []
+        # 轮询线程和采样线程都可能解析，串行执行，后发布的总是用最新的 wanted_pids
+        self.parse_lock = Lock()
         self.tss_interval = tss_interval
         self.tss_port = tss_arguments[1]
         Thread(target=self._request_tss, daemon=True).start()
@@ -24,38 +63,60 @@ class PerformanceCounter:
     def _launch_tss(self):
         self.tss = subprocess.Popen(list(map(str, self.tss_arguments)))
 
+    def _parse(self, processes: List[Dict[str, str]]) -> None:
+        with self.parse_lock:
+            self.last_processes = processes
+            self.maps = self._parse_maps(processes, self.wanted_pids)
+
+    def _parse_maps(
+        self, processes: List[Dict[str, str]], wanted_pids: Optional[FrozenSet[int]]
+    ) -> CounterMaps:
+        old_vsize_map = self.maps.vsize_mb
+        cpu_map, gpu_map, memory_map, vsize_map = {}, {}, {}, {}
+        for process in processes:
+            try:
+                pid = int(process["PID"])
+                if wanted_pids is not None and pid not in wanted_pids:
+                    continue
+                cpu_map[pid] = _parse_number(process["CPU"])
+                gpu_map[pid] = _parse_number(process["GPU"])
+                memory_map[pid] = _parse_number(process["内存"])
+
+                vsize = float(process["vsize"].strip() if "vsize" in process else "0")
+                # TaskStatsServer 偶尔拿不到 vsize，沿用上一次的值
+                vsize_map[pid] = vsize if vsize != 0 else old_vsize_map.get(pid, 0)
+            except Exception as e:
+                print("无法解析 TaskStatsServer 数据", process, "exception:", e)
+                continue
+
+        return CounterMaps(cpu_map, gpu_map, memory_map, vsize_map)
+
     def _request_tss(self):
-        time.sleep(1)
+        import requests
+        import requests.adapters
+
+        session = requests.Session()
+        session.mount(
+            "http://", requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=1)
+        )
+        url = f"http://127.0.0.1:{self.tss_port}"
+        interval = self.tss_interval / 1000
+        startup_deadline = time.monotonic() + TSS_STARTUP_SECONDS
+        connected = False
+        next_poll = time.monotonic()
         while True:
-            time.sleep(self.tss_interval / 1000)
-            url = f"http://127.0.0.1:{self.tss_port}"
+            time.sleep(max(0.0, next_poll - time.monotonic()))
+            # 按固定节奏轮询，请求本身的耗时不会累积成漂移
+            next_poll = max(next_poll + interval, time.monotonic())
             try:
-                processes = requests.get(url).json()
-
-                for process in processes:
-                    try:
-                        pid = int(process["PID"])
-                        self.pid_to_cpu_percent_map[pid] = float(
-                            process["CPU"].replace("%", "").strip()
-                        )
-                        self.pid_to_gpu_percent_map[pid] = float(
-                            process["GPU"].replace("%", "").strip()
-                        )
-                        self.pid_to_memory_mb_map[pid] = float(
-                            process["内存"].replace("MB", "").strip()
-                        )
-
-                        vsize = float(
-                            process["vsize"].strip() if "vsize" in process else "0"
-                        )
-                        if vsize == 0:
-                            if pid not in self.pid_to_vsize_mb_map:
-                                self.pid_to_vsize_mb_map[pid] = 0
-                        else:
-                            self.pid_to_vsize_mb_map[pid] = vsize
-                    except Exception as e:
-                        print("无法解析 TaskStatsServer 数据", process, "exception:", e)
-                        continue
+                response = session.get(url, timeout=TSS_TIMEOUT)
+                self._parse(response.json())
+                connected = True
+            except requests.ConnectionError as e:
+                if not connected and time.monotonic() < startup_deadline:
+                    next_poll = time.monotonic() + TSS_STARTUP_RETRY_SECONDS
+                    continue
+                print("无法连接 TaskStatsServer", e)
             except Exception as e:
                 if "NoneType" in str(e):
                     pass
@@ -68,13 +129,23 @@ class PerformanceCounter:
     def get_pid_to_cpu_percent_map(
         self, processes: List[psutil.Process]
     ) -> Dict[int, float]:
-        return self.pid_to_cpu_percent_map
+        # 采样线程每个周期都会传入当前的进程列表，之后的轮询只解析这些 pid
+        wanted_pids = frozenset([0] + [process.pid for process in processes])
+        old_wanted_pids = self.wanted_pids
+        self.wanted_pids = wanted_pids
+        if old_wanted_pids is not None and not wanted_pids <= old_wanted_pids:
+            # 新的目标进程之前被过滤掉了，用最近一次的响应重新解析，这次采样就能读到
+            self._parse(self.last_processes)
+        self.cycle_maps = self.maps
+        return self.cycle_maps.cpu_percent
+
+    # 以下几个在同一周期内 get_pid_to_cpu_percent_map 之后调用，读的是同一份结果
 
     def get_pid_to_gpu_percent_map(self, pids: List[int]) -> Dict[int, float]:
-        return self.pid_to_gpu_percent_map
+        return self.cycle_maps.gpu_percent
 
     def get_pid_to_memory_mb_map(self, pids: List[int]) -> Dict[int, float]:
-        return self.pid_to_memory_mb_map
+        return self.cycle_maps.memory_mb
 
     def get_pid_to_vsize_mb_map(self, pids: List[int]) -> Dict[int, float]:
-        return self.pid_to_vsize_mb_map
+        return self.cycle_maps.vsize_mb
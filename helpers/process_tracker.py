@@ -0,0 +1,98 @@
+import psutil
+import time
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+ProcessKey = Tuple[int, float]
+
+# 不是目标的 pid 在这段时间之后重新检查一次，单位：秒
+# Linux 下进程 exec() 成目标程序时 pid 不变，只靠「新出现的 pid」发现不了它
+REJECTION_TTL_SECONDS = 5.0
+
+
+class ProcessTracker:
+    """
+    增量地寻找目标进程，取代每次都遍历全部进程并调用 name() 的 get_processes_by_name
+
+    - 只检查上次扫描之后新出现的 pid，确认过不是目标的 pid 一段时间内不再重复查询
+    - 已跟踪的进程用 (pid, create_time) 识别，pid 被系统复用时不会把新进程当成旧进程
+    - follow_children 为 True 时，目标进程的所有子进程都会被跟踪，无论进程名是什么
+    - 可以同时寻找多个进程名，每次扫描仍然只遍历一遍 pid；targets 记录每个进程属于哪个目标，
+      子进程归属于它的父进程所在的目标
+    """
+
+    def __init__(self, names: Iterable[str], follow_children: bool = False) -> None:
+        self.names = frozenset(names)
+        self.follow_children = follow_children
+        self.tracked: Dict[ProcessKey, psutil.Process] = {}
+        self.targets: Dict[ProcessKey, str] = {}
+        # 检查过、不是目标的 pid -> 检查的时刻；pid 消失或者超过 REJECTION_TTL_SECONDS 后
+        # 会被移出，所以复用的 pid 和 exec() 成目标的进程都会被重新检查
+        self.rejected_pids: Dict[int, float] = {}
+
+    @staticmethod
+    def key_of(process: psutil.Process) -> ProcessKey:
+        # psutil 会缓存 create_time，这里不会产生额外的系统调用
+        return (process.pid, process.create_time())
+
+    def _forget_missing(self, pids: Set[int]) -> None:
+        expire_before = time.monotonic() - REJECTION_TTL_SECONDS
+        self.rejected_pids = {
+            pid: rejected_at
+            for pid, rejected_at in self.rejected_pids.items()
+            if rejected_at > expire_before and pid in pids
+        }
+        for key, process in list(self.tracked.items()):
+            if key[0] not in pids or not process.is_running():
+                del self.tracked[key]
+                del self.targets[key]
+
+    def _track(self, process: psutil.Process, target: str) -> None:
+        try:
+            key = self.key_of(process)
+        except psutil.Error:
+            return
+        self.tracked[key] = process
+        self.targets[key] = target
+
+    def _target_of(
+        self, process: psutil.Process, tracked_pids: Dict[int, str]
+    ) -> Optional[str]:
+        """
+        返回进程所属的目标，不是目标时返回 None
+        """
+        name = process.name()
+        if name in self.names:
+            return name
+        if self.follow_children:
+            return tracked_pids.get(process.ppid())
+        return None
+
+    def _examine_new_pids(self, pids: Set[int]) -> None:
+        tracked_pids = {key[0]: target for key, target in self.targets.items()}
+        candidates = pids - self.rejected_pids.keys() - tracked_pids.keys()
+        now = time.monotonic()
+        # 跟踪子进程时，父进程可能和子进程在同一轮中出现，循环到没有新进程被跟踪为止
+        while candidates:
+            undecided = set()
+            for pid in candidates:
+                try:
+                    process = psutil.Process(pid)
+                    target = self._target_of(process, tracked_pids)
+                    if target is not None:
+                        self._track(process, target)
+                        tracked_pids[pid] = target
+                        continue
+                except psutil.Error:
+                    self.rejected_pids[pid] = now
+                    continue
+                undecided.add(pid)
+            if not self.follow_children or len(undecided) == len(candidates):
+                self.rejected_pids.update(dict.fromkeys(undecided, now))
+                break
+            candidates = undecided
+
+    def scan(self) -> List[psutil.Process]:
+        pids = set(psutil.pids())
+        self._forget_missing(pids)
+        self._examine_new_pids(pids)
+        return list(self.tracked.values())
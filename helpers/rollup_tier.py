@@ -0,0 +1,12 @@
+class RollupTier:
+    def __init__(self, seconds: int, retention_hours: float):
+        self.seconds = seconds
+        self.retention_seconds = int(retention_hours * 3600)
+
+
+# 10 秒粒度保留 6 小时，1 分钟保留 2 天，10 分钟保留 30 天
+DEFAULT_ROLLUP_TIERS = [
+    RollupTier(10, 6),
+    RollupTier(60, 48),
+    RollupTier(600, 720),
+]
@@ -1,14 +1,19 @@
 #!python3
 # encoding:utf-8
 
+import time
+
+# 启动时刻，用于测量到第一次采样的耗时，要在其他导入之前
+START_TIME = time.perf_counter()
+
 from core.kprofiler import KProfiler
 from core.history import History
 from helpers.config import Config
-from server.backend import KProfilerBackend
-from threading import Thread
 from helpers.ctrl_c_kill import kill_on_ctrl_c
-import time
-import webbrowser
+import sys
+
+# 不等第一次采样就开始加载网页服务的最长时间，单位：秒
+FIRST_SAMPLE_TIMEOUT = 1.0
 
 
 def load_config() -> Config:
@@ -19,25 +24,43 @@ def load_config() -> Config:
         exit(1)
 
 
+def run_backend(profiler: KProfiler, history: History):
+    # FastAPI、uvicorn 等导入较慢，只有需要网页时才导入，而且放在第一次采样之后
+    from server.backend import KProfilerBackend
+    import webbrowser
+
+    backend = KProfilerBackend(profiler, profiler.process_map, history)
+    backend.run(
+        on_started=lambda: webbrowser.open(
+            f"http://127.0.0.1:{profiler.config.port}", autoraise=True
+        )
+    )
+
+
 def main():
+    # --headless：只采样、写日志，不启动网页服务，也不导入 FastAPI
+    headless = "--headless" in sys.argv[1:]
     config = load_config()
-    history = History(history_upperbound=config.history_upperbound)
+    history = History(
+        history_upperbound=config.history_upperbound,
+        rollup_tiers=config.rollup_tiers,
+    )
     profiler = KProfiler(history=history, config=config)
-    backend = KProfilerBackend(profiler, profiler.process_map, history)
     profiler.subscribe_to_process_change(
         lambda: profiler.worker.performance_counter.invalidate_cache()
     )
+    kill_on_ctrl_c(before_kill=profiler.notify_stop)
     profiler.start()
 
-    if profiler.config.realtime_diagram:
-        Thread(
-            target=lambda: time.sleep(0.25)
-            or webbrowser.open(
-                f"http://127.0.0.1:{profiler.config.port}", autoraise=True
-            ),
-            daemon=True,
-        ).start()
-        backend.run()
+    if profiler.worker.first_sample.wait(FIRST_SAMPLE_TIMEOUT):
+        elapsed_millis = (time.perf_counter() - START_TIME) * 1000
+        print(f"第一次采样完成，启动耗时 {elapsed_millis:.0f} ms")
+
+    if headless and not config.write_logs:
+        print("无界面模式下没有开启 write_logs，采样结果不会被保存")
+
+    if config.realtime_diagram and not headless:
+        run_backend(profiler, history)
 
     profiler.wait_all()
 
@@ -53,5 +76,4 @@ if __name__ == "__main__":
 ╚═╝  ╚═╝╚═╝     ╚═╝  ╚═╝ ╚═════╝ ╚═╝     ╚═╝╚══════╝╚══════╝╚═╝  ╚═╝
 """
     )
-    kill_on_ctrl_c()
     main()
@@ -23,6 +23,8 @@ Copy-Item -Recurse utils dist
 
 Copy-Item -Recurse frontend/dist dist/frontend/dist
 
+python -m server.static_files dist/frontend/dist
+
 Copy-Item config.yaml dist
 Copy-Item main.py dist
 Copy-Item README.md dist
@@ -1,9 +1,23 @@
-from fastapi import FastAPI, APIRouter, staticfiles
+from fastapi import FastAPI, APIRouter, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
-from core import kprofiler, process_map as pmap, history as phistory
+from core import kprofiler, process_map as pmap, history as phistory, segment
+from core.downsample import downsample
+from core.stats import StatsCache
+from server import codec
+from server.caching import ResponseCache, REVALIDATE_CACHE_CONTROL, etag_matches
+from server.executor import ApiExecutor
+from server.static_files import PrecompressedStaticFiles
 from pydantic import BaseModel
+from typing import Optional, Dict, Any, Callable, Hashable, Iterator
+from urllib.parse import quote
+import asyncio
+import json
 import mimetypes
+import os
+import tempfile
 import uvicorn
+import zlib
 
 mimetypes.add_type("application/javascript", ".js")
 mimetypes.add_type("text/css", ".css")
@@ -13,6 +27,61 @@ class LoadHistoryRequest(BaseModel):
     full_history: str
 
 
+def _translate_record(record: phistory.HistoryRecord) -> Dict[str, Any]:
+    return {
+        "timestampSeconds": record.timestamp_seconds,
+        "process": {
+            "processId": record.process.pid,
+            "name": record.process.name,
+            "label": record.process.label,
+        },
+        "cpuPercentage": record.cpu_percent,
+        "gpuPercentage": record.gpu_percent,
+        "memoryUtilization": {
+            "uniqueSetSize": record.memory_utilization.uss_mb,
+            "residentSetSize": record.memory_utilization.rss_mb,
+            "virtualSize": record.memory_utilization.vms_mb,
+            "workingSet": record.memory_utilization.wset_mb,
+            "privateWorkingSet": record.memory_utilization.pwset_mb,
+            "fromTaskmgr": record.memory_utilization.taskmgr_mb,
+            "systemTotal": record.memory_utilization.system_total_memory_mb,
+            "systemAvailable": record.memory_utilization.system_free_memory_mb,
+            "vsize": record.memory_utilization.vsize,
+        },
+    }
+
+
+def _attachment(filename: str) -> Dict[str, str]:
+    # 目标进程名可能不是 ASCII，按 RFC 6266 编码
+    return {"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"}
+
+
+def _gzip_chunks(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+class _Server(uvicorn.Server):
+    """
+    开始监听之后调用 on_started，例如打开浏览器，不用猜服务器什么时候准备好
+    """
+
+    def __init__(
+        self, config: uvicorn.Config, on_started: Optional[Callable[[], None]]
+    ) -> None:
+        super().__init__(config)
+        self.on_started = on_started
+
+    async def startup(self, sockets=None) -> None:
+        await super().startup(sockets=sockets)
+        if self.started and self.on_started is not None:
+            self.on_started()
+
+
 def _create_fastapi_app(router: APIRouter) -> FastAPI:
     app = FastAPI()
     app.add_middleware(
@@ -36,106 +105,450 @@ class KProfilerBackend:
         self.profiler = profiler
         self.process_map = process_map
         self.history = history
+        self.stats_cache = StatsCache(history)
+        self.executor = ApiExecutor(profiler.config.api_workers)
+        self.response_cache = ResponseCache()
 
         router = APIRouter()
         router.add_api_route("/api/config", self.get_config, methods=["GET"])
         router.add_api_route("/api/history", self.get_history, methods=["GET"])
+        router.add_api_route("/api/stream", self.stream_history, methods=["GET"])
+        router.add_api_route("/api/rollup", self.get_rollup, methods=["GET"])
+        router.add_api_route("/api/stats", self.get_stats, methods=["GET"])
+        router.add_api_route("/api/status", self.get_status, methods=["GET"])
         router.add_api_route("/api/processes", self.get_processes, methods=["GET"])
+        router.add_api_route("/api/download", self.download_history, methods=["GET"])
         router.add_api_route("/api/download", self.request_download, methods=["POST"])
         router.add_api_route("/api/load", self.request_load, methods=["POST"])
         router.add_api_route("/api/clear", self.request_clear, methods=["POST"])
         self.router = router
 
         app = _create_fastapi_app(self.router)
-        app.mount("/", staticfiles.StaticFiles(directory="frontend/dist", html=True))
+        app.mount("/", PrecompressedStaticFiles(directory="frontend/dist", html=True))
         self.app = app
 
-    def get_config(self):
+    async def _cached(
+        self, request: Request, key: Hashable, encode: Callable, *args
+    ) -> Response:
+        """
+        响应体只由 key 决定的接口：key 不变时复用编码好的响应，
+        客户端的 If-None-Match 与 ETag 一致时只返回 304
+        """
+        etag = self.response_cache.etag(key)
+        headers = {"ETag": etag, "Cache-Control": REVALIDATE_CACHE_CONTROL}
+        if etag_matches(request.headers.get("if-none-match"), etag):
+            return Response(status_code=304, headers=headers)
+        body = self.response_cache.get(key)
+        if body is None:
+            body = await self.executor.run_once(key, encode, *args)
+            self.response_cache.put(key, body)
+        return Response(body, media_type="application/json", headers=headers)
+
+    async def get_config(self, request: Request):
+        """
+        配置在运行期间不变，以配置文件的校验值为版本缓存
+        """
+        return await self._cached(
+            request, ("config", self.profiler.config.version), self._encode_config
+        )
+
+    def _encode_config(self) -> bytes:
         config = self.profiler.config
-        return {
-            "targetProcessName": config.target,
-            "durationMillis": config.duration_millis,
-            "shouldShowRealtimeDiagram": config.realtime_diagram,
-            "pageUpdateIntervalMillis": config.page_update_interval,
-            "shouldWriteLogs": config.write_logs,
-            "shouldDisableGpu": config.disable_gpu,
-            "shouldShowTotalOnly": config.total_only,
-            "port": config.port,
-            "historyUpperBound": config.history_upperbound,
-            "cpuDurationMillis": config.cpu_duration_millis,
-            "gpuDurationMillis": config.gpu_duration_millis,
-            "labelCriteria": [
-                {"keyword": c.keyword, "label": c.label} for c in config.label_criteria
-            ],
-        }
+        return codec.encode_json(
+            {
+                "targetProcessName": config.target,
+                "targets": config.targets,
+                "durationMillis": config.duration_millis,
+                "shouldShowRealtimeDiagram": config.realtime_diagram,
+                "pageUpdateIntervalMillis": config.page_update_interval,
+                "shouldWriteLogs": config.write_logs,
+                "shouldDisableGpu": config.disable_gpu,
+                "shouldShowTotalOnly": config.total_only,
+                "port": config.port,
+                "historyUpperBound": config.history_upperbound,
+                "cpuDurationMillis": config.cpu_duration_millis,
+                "gpuDurationMillis": config.gpu_duration_millis,
+                "adaptiveSampling": config.adaptive_sampling,
+                "rollupResolutions": self.history.rollups.resolutions,
+                "labelCriteria": [
+                    {"keyword": c.keyword, "label": c.label}
+                    for c in config.label_criteria
+                ],
+            }
+        )
 
-    def get_history(self, offset: int, version: int):
-        need_upgrade = version != self.history.version
-        if need_upgrade:
-            records = self.history.get_offset(0)
+    async def get_history(
+        self,
+        request: Request,
+        since: Optional[int] = None,
+        offset: Optional[int] = None,
+        version: Optional[int] = None,
+        format: Optional[str] = None,
+        max_points: Optional[int] = None,
+        resolution: Optional[int] = None,
+        method: str = "minmax",
+        metric: str = "cpu_percent",
+        pid: Optional[int] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        target: Optional[str] = None,
+    ):
+        """
+        推荐使用 since：传入上次拿到的 cursor，只返回更新的记录
+        offset + version 是旧的接口，保留给旧版前端
+
+        format=columnar 返回列式 JSON，format=binary（或 Accept 为二进制类型）
+        返回打包的 float32，格式见 server/codec.py；默认仍是逐条记录的 JSON
+
+        给出 max_points 或 resolution 时返回 [start, end] 内降采样后的全部记录
+        （忽略 since，默认列式 JSON），见 core/downsample.py；
+        响应中的 cursor 可以直接用于之后的增量请求
+
+        target：只返回该目标的记录（多目标时），cursor 的含义不变
+        """
+        if format is None and codec.BINARY_MEDIA_TYPE in request.headers.get(
+            "accept", ""
+        ):
+            format = "binary"
+        if max_points is not None or resolution is not None:
+            filters = dict(
+                max_points=max_points,
+                resolution=resolution,
+                method=method,
+                metric=metric,
+                start_time=start,
+                end_time=end,
+                pid=pid,
+                target=target,
+            )
+            # 同样的参数、同一时刻的历史只降采样一次，并发的请求共用结果
+            key = ("downsample", self.history.version, self.history.next_sequence)
+            key += (format, *filters.values())
+            body = await self.executor.run_once(
+                key, self._encode_downsampled, format, filters
+            )
         else:
-            records = self.history.get_offset(offset)
+            body = await self.executor.run(
+                self._encode_history, format, since, offset, version, target
+            )
+        media_type = (
+            codec.BINARY_MEDIA_TYPE if format == "binary" else "application/json"
+        )
+        return Response(body, media_type=media_type)
+
+    def _encode_columns(self, columns: phistory.HistoryColumns, format) -> bytes:
+        if format == "binary":
+            return codec.encode_binary(columns, self.history.version)
+        return codec.encode_columnar_json(columns, self.history.version)
+
+    def _encode_downsampled(self, format: Optional[str], filters: Dict) -> bytes:
+        try:
+            columns = downsample(self.history, **filters)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return self._encode_columns(columns, format)
+
+    def _encode_history(
+        self,
+        format: Optional[str],
+        since: Optional[int],
+        offset: Optional[int],
+        version: Optional[int],
+        target: Optional[str],
+    ) -> bytes:
+        if format in ("columnar", "binary"):
+            columns = self.history.get_columns_since(since or 0, target)
+            return self._encode_columns(columns, format)
 
-        translatedRecords = []
-        for record in records:
-            translatedRecords.append(
+        if since is not None:
+            history_slice = self.history.get_since(since, target)
+            return codec.encode_json(
                 {
-                    "timestampSeconds": record.timestamp_seconds,
-                    "process": {
-                        "processId": record.process.pid,
-                        "name": record.process.name,
-                        "label": record.process.label,
-                    },
-                    "cpuPercentage": record.cpu_percent,
-                    "gpuPercentage": record.gpu_percent,
-                    "memoryUtilization": {
-                        "uniqueSetSize": record.memory_utilization.uss_mb,
-                        "residentSetSize": record.memory_utilization.rss_mb,
-                        "virtualSize": record.memory_utilization.vms_mb,
-                        "workingSet": record.memory_utilization.wset_mb,
-                        "privateWorkingSet": record.memory_utilization.pwset_mb,
-                        "fromTaskmgr": record.memory_utilization.taskmgr_mb,
-                        "systemTotal": record.memory_utilization.system_total_memory_mb,
-                        "systemAvailable": record.memory_utilization.system_free_memory_mb,
-                        "vsize": record.memory_utilization.vsize,
+                    "history": {
+                        "records": [
+                            _translate_record(r) for r in history_slice.records
+                        ],
                     },
+                    "cursor": history_slice.next_sequence,
+                    "firstSequence": history_slice.first_sequence,
+                    "gap": history_slice.gap,
+                    "version": self.history.version,
                 }
             )
 
+        need_upgrade = version != self.history.version
+        if need_upgrade:
+            records = self.history.get_offset(0)
+        else:
+            records = self.history.get_offset(offset or 0)
+        if target is not None:
+            records = [r for r in records if r.process.name == target]
+
+        return codec.encode_json(
+            {
+                "history": {
+                    "records": [_translate_record(r) for r in records],
+                },
+                "version": (self.history.version if need_upgrade else None),
+            }
+        )
+
+    async def get_rollup(
+        self,
+        resolution: int,
+        pid: Optional[int] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        target: Optional[str] = None,
+    ):
+        """
+        resolution 秒粒度的汇总（min/max/avg/p95），只与桶数有关，适合缩小后的视图
+        可选的粒度见 config.yaml 中的 rollup_tiers
+        """
+        body = await self.executor.run(
+            self._encode_rollup, resolution, start, end, pid, target
+        )
+        return Response(body, media_type="application/json")
+
+    def _encode_rollup(self, resolution, start, end, pid, target) -> bytes:
+        try:
+            rollup = self.history.get_rollup(resolution, start, end, pid, target)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return codec.encode_rollup_json(rollup)
+
+    async def get_status(self):
+        """
+        采样和日志的运行状况：当前采样间隔、超时次数、采样耗时、因磁盘跟不上丢弃的日志批次
+        采样相关的数据取自采样线程最近一次发布的快照，tick 为它的编号
+        gpuAgeMillis：GPU 按更低的频率采集，最近记录的 GPU 数据比采样时刻旧了多少毫秒，
+        停用 GPU 时为 null
+        """
+        worker = self.profiler.worker
+        log_writer = worker.log_writer
+        snapshot = worker.snapshot
         return {
-            "history": {
-                "records": translatedRecords,
-            },
-            "version": (self.history.version if need_upgrade else None),
+            "tick": snapshot.tick if snapshot is not None else 0,
+            "gpuAgeMillis": (
+                snapshot.metrics.gpu_age_millis() if snapshot is not None else None
+            ),
+            "sampling": (
+                snapshot.sampling
+                if snapshot is not None
+                else worker.interval_controller.stats()
+            ),
+            "droppedLogBatches": (
+                log_writer.dropped_batches if log_writer is not None else 0
+            ),
+            "historySize": len(self.history),
+            "version": self.history.version,
         }
 
-    def get_processes(self):
-        self.profiler.reload_processes()
-        return {
-            "processes": list(
-                map(
-                    lambda p: {
+    async def get_stats(
+        self,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        target: Optional[str] = None,
+    ):
+        """
+        每个进程、每个标签（同一时刻该标签下所有进程之和）以及总值在 [start, end] 内的
+        mean / min / max / stddev / p50 / p95 / p99 / slope（每秒的变化量），
+        指标名与 /api/history 一致
+        多目标时 totals 为每个目标的总值，total 只在只有一个目标或指定了 target 时给出
+        """
+        history = self.history
+        key = ("stats", history.version, history.next_sequence, start, end, target)
+        body = await self.executor.run_once(key, self._encode_stats, start, end, target)
+        return Response(body, media_type="application/json")
+
+    def _encode_stats(self, start, end, target) -> bytes:
+        stats = self.stats_cache.get(start, end, target)
+
+        def _translate(item):
+            if item is None:
+                return None
+            return {
+                **item,
+                "metrics": {
+                    codec.COLUMN_NAMES[field]: values
+                    for field, values in item["metrics"].items()
+                },
+            }
+
+        return codec.encode_json(
+            {
+                "processes": [_translate(item) for item in stats["processes"]],
+                "labels": [_translate(item) for item in stats["labels"]],
+                "total": _translate(stats["total"]),
+                "totals": [_translate(item) for item in stats["totals"]],
+                "version": self.history.version,
+            }
+        )
+
+    async def stream_history(self, request: Request, target: Optional[str] = None):
+        """
+        Server-Sent Events：采样线程每产生一批记录就推送一次
+        每个事件带 since/cursor，前端发现 since 与本地 cursor 不一致时用 /api/history 补齐
+        target：只推送该目标的记录；其他目标的批次也会推送（记录为空），保证 since/cursor 连续
+        """
+        broadcaster = self.profiler.broadcaster
+        subscription = broadcaster.subscribe(asyncio.get_running_loop())
+
+        async def _events():
+            try:
+                yield "retry: 1000\n\n"
+                while not await request.is_disconnected():
+                    try:
+                        batch = await asyncio.wait_for(subscription.get(), timeout=15)
+                    except asyncio.TimeoutError:
+                        yield ": keep-alive\n\n"
+                        continue
+                    records = batch.records
+                    if target is not None:
+                        records = [r for r in records if r.process.name == target]
+                    data = {
+                        "records": [_translate_record(r) for r in records],
+                        "since": batch.since,
+                        "cursor": batch.cursor,
+                        "version": batch.version,
+                    }
+                    yield f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+            finally:
+                broadcaster.unsubscribe(subscription)
+
+        return StreamingResponse(
+            _events(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    async def get_processes(self, request: Request, target: Optional[str] = None):
+        """
+        采样线程每个周期都会扫描进程，这里只读取最近发布的进程快照，
+        不加锁、不调用 psutil，也就不会和采样线程抢进程扫描；
+        同一份快照只生成一次响应，进程列表没有变化时轮询只得到 304
+        """
+        snapshot = self.process_map.snapshot
+        return await self._cached(
+            request,
+            ("processes", snapshot.generation, target),
+            self._encode_processes,
+            snapshot,
+            target,
+        )
+
+    def _encode_processes(
+        self, snapshot: pmap.ProcessSnapshot, target: Optional[str]
+    ) -> bytes:
+        return codec.encode_json(
+            {
+                "processes": [
+                    {
                         "processId": p.pid,
-                        "name": p.name(),
-                        "label": self.process_map.get_label(p.pid),
-                    },
-                    self.process_map.processes,
-                )
+                        "name": snapshot.pid_to_name.get(p.pid),
+                        "label": snapshot.get_label(p.pid),
+                        "target": snapshot.get_target(p.pid),
+                    }
+                    for p in snapshot.processes
+                    if target is None or snapshot.get_target(p.pid) == target
+                ],
+                "generation": snapshot.generation,
+            }
+        )
+
+    async def download_history(
+        self,
+        format: str = "csv",
+        gzip: bool = False,
+        pid: Optional[int] = None,
+        label: Optional[str] = None,
+        start: Optional[float] = None,
+        end: Optional[float] = None,
+        target: Optional[str] = None,
+    ):
+        """
+        流式导出，边生成边发送，内存占用与历史长度无关；每一块都在接口线程池中生成
+        format：csv 或 segment（分段文件，见 core/segment.py）
+        gzip：把 CSV 压缩成 .csv.gz，/api/load 可以直接载入
+        pid / label / start / end：只导出指定进程、标签和时间范围（秒，闭区间）的记录
+        target：只导出该目标的记录
+        """
+        filters = dict(
+            start_time=start, end_time=end, pid=pid, label=label, target=target
+        )
+        filename = f"history-{target or self.profiler.config.targets_name}"
+        if format == "segment":
+            return StreamingResponse(
+                self.executor.iterate(segment.iter_segment(self.history, **filters)),
+                media_type="application/octet-stream",
+                headers=_attachment(filename + ".kpseg"),
             )
-        }
+        if format != "csv":
+            raise HTTPException(status_code=400, detail=f"不支持的格式：{format}")
 
-    def request_download(self):
-        full_history = self.history.serialize()
-        return {"fullHistory": full_history}
+        chunks = (chunk.encode("utf-8") for chunk in self.history.iter_csv(**filters))
+        if not gzip:
+            return StreamingResponse(
+                self.executor.iterate(chunks),
+                media_type="text/csv",
+                headers=_attachment(filename + ".csv"),
+            )
+        return StreamingResponse(
+            self.executor.iterate(_gzip_chunks(chunks)),
+            media_type="application/gzip",
+            headers=_attachment(filename + ".csv.gz"),
+        )
 
-    def request_load(self, data: LoadHistoryRequest):
-        self.history.parse_and_load(
-            data.full_history,
-            history_upperbound=self.profiler.config.history_upperbound,
+    async def request_download(self):
+        body = await self.executor.run(
+            lambda: codec.encode_json({"fullHistory": self.history.serialize()})
         )
+        return Response(body, media_type="application/json")
 
-    def request_clear(self):
-        self.history.records.clear()
+    async def request_load(self, request: Request):
+        """
+        请求体直接是文件内容（CSV、.csv.gz 或分段文件），边接收边写入临时文件，
+        再在接口线程池里逐行载入，内存占用只和 history_upperbound 有关
+        Content-Type 为 application/json 时按旧接口处理 {"full_history": "..."}
+        服务端监听 0.0.0.0，不提供按路径读取服务器本地文件的方式
+        """
+        upperbound = self.profiler.config.history_upperbound
+        try:
+            if request.headers.get("content-type", "").startswith("application/json"):
+                data = LoadHistoryRequest(**await request.json())
+                report = await self.executor.run(
+                    self.history.parse_and_load, data.full_history, upperbound
+                )
+            else:
+                fd, temp_path = tempfile.mkstemp(prefix="kprofiler-load-")
+                try:
+                    with os.fdopen(fd, "wb") as f:
+                        async for chunk in request.stream():
+                            f.write(chunk)
+                    report = await self.executor.run(
+                        self.history.parse_file_and_load, temp_path, upperbound
+                    )
+                finally:
+                    os.remove(temp_path)
+        except (OSError, ValueError) as e:
+            raise HTTPException(status_code=400, detail=str(e))
 
-    def run(self):
-        uvicorn.run(self.app, host="0.0.0.0", port=6308, log_level="error")
+        return {
+            "loaded": report.loaded,
+            "failed": report.failed,
+            "errors": [
+                {"line": line, "message": message} for line, message in report.errors
+            ],
+        }
+
+    async def request_clear(self):
+        self.history.clear()
+
+    def run(self, on_started: Optional[Callable[[], None]] = None):
+        config = uvicorn.Config(
+            self.app,
+            host="0.0.0.0",
+            port=self.profiler.config.port,
+            log_level="error",
+        )
+        _Server(config, on_started).run()
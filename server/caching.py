@@ -0,0 +1,59 @@
+"""
+接口响应的缓存与 ETag
+
+- 响应体只由 key 决定（例如 /api/processes 的 key 是进程快照的 generation 和目标），
+  key 不变就直接复用上次编码好的字节，不再进线程池
+- ETag 由 key 算出，浏览器带着 If-None-Match 轮询时，没有变化只返回 304，不发送响应体
+- generation 等计数每次启动都从头开始，ETag 中加上本次启动的编号，重启后不会误用旧缓存
+"""
+
+from collections import OrderedDict
+from typing import Hashable, Optional
+import hashlib
+import uuid
+
+# 让浏览器每次都带着 ETag 来确认，而不是在一段时间内直接使用本地缓存
+REVALIDATE_CACHE_CONTROL = "no-cache"
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*":
+            return True
+        # 弱比较：忽略 W/ 前缀
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == etag:
+            return True
+    return False
+
+
+class ResponseCache:
+    """
+    key -> (ETag, 编码好的响应体)，按最近使用淘汰
+    只在事件循环线程上使用，不需要加锁
+    """
+
+    def __init__(self, capacity: int = 64) -> None:
+        self.capacity = capacity
+        self.instance = uuid.uuid4().hex[:8]
+        self.cache: "OrderedDict[Hashable, bytes]" = OrderedDict()
+
+    def etag(self, key: Hashable) -> str:
+        digest = hashlib.sha1(repr(key).encode("utf-8")).hexdigest()[:16]
+        return f'"{self.instance}-{digest}"'
+
+    def get(self, key: Hashable) -> Optional[bytes]:
+        body = self.cache.get(key)
+        if body is not None:
+            self.cache.move_to_end(key)
+        return body
+
+    def put(self, key: Hashable, body: bytes) -> None:
+        self.cache[key] = body
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
@@ -0,0 +1,139 @@
+from core.history import HistoryColumns
+from core.rollup import RollupColumns
+from array import array
+from typing import Dict, Any, List
+import json
+import struct
+import sys
+
+# 列名与 /api/history 默认 JSON 中的字段名保持一致，前端解码后可以直接拼回 HistoryRecord
+COLUMN_NAMES = {
+    "cpu_percent": "cpuPercentage",
+    "gpu_percent": "gpuPercentage",
+    "taskmgr_mb": "fromTaskmgr",
+    "uss_mb": "uniqueSetSize",
+    "rss_mb": "residentSetSize",
+    "vms_mb": "virtualSize",
+    "wset_mb": "workingSet",
+    "pwset_mb": "privateWorkingSet",
+    "system_total_memory_mb": "systemTotal",
+    "system_free_memory_mb": "systemAvailable",
+    "vsize": "vsize",
+}
+
+# KPH2：时间戳由整秒的差分改为 f64 秒，精确到毫秒
+BINARY_MAGIC = b"KPH2"
+BINARY_MEDIA_TYPE = "application/x-kprofiler-columns"
+
+
+def encode_json(body: Any) -> bytes:
+    return json.dumps(body, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _to_millis(timestamps: array) -> List[int]:
+    return [round(timestamp * 1000) for timestamp in timestamps]
+
+
+def _delta_encode(timestamps: array) -> List[int]:
+    """
+    相邻时间戳之差，单位毫秒；先取整到毫秒再相减，前端逐个累加不会积累误差
+    """
+    if len(timestamps) == 0:
+        return []
+    millis = _to_millis(timestamps)
+    return [0] + [b - a for a, b in zip(millis, millis[1:])]
+
+
+def _make_header(columns: HistoryColumns, version: int) -> Dict[str, Any]:
+    return {
+        "processes": [
+            {
+                "id": kind_id,
+                "processId": kind.pid,
+                "name": kind.name,
+                "label": kind.label,
+            }
+            for kind_id, kind in columns.kinds.items()
+        ],
+        "count": len(columns.kind_ids),
+        # 秒，精确到毫秒；列式 JSON 中之后的 timestampDeltas 单位为毫秒
+        "timestampBase": (
+            round(columns.timestamps[0] * 1000) / 1000 if len(columns.timestamps) else 0
+        ),
+        "cursor": columns.next_sequence,
+        "firstSequence": columns.first_sequence,
+        "gap": columns.gap,
+        "version": version,
+    }
+
+
+def encode_columnar_json(columns: HistoryColumns, version: int) -> bytes:
+    """
+    列式 JSON：进程字典只发一次，每个指标一个数组，时间戳按毫秒差分编码
+    float32 保留 3 位小数，避免 12.300000190734863 这种尾巴撑大体积
+    """
+    body = _make_header(columns, version)
+    body["format"] = "columnar"
+    body["kinds"] = columns.kind_ids.tolist()
+    body["timestampDeltas"] = _delta_encode(columns.timestamps)
+    body["columns"] = {
+        COLUMN_NAMES[field]: [round(v, 3) for v in values]
+        for field, values in columns.metrics.items()
+    }
+    return encode_json(body)
+
+
+def encode_binary(columns: HistoryColumns, version: int) -> bytes:
+    """
+    二进制格式，全部小端：
+    magic(4) | header 长度 u32 | header JSON | 补齐到 8 字节
+    | 时间戳 f64[count]（秒）| kinds u32[count] | 每个指标 f32[count]，顺序见 header.columns
+    时间戳不用差分：毫秒的差分超过 i32 只要 24 天，载入旧文件之后接着采样就会出现
+    """
+    header = _make_header(columns, version)
+    header["format"] = "binary"
+    header["columns"] = [COLUMN_NAMES[field] for field in columns.metrics]
+    header_bytes = json.dumps(header, ensure_ascii=False).encode("utf-8")
+    # 前面的 magic 和长度共 8 字节，补齐之后 f64 的时间戳按 8 字节对齐
+    header_bytes += b" " * (-len(header_bytes) % 8)
+
+    blocks = [
+        array("d", columns.timestamps),
+        array("I", columns.kind_ids),
+        *columns.metrics.values(),
+    ]
+    parts = [BINARY_MAGIC, struct.pack("<I", len(header_bytes)), header_bytes]
+    for block in blocks:
+        if sys.byteorder == "big":
+            block = array(block.typecode, block)
+            block.byteswap()
+        parts.append(block.tobytes())
+    return b"".join(parts)
+
+
+def encode_rollup_json(rollup: RollupColumns) -> bytes:
+    """
+    汇总数据：每个桶一行，每个指标按统计量分别给出一个数组
+    """
+    body = {
+        "resolution": rollup.seconds,
+        "processes": [
+            {
+                "id": kind_id,
+                "processId": kind.pid,
+                "name": kind.name,
+                "label": kind.label,
+            }
+            for kind_id, kind in rollup.kinds.items()
+        ],
+        "kinds": rollup.kind_ids.tolist(),
+        "timestamps": rollup.timestamps.tolist(),
+        "counts": rollup.counts.tolist(),
+        "columns": {
+            COLUMN_NAMES[field]: {
+                stat: [round(v, 3) for v in values] for stat, values in stats.items()
+            }
+            for field, stats in rollup.stats.items()
+        },
+    }
+    return encode_json(body)
@@ -0,0 +1,70 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Hashable, Iterator
+import asyncio
+import functools
+
+# 迭代结束的标记，next() 的默认值
+_DONE = object()
+
+
+class SingleFlight:
+    """
+    相同 key 的并发调用合并成一次：第一个调用真正执行，之后到达的等待同一个结果
+    只在事件循环线程上使用，不需要加锁
+    """
+
+    def __init__(self) -> None:
+        self.inflight: Dict[Hashable, asyncio.Future] = {}
+
+    async def run(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(fn())
+            self.inflight[key] = future
+            future.add_done_callback(lambda _: self._forget(key, future))
+        # 某个客户端断开时只取消它自己的等待，不影响共用结果的其他请求
+        return await asyncio.shield(future)
+
+    def _forget(self, key: Hashable, future: asyncio.Future) -> None:
+        if self.inflight.get(key) is future:
+            del self.inflight[key]
+
+
+class ApiExecutor:
+    """
+    接口的耗时操作（序列化、统计、导出）放到这里的几个线程中执行，不占用事件循环
+    线程数有上限：同时在跑的重活最多 max_workers 个，不会像 Starlette 默认的 40 个线程那样
+    一起抢 GIL、拖慢采样线程；多出来的请求在队列里等待
+    历史数据在本进程的内存中，换成进程池需要先把数据复制过去，反而更慢，所以用线程池
+    """
+
+    def __init__(self, max_workers: int) -> None:
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, max_workers), thread_name_prefix="kprofiler-api"
+        )
+        self.single_flight = SingleFlight()
+
+    async def run(self, fn: Callable, *args, **kwargs) -> Any:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs)
+        )
+
+    async def run_once(self, key: Hashable, fn: Callable, *args, **kwargs) -> Any:
+        """
+        同 run，但 key 相同的并发调用共用一次执行
+        """
+        return await self.single_flight.run(key, lambda: self.run(fn, *args, **kwargs))
+
+    async def iterate(self, iterator: Iterator) -> AsyncIterator:
+        """
+        在线程池中逐个取出 iterator 的元素，用于流式响应
+        """
+        while True:
+            item = await self.run(next, iterator, _DONE)
+            if item is _DONE:
+                return
+            yield item
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
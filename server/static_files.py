@@ -0,0 +1,144 @@
+"""
+前端静态文件
+
+- 浏览器支持时优先发送预先压缩好的 .br / .gz，不在每次请求时压缩
+- vite 输出到 assets/ 下的文件名带内容哈希，内容变了文件名也会变，可以永久缓存；
+  index.html 等其他文件每次都用 ETag 向服务端确认，没变化时只返回 304
+
+预压缩：python -m server.static_files frontend/dist
+没有安装 brotli 时只生成 .gz
+"""
+
+from starlette.datastructures import Headers
+from starlette.responses import FileResponse, Response
+from starlette.staticfiles import NotModifiedResponse, StaticFiles
+from starlette.types import Scope
+from typing import List, Tuple
+import gzip
+import mimetypes
+import os
+import re
+import stat
+import sys
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# (Content-Encoding, 后缀)，按优先级排列
+ENCODINGS = (("br", ".br"), ("gzip", ".gz"))
+
+# 小于这个大小的文件压缩不划算
+MIN_COMPRESS_BYTES = 1024
+
+COMPRESSIBLE_EXTENSIONS = (".html", ".js", ".css", ".json", ".svg", ".txt", ".map")
+
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# vite 默认的输出文件名：assets/<名字>-<8 位哈希>.<扩展名>
+_HASHED_ASSET = re.compile(r"(^|/)assets/.+-[\w-]{8}\.\w+$")
+
+
+def _accepted_encodings(request_headers: Headers) -> List[str]:
+    accept = request_headers.get("accept-encoding", "")
+    return [item.split(";")[0].strip() for item in accept.split(",")]
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    def file_response(
+        self,
+        full_path,
+        stat_result: os.stat_result,
+        scope: Scope,
+        status_code: int = 200,
+    ) -> Response:
+        request_headers = Headers(scope=scope)
+        full_path = str(full_path)
+        media_type = mimetypes.guess_type(full_path)[0] or "text/plain"
+        accepted = _accepted_encodings(request_headers)
+
+        response = None
+        for encoding, suffix in ENCODINGS:
+            if encoding not in accepted:
+                continue
+            try:
+                compressed_stat = os.stat(full_path + suffix)
+            except OSError:
+                continue
+            if not stat.S_ISREG(compressed_stat.st_mode):
+                continue
+            # ETag 由压缩文件的大小和修改时间算出，与未压缩的版本不同
+            response = FileResponse(
+                full_path + suffix,
+                status_code=status_code,
+                stat_result=compressed_stat,
+                media_type=media_type,
+                headers={"Content-Encoding": encoding},
+            )
+            break
+        if response is None:
+            response = FileResponse(
+                full_path,
+                status_code=status_code,
+                stat_result=stat_result,
+                media_type=media_type,
+            )
+
+        response.headers["Vary"] = "Accept-Encoding"
+        relative_path = scope.get("path", "").lstrip("/")
+        if _HASHED_ASSET.search(relative_path):
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        else:
+            response.headers["Cache-Control"] = "no-cache"
+
+        if self.is_not_modified(response.headers, request_headers):
+            return NotModifiedResponse(response.headers)
+        return response
+
+
+def precompress(directory: str) -> List[Tuple[str, int, int]]:
+    """
+    为目录下的文本类文件生成 .gz（以及 .br），已经是最新的跳过
+    返回 (文件, 原大小, 压缩后最小的大小)
+    """
+    ret = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE_EXTENSIONS):
+                continue
+            path = os.path.join(root, name)
+            source_stat = os.stat(path)
+            if source_stat.st_size < MIN_COMPRESS_BYTES:
+                continue
+            with open(path, "rb") as f:
+                content = f.read()
+            sizes = []
+            for encoding, suffix in ENCODINGS:
+                if encoding == "br":
+                    if brotli is None:
+                        continue
+                    compressed = brotli.compress(content, quality=11)
+                else:
+                    compressed = gzip.compress(content, compresslevel=9, mtime=0)
+                # 压缩后反而更大就不生成，请求时直接发送原文件
+                if len(compressed) >= len(content):
+                    continue
+                with open(path + suffix, "wb") as f:
+                    f.write(compressed)
+                # 与原文件保持相同的修改时间，原文件更新后重新生成即可
+                os.utime(path + suffix, (source_stat.st_atime, source_stat.st_mtime))
+                sizes.append(len(compressed))
+            if len(sizes) > 0:
+                ret.append((path, len(content), min(sizes)))
+    return ret
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("用法：python -m server.static_files <前端 dist 目录>")
+        exit(1)
+    if brotli is None:
+        print("没有安装 brotli，只生成 .gz")
+    for path, size, compressed_size in precompress(sys.argv[1]):
+        print(f"{path}: {size} -> {compressed_size} 字节")
@@ -0,0 +1 @@
+# O.o
@@ -0,0 +1,158 @@
+"""
+History 按 pid / 时间窗口查询的基准测试
+
+构造 N 条记录（默认 500 万，50 个进程，每个进程每秒一条），
+对比索引查询与逐条扫描（索引之前 get_all / get_latest 的做法）的耗时
+
+另外把最近 LOAD_ROWS 条写成分段文件和 CSV 再载入（连同多级汇总），
+每行的耗时超过 LOAD_BUDGET_MICROS 时以非 0 退出，防止载入又退化成逐行重建汇总
+
+用法：python -m tools.bench_history_query [记录数]
+"""
+
+from core.history import History, ProcessKind, METRIC_FIELDS
+from core.segment import iter_segment
+from helpers.memory_helper import MemoryUtilization
+from array import array
+from typing import Callable, List
+import os
+import sys
+import tempfile
+import time
+
+PROCESS_COUNT = 50
+WINDOW_SECONDS = 10 * 60
+REPEAT = 5
+
+# 载入基准的记录数；50 个进程约一个多小时的数据，都在最细一级汇总的保留时长之内
+LOAD_ROWS = 200_000
+
+# 载入时每行耗时的上限，单位：微秒；逐行重建汇总时分段文件约 14 µs/行、CSV 约 19 µs/行
+LOAD_BUDGET_MICROS = {"分段文件": 10.0, "CSV": 17.0}
+
+
+def build_history(count: int) -> History:
+    history = History(count)
+    store = history._store
+    kind_ids = [
+        store.intern(ProcessKind(pid=1000 + i, name="bench.exe", label="主进程"))
+        for i in range(PROCESS_COUNT)
+    ]
+    origin = int(time.time()) - count // PROCESS_COUNT
+    values = array("f", ((i * 7919) % 1000 / 10 for i in range(count)))
+    # 批量写入，比逐条 add_record 快得多；索引照常维护
+    store.extend(
+        array("d", (origin + i // PROCESS_COUNT for i in range(count))),
+        array("I", (kind_ids[i % PROCESS_COUNT] for i in range(count))),
+        # 取值要有变化，汇总里的排序才和真实数据的开销相当
+        {field: values for field in METRIC_FIELDS},
+    )
+    return history
+
+
+def bench_load(count: int) -> bool:
+    """
+    把 count 条记录写成分段文件和 CSV，再分别载入；返回是否都在预算之内
+    """
+    source = build_history(count)
+    ok = True
+    with tempfile.TemporaryDirectory() as directory:
+        segment_path = os.path.join(directory, "bench.kpseg")
+        with open(segment_path, "wb") as f:
+            for chunk in iter_segment(source):
+                f.write(chunk)
+        csv_path = os.path.join(directory, "bench.csv")
+        with open(csv_path, "w", encoding="utf-8", newline="") as f:
+            for chunk in source.iter_csv():
+                f.write(chunk)
+
+        for name, path in (("分段文件", segment_path), ("CSV", csv_path)):
+            history = History(count)
+            start = time.perf_counter()
+            report = history.parse_file_and_load(path, count)
+            elapsed = time.perf_counter() - start
+            finest = history.get_rollup(history.rollups.resolutions[0])
+            assert report.loaded == count and sum(finest.counts) == count
+
+            micros = elapsed / count * 1e6
+            budget = LOAD_BUDGET_MICROS[name]
+            print(
+                f"载入{name} {count} 条（含汇总）：{elapsed:.2f} s，"
+                f"{micros:.1f} µs/行，预算 {budget:.0f} µs/行"
+            )
+            if micros > budget:
+                print(f"  {name}载入超出预算")
+                ok = False
+    return ok
+
+
+def linear_window(history: History, pid: int, start: int, end: int) -> List:
+    store = history._store
+    kinds, kind_ids, timestamps = store.kinds, store.kind_ids, store.timestamps
+    return [
+        store.record_at(slot)
+        for slot in store.iter_slots()
+        if kinds[kind_ids[slot]].pid == pid and start <= timestamps[slot] <= end
+    ]
+
+
+def linear_latest(history: History, pid: int, count: int) -> List:
+    store = history._store
+    kinds, kind_ids = store.kinds, store.kind_ids
+    slots = [slot for slot in store.iter_slots() if kinds[kind_ids[slot]].pid == pid]
+    return [store.record_at(slot) for slot in slots[-count:]]
+
+
+def measure(fn: Callable[[], List], repeat: int) -> float:
+    # 取多次中最快的一次，单位：毫秒
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5_000_000
+    start = time.perf_counter()
+    history = build_history(count)
+    print(f"构造 {len(history)} 条记录，耗时 {time.perf_counter() - start:.1f} s")
+
+    pid = 1000 + PROCESS_COUNT // 2
+    end_time = history._store.timestamp_of(history.next_sequence - 1)
+    start_time = end_time - WINDOW_SECONDS
+
+    class Window:
+        start = start_time
+        end = end_time
+
+    cases = [
+        (
+            f"单个 pid、{WINDOW_SECONDS // 60} 分钟窗口",
+            lambda: history.get_all(Window, pid),
+            lambda: linear_window(history, pid, start_time, end_time),
+        ),
+        (
+            "单个 pid、最近 100 条",
+            lambda: history.get_latest(100, pid),
+            lambda: linear_latest(history, pid, 100),
+        ),
+    ]
+    for name, indexed, linear in cases:
+        assert indexed() == linear()
+        indexed_millis = measure(indexed, REPEAT)
+        # 逐条扫描很慢，只跑一次
+        linear_millis = measure(linear, 1)
+        print(
+            f"{name}：索引 {indexed_millis:.2f} ms，逐条扫描 {linear_millis:.0f} ms，"
+            f"快 {linear_millis / indexed_millis:.0f} 倍"
+        )
+
+    if not bench_load(min(count, LOAD_ROWS)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,3 +3,11 @@ import sys
 
 def is_macos() -> bool:
     return sys.platform == "darwin"
+
+
+def is_linux() -> bool:
+    return sys.platform.startswith("linux")
+
+
+def is_windows() -> bool:
+    return sys.platform == "win32"